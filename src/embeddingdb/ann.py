@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+
+"""Approximate nearest neighbor search with an inverted file index and optional product quantization.
+
+An :class:`IVFIndex` partitions a collection with k-means into ``n_lists`` inverted lists. A query only visits
+the ``nprobe`` lists whose centroids are closest to it. Within the lists, candidates are either scored exactly
+against the collection's matrix or, when the index is built with product quantization, approximately from
+compact codes of their residuals to the list centroids, optionally re-ranking the best of them exactly.
+
+Rows are always assigned to lists by Euclidean distance, after normalizing them for the ``cosine`` metric.
+For the ``dot`` metric, the rows aren't normalized and queries visit the lists whose centroids have the
+largest inner products with them instead, which favors the lists of rows with large norms like the
+similarity itself does.
+
+Indexes are stored with the files derived from the collection they were built from (see
+:meth:`embeddingdb.cache.CollectionCache.get_derived_path`), along with the parameters they were built with,
+so they outlive the eviction of the collection's cache entry. They are picked up by
+:func:`embeddingdb.search.get_index`.
+"""
+
+import json
+import os
+import shutil
+import time
+import uuid
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+
+import click
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from .cache import CollectionCache
+from .constants import config
+from .search import ExactIndex, METRICS, _top_k, sort_by_curie
+from .sql.models import Collection, get_session
+
+__all__ = [
+    'IVFIndex',
+    'build_ivf_index',
+    'get_ivf_index_path',
+    'load_ivf_index',
+    'evaluate_ivf_index',
+    'main',
+]
+
+_METADATA = 'metadata.json'
+_ARRAYS = ('centroids', 'order', 'offsets', 'codes', 'codebooks')
+
+#: The number of code words per product quantization subspace
+_PQ_CODES = 256
+
+#: The number of rows assigned to lists or encoded at a time while building
+_BUILD_BLOCK_SIZE = 65_536
+
+
+class IVFIndex(ExactIndex):
+    """An inverted file index over a matrix of vectors labeled by sorted CURIEs."""
+
+    def __init__(
+            self,
+            curies: Sequence[str],
+            vectors: np.ndarray,
+            *,
+            centroids: np.ndarray,
+            order: np.ndarray,
+            offsets: np.ndarray,
+            codes: Optional[np.ndarray] = None,
+            codebooks: Optional[np.ndarray] = None,
+            metric: str = 'cosine',
+            nprobe: int = 8,
+            metadata: Optional[Mapping[str, Any]] = None,
+    ) -> None:
+        """Initialize the index. Use :func:`build_ivf_index` or :func:`load_ivf_index` instead.
+
+        :param curies: The sorted CURIEs labeling the rows of the matrix
+        :param vectors: The float32 matrix the index was built from
+        :param centroids: The centroids of the inverted lists
+        :param order: The rows of the matrix, grouped by inverted list
+        :param offsets: The start of each list in ``order`` (and ``codes``), followed by the number of rows
+        :param codes: The product quantization codes of the rows, in the same order as ``order``
+        :param codebooks: The code words of each subspace, of shape ``(subspaces, 256, dimensions / subspaces)``
+        :param metric: Either ``cosine`` or ``dot``
+        :param nprobe: The default number of lists visited per query
+        :param metadata: The parameters the index was built with
+        """
+        super().__init__(curies, vectors, metric=metric)
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.codes = codes
+        self.codebooks = codebooks
+        self.nprobe = nprobe
+        self.metadata = dict(metadata or {})
+
+    @property
+    def n_lists(self) -> int:
+        """The number of inverted lists."""
+        return len(self.centroids)
+
+    def search(
+            self,
+            queries: np.ndarray,
+            k: int,
+            nprobe: Optional[int] = None,
+            refine: Optional[int] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find approximately the k most similar rows to each query.
+
+        :param queries: A matrix of shape ``(m, dimensions)``
+        :param k: The number of neighbors to find per query
+        :param nprobe: The number of inverted lists visited per query. Defaults to the index's ``nprobe``.
+        :param refine: With product quantization, ``refine * k`` candidates are re-ranked with the exact
+         vectors. Defaults to the value the index was built with. Set to 0 to only use the codes.
+        :return: The positions and similarities of the neighbors, both of shape ``(m, k)`` and sorted by
+         decreasing similarity. Rows are padded with position -1 if fewer than k candidates were found.
+        """
+        if k < 1:
+            raise ValueError(f'k should be positive: {k}')
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        if refine is None:
+            refine = self.metadata.get('refine', 0)
+
+        queries = self._normalize_queries(queries)
+        if self.metric == 'dot':
+            distances = -(queries @ self.centroids.T)
+        else:
+            distances = (
+                np.einsum('ij,ij->i', self.centroids, self.centroids)[np.newaxis, :]
+                - 2 * queries @ self.centroids.T
+            )
+        probes = np.argpartition(distances, nprobe - 1, axis=1)[:, :nprobe]
+
+        rv_positions = np.full((len(queries), k), -1, dtype=np.int64)
+        rv_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            slices = [slice(self.offsets[list_id], self.offsets[list_id + 1]) for list_id in lists]
+            positions = np.concatenate([self.order[s] for s in slices])
+            if not len(positions):
+                continue
+            if self.codes is None:
+                scores = self._score_exact(query, positions)
+            else:
+                scores = self._score_codes(query, lists, slices)
+                if refine:
+                    positions, scores = _top_k(positions[np.newaxis], scores[np.newaxis], refine * k)
+                    positions = positions[0]
+                    scores = self._score_exact(query, positions)
+            positions, scores = _top_k(positions[np.newaxis], scores[np.newaxis], k)
+            order = np.argsort(-scores[0])
+            rv_positions[i, :len(order)] = positions[0, order]
+            rv_scores[i, :len(order)] = scores[0, order]
+        return rv_positions, rv_scores
+
+    def _normalize_queries(self, queries: np.ndarray) -> np.ndarray:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            queries = queries / np.where(norms > 0, norms, 1)
+        return queries
+
+    def _score_exact(self, query: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        # sorting the positions makes reads from a memory-mapped matrix sequential
+        order = np.argsort(positions)
+        scores = np.empty(len(positions), dtype=np.float32)
+        scores[order] = np.asarray(self.vectors[positions[order]]) @ query
+        if self.inverse_norms is not None:
+            scores *= self.inverse_norms[positions]
+        return scores
+
+    def _score_codes(self, query: np.ndarray, lists: np.ndarray, slices) -> np.ndarray:
+        subspaces = len(self.codebooks)
+        # the similarity to each code word of each subspace
+        table = np.einsum('sjd,sd->sj', self.codebooks, query.reshape(subspaces, -1))
+        return np.concatenate([
+            self.centroids[list_id] @ query + table[np.arange(subspaces), self.codes[s]].sum(axis=1)
+            for list_id, s in zip(lists, slices)
+        ])
+
+    def save(self, directory: str) -> None:
+        """Save the index to a directory.
+
+        The directory is written to a temporary location first and renamed into place.
+        """
+        tmp_directory = f'{directory}.tmp-{uuid.uuid4().hex}'
+        os.makedirs(tmp_directory)
+        for name in _ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(tmp_directory, f'{name}.npy'), array)
+        with open(os.path.join(tmp_directory, _METADATA), 'w') as file:
+            json.dump(self.metadata, file, indent=2)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_directory, directory)
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def _iter_blocks(vectors: np.ndarray, metric: str):
+    for start in range(0, len(vectors), _BUILD_BLOCK_SIZE):
+        block = np.asarray(vectors[start:start + _BUILD_BLOCK_SIZE], dtype=np.float32)
+        yield start, _normalize_rows(block) if metric == 'cosine' else block
+
+
+def build_ivf_index(
+        curies: Sequence[str],
+        vectors: np.ndarray,
+        *,
+        metric: str = 'cosine',
+        n_lists: Optional[int] = None,
+        subspaces: int = 0,
+        nprobe: int = 8,
+        refine: int = 0,
+        sample_size: Optional[int] = None,
+        seed: int = 0,
+) -> IVFIndex:
+    """Build an inverted file index.
+
+    :param curies: The CURIEs labeling the rows of the matrix. If they are not sorted, the CURIEs and
+     the matrix are sorted together first.
+    :param vectors: A float32 matrix
+    :param metric: Either ``cosine`` or ``dot``
+    :param n_lists: The number of inverted lists. Defaults to four times the square root of the number of rows
+     and is capped at the number of rows.
+    :param subspaces: The number of product quantization subspaces, which must divide the dimensions.
+     Set to 0 to score candidates exactly instead.
+    :param nprobe: The default number of lists visited per query
+    :param refine: With product quantization, the default factor of candidates re-ranked exactly
+    :param sample_size: The number of rows k-means is trained on. Defaults to 64 per list (or code word).
+    :param seed: The random seed for sampling and k-means
+    :raises ValueError: If the collection is empty or the parameters are invalid
+    """
+    if metric not in METRICS:
+        raise ValueError(f'invalid metric: {metric}. Should be one of {METRICS}')
+    if n_lists is not None and n_lists < 1:
+        raise ValueError(f'the number of lists should be positive: {n_lists}')
+    curies, vectors = sort_by_curie(curies, vectors)
+    n, dimensions = vectors.shape
+    if n == 0:
+        raise ValueError('can not build an index of an empty collection')
+    if subspaces and dimensions % subspaces:
+        raise ValueError(f'the number of subspaces ({subspaces}) must divide the dimensions ({dimensions})')
+    if n_lists is None:
+        n_lists = max(1, int(4 * np.sqrt(n)))
+    n_lists = min(n_lists, n)
+    if sample_size is None:
+        sample_size = 64 * max(n_lists, _PQ_CODES if subspaces else 0)
+    sample_size = max(sample_size, n_lists)
+
+    start_time = time.time()
+    random_state = np.random.RandomState(seed)
+    sample_positions = np.sort(random_state.choice(n, size=min(sample_size, n), replace=False))
+    sample = np.asarray(vectors[sample_positions], dtype=np.float32)
+    if metric == 'cosine':
+        sample = _normalize_rows(sample)
+
+    coarse = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3).fit(sample)
+    centroids = coarse.cluster_centers_.astype(np.float32)
+
+    assignments = np.concatenate([coarse.predict(block) for _, block in _iter_blocks(vectors, metric)])
+    order = np.argsort(assignments, kind='stable')
+    offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+
+    codes, codebooks = None, None
+    if subspaces:
+        residuals = (sample - centroids[coarse.predict(sample)]).reshape(len(sample), subspaces, -1)
+        codebooks = np.stack([
+            MiniBatchKMeans(
+                n_clusters=min(_PQ_CODES, len(sample)), random_state=seed, n_init=3,
+            ).fit(residuals[:, subspace]).cluster_centers_
+            for subspace in range(subspaces)
+        ]).astype(np.float32)
+        codes = np.empty((n, subspaces), dtype=np.uint8)
+        for start, block in _iter_blocks(vectors, metric):
+            block_assignments = assignments[start:start + len(block)]
+            block_residuals = (block - centroids[block_assignments]).reshape(len(block), subspaces, -1)
+            for subspace in range(subspaces):
+                codebook = codebooks[subspace]
+                distances = (
+                    np.einsum('ij,ij->i', codebook, codebook)[np.newaxis, :]
+                    - 2 * block_residuals[:, subspace] @ codebook.T
+                )
+                codes[start:start + len(block), subspace] = distances.argmin(axis=1)
+        codes = codes[order]
+
+    metadata = dict(
+        metric=metric,
+        n_lists=n_lists,
+        subspaces=subspaces,
+        nprobe=nprobe,
+        refine=refine,
+        sample_size=len(sample),
+        seed=seed,
+        rows=n,
+        dimensions=dimensions,
+        build_seconds=time.time() - start_time,
+    )
+    return IVFIndex(
+        curies,
+        vectors,
+        centroids=centroids,
+        order=order,
+        offsets=offsets,
+        codes=codes,
+        codebooks=codebooks,
+        metric=metric,
+        nprobe=nprobe,
+        metadata=metadata,
+    )
+
+
+def get_ivf_index_path(collection, metric: str = 'cosine', cache: Optional[CollectionCache] = None) -> str:
+    """Get the directory where the index for a collection is stored.
+
+    :param collection: A :class:`embeddingdb.sql.models.Collection`
+    :param metric: Either ``cosine`` or ``dot``
+    :param cache: The cache holding the collection. Defaults to the configured cache.
+    """
+    if cache is None:
+        cache = CollectionCache()
+    return cache.get_derived_path(collection, f'ivf-{metric}')
+
+
+def load_ivf_index(
+        collection,
+        metric: str = 'cosine',
+        cache: Optional[CollectionCache] = None,
+) -> Optional[IVFIndex]:
+    """Load the index for a collection, if one was built.
+
+    :param collection: A :class:`embeddingdb.sql.models.Collection`
+    :param metric: Either ``cosine`` or ``dot``
+    :param cache: The cache holding the collection. Defaults to the configured cache.
+    """
+    if cache is None:
+        cache = CollectionCache()
+    directory = get_ivf_index_path(collection, metric=metric, cache=cache)
+    try:
+        with open(os.path.join(directory, _METADATA)) as file:
+            metadata = json.load(file)
+    except FileNotFoundError:
+        return None
+
+    arrays: Dict[str, Optional[np.ndarray]] = {}
+    for name in _ARRAYS:
+        path = os.path.join(directory, f'{name}.npy')
+        arrays[name] = np.load(path, mmap_mode='r') if os.path.exists(path) else None
+
+    curies, vectors = _load_vectors(collection, cache)
+    return IVFIndex(curies, vectors, metric=metric, nprobe=metadata['nprobe'], metadata=metadata, **arrays)
+
+
+def _load_vectors(collection, cache: CollectionCache) -> Tuple[np.ndarray, np.ndarray]:
+    loaded = cache.load(collection)
+    # the entry can be evicted by another process at any time, then the database is read instead
+    return loaded if loaded is not None else collection.load(use_cache=False, encoded=True)
+
+
+def evaluate_ivf_index(
+        index: IVFIndex,
+        *,
+        k: int = 10,
+        nprobes: Sequence[int] = (1, 2, 4, 8, 16, 32),
+        n_queries: int = 1_000,
+        seed: int = 0,
+        refine: Optional[int] = None,
+):
+    """Compare the recall and latency of an index to exact search, using rows of the collection as queries.
+
+    :return: A list of dictionaries with the ``nprobe``, the mean recall at k, and the milliseconds per query,
+     starting with exact search (whose ``nprobe`` is None)
+    """
+    random_state = np.random.RandomState(seed)
+    positions = np.sort(random_state.choice(len(index), size=min(n_queries, len(index)), replace=False))
+    queries = np.asarray(index.vectors[positions])
+
+    exact = ExactIndex(index.curies, index.vectors, metric=index.metric)
+    start_time = time.time()
+    truth, _ = exact.search(queries, k)
+    rv = [dict(nprobe=None, recall=1.0, ms_per_query=1000 * (time.time() - start_time) / len(queries))]
+
+    for nprobe in nprobes:
+        start_time = time.time()
+        found, _ = index.search(queries, k, nprobe=nprobe, refine=refine)
+        elapsed = time.time() - start_time
+        recall = np.mean([
+            len(np.intersect1d(expected, actual)) / len(expected)
+            for expected, actual in zip(truth, found)
+        ])
+        rv.append(dict(nprobe=nprobe, recall=float(recall), ms_per_query=1000 * elapsed / len(queries)))
+    return rv
+
+
+@click.group()
+def main():
+    """Build and evaluate approximate nearest neighbor indexes."""
+
+
+metric_option = click.option('--metric', type=click.Choice(METRICS), default='cosine', show_default=True)
+
+
+@main.command()
+@click.argument('collection_id', type=int)
+@metric_option
+@click.option('--lists', type=int, help='Number of inverted lists. Defaults to 4 * sqrt(rows)')
+@click.option('--subspaces', type=int, default=0, show_default=True,
+              help='Number of product quantization subspaces. 0 scores candidates exactly')
+@click.option('--nprobe', type=int, default=8, show_default=True, help='Default number of lists visited')
+@click.option('--refine', type=int, default=0, show_default=True,
+              help='Default factor of product quantized candidates re-ranked exactly')
+@click.option('--seed', type=int, default=0, show_default=True)
+@config.get_connection_option()
+def build(collection_id: int, metric: str, lists: Optional[int], subspaces: int, nprobe: int, refine: int, seed: int,
+          connection: str):
+    """Build the index for a collection."""
+    session = get_session(connection)
+    collection = session.query(Collection).get(collection_id)
+    if collection is None:
+        raise click.ClickException(f'collection {collection_id} does not exist')
+    cache = CollectionCache()
+    curies, vectors = _load_vectors(collection, cache)
+    try:
+        index = build_ivf_index(
+            curies, vectors,
+            metric=metric, n_lists=lists, subspaces=subspaces, nprobe=nprobe, refine=refine, seed=seed,
+        )
+    except ValueError as e:
+        raise click.ClickException(f'collection {collection_id}: {e}')
+    path = get_ivf_index_path(collection, metric=metric, cache=cache)
+    index.save(path)
+    click.echo(f'Built index with {index.n_lists} lists in {index.metadata["build_seconds"]:.1f}s at {path}')
+
+
+@main.command()
+@click.argument('collection_id', type=int)
+@metric_option
+@click.option('-k', type=int, default=10, show_default=True)
+@click.option('--nprobe', 'nprobes', type=int, multiple=True, help='Can be given several times')
+@click.option('--queries', type=int, default=1_000, show_default=True)
+@click.option('--refine', type=int)
+@config.get_connection_option()
+def evaluate(collection_id: int, metric: str, k: int, nprobes: Sequence[int], queries: int, refine: Optional[int],
+             connection: str):
+    """Compare the recall and latency of a collection's index with exact search."""
+    session = get_session(connection)
+    collection = session.query(Collection).get(collection_id)
+    if collection is None:
+        raise click.ClickException(f'collection {collection_id} does not exist')
+    index = load_ivf_index(collection, metric=metric)
+    if index is None:
+        raise click.ClickException(f'collection {collection_id} has no {metric} index. Build one first.')
+
+    click.echo('\t'.join(('nprobe', f'recall@{k}', 'ms/query')))
+    for row in evaluate_ivf_index(index, k=k, nprobes=nprobes or (1, 2, 4, 8, 16, 32), n_queries=queries,
+                                  refine=refine):
+        click.echo(f'{row["nprobe"] or "exact"}\t{row["recall"]:.3f}\t{row["ms_per_query"]:.3f}')
@@ -0,0 +1,497 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for ``embeddingdb``.
+
+The suite builds synthetic collections of the given sizes in a database, by default a temporary SQLite
+database, and measures:
+
+- ``ingest``: the rows per second of each loader in :mod:`embeddingdb.sql.io`, from files written ahead of
+  time, and of :func:`embeddingdb.sql.bulk.bulk_insert_chunks` directly
+- ``lookup``: the latency of single and batch lookups through the web application's test client
+- ``load``: the throughput of loading a collection's matrix from the database and from the cache
+- ``regression``: the wall time and peak memory (as traced by :mod:`tracemalloc`) of
+  :func:`embeddingdb.sql.analysis.perform_regression`
+
+The results are written as JSON, so runs can be compared. The collections are deleted afterwards, so a
+throwaway PostgreSQL database can be used as well.
+
+The startup benchmark guards the time it takes to run a light command like ``embeddingdb ls``, which
+should never import the packages that only some subcommands need (see :class:`embeddingdb.cli.LazyGroup`).
+"""
+
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import click
+import numpy as np
+
+from .cache import CollectionCache
+from .constants import config
+from .parsers import Chunk
+from .synthetic import iter_synthetic_chunks
+from .version import get_version
+
+__all__ = [
+    'BENCHMARKS',
+    'LOADERS',
+    'HEAVY_MODULES',
+    'run_benchmarks',
+    'benchmark_ingest',
+    'benchmark_lookup',
+    'benchmark_load',
+    'benchmark_regression',
+    'benchmark_startup',
+    'main',
+]
+
+#: The benchmarks run by :func:`run_benchmarks`
+BENCHMARKS = ('ingest', 'lookup', 'load', 'regression')
+
+#: The loaders measured by :func:`benchmark_ingest`
+LOADERS = ('chunks', 'word2vec', 'word2vec-binary', 'keen', 'parquet')
+
+#: Packages that are slow to import and must not be imported when the command line interface starts
+HEAVY_MODULES = ('sklearn', 'scipy', 'pandas', 'gensim', 'joblib', 'flask', 'pyarrow')
+
+_IMPORTED_MODULES_SCRIPT = '''
+import json, sys
+from embeddingdb.cli import main
+main.get_command(None, {command!r})
+print(json.dumps(sorted({{name.split('.')[0] for name in sys.modules}})))
+'''
+
+
+def run_benchmarks(
+        connection: Optional[str] = None,
+        rows: Sequence[int] = (10_000,),
+        dimensions: Sequence[int] = (32,),
+        benchmarks: Sequence[str] = BENCHMARKS,
+        *,
+        loaders: Optional[Sequence[str]] = None,
+        lookups: int = 200,
+        lookup_batch_size: int = 1_000,
+        models: Sequence[str] = ('linear', 'least-squares'),
+        seed: int = 0,
+) -> Dict[str, Any]:
+    """Run the benchmarks for every combination of the given numbers of rows and dimensions.
+
+    :param connection: The SQLAlchemy connection string. Defaults to a temporary SQLite database.
+    :param rows: The numbers of rows of the synthetic collections
+    :param dimensions: The dimensions of the synthetic collections
+    :param benchmarks: The benchmarks to run, among :data:`BENCHMARKS`
+    :param loaders: The loaders to measure in the ingest benchmark, among :data:`LOADERS`. Defaults to all
+     of them, except for ``parquet`` if :mod:`pyarrow` isn't installed.
+    :param lookups: The number of single lookups in the lookup benchmark
+    :param lookup_batch_size: The number of CURIEs per batch lookup
+    :param models: The shortcut names of the regressions to measure
+    :param seed: The seed for generating the collections
+    :return: A dictionary describing the run, with one entry per measurement under ``results``
+    """
+    from .sql.bulk import bulk_insert_chunks
+    from .sql.manage import delete_collection
+    from .sql.models import Collection, create_all, get_session
+
+    unknown = set(benchmarks).difference(BENCHMARKS)
+    if unknown:
+        raise ValueError(f'invalid benchmarks: {sorted(unknown)}. Should be among {BENCHMARKS}')
+    if loaders is None:
+        loaders = [
+            loader
+            for loader in LOADERS
+            if loader != 'parquet' or importlib.util.find_spec('pyarrow') is not None
+        ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        if connection is None:
+            connection = f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+        create_all(connection)
+        session = get_session(connection)
+
+        results = []
+        for n_rows in rows:
+            for n_dimensions in dimensions:
+                size = dict(rows=n_rows, dimensions=n_dimensions)
+                collection_ids = []
+                try:
+                    if 'ingest' in benchmarks:
+                        for result in benchmark_ingest(
+                                session, n_rows, n_dimensions, loaders=loaders, directory=directory, seed=seed,
+                        ):
+                            results.append({'benchmark': 'ingest', **size, **result})
+
+                    collection = Collection(dimensions=n_dimensions, package_name='benchmark',
+                                            package_version=get_version())
+                    bulk_insert_chunks(session, collection, iter_synthetic_chunks(
+                        n_rows, n_dimensions, prefix='benchmark', seed=seed,
+                    ))
+                    collection_ids.append(collection.id)
+
+                    if 'lookup' in benchmarks:
+                        for result in benchmark_lookup(
+                                connection, collection, lookups=lookups, batch_size=lookup_batch_size, seed=seed,
+                        ):
+                            results.append({'benchmark': 'lookup', **size, **result})
+
+                    if 'load' in benchmarks:
+                        results.append({'benchmark': 'load', **size, **benchmark_load(collection, directory)})
+
+                    if 'regression' in benchmarks:
+                        target = Collection(dimensions=n_dimensions, package_name='benchmark',
+                                            package_version=get_version())
+                        bulk_insert_chunks(session, target, _iter_linear_targets(
+                            iter_synthetic_chunks(n_rows, n_dimensions, prefix='benchmark', seed=seed), seed=seed,
+                        ))
+                        collection_ids.append(target.id)
+                        for result in benchmark_regression(collection, target, models=models):
+                            results.append({'benchmark': 'regression', **size, **result})
+                finally:
+                    for collection_id in collection_ids:
+                        delete_collection(session, collection_id)
+
+    return {
+        'started': datetime.datetime.now().isoformat(),
+        'version': get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'dialect': connection.split(':', 1)[0],
+        'batch_size': config.batch_size,
+        'vector_dtype': config.vector_dtype,
+        'results': results,
+    }
+
+
+def _iter_linear_targets(chunks: Iterable[Chunk], seed: int) -> Iterable[Chunk]:
+    """Map chunks through a fixed random linear transformation with noise, so regressions have a signal."""
+    random_state = np.random.default_rng(seed + 1)
+    weights = None
+    for curies, vectors in chunks:
+        if weights is None:
+            weights = random_state.standard_normal((vectors.shape[1], vectors.shape[1]), dtype=np.float32)
+        noise = random_state.standard_normal(vectors.shape, dtype=np.float32)
+        yield curies, vectors @ weights + 0.1 * noise
+
+
+def benchmark_ingest(
+        session,
+        rows: int,
+        dimensions: int,
+        *,
+        loaders: Sequence[str] = LOADERS,
+        directory: str,
+        seed: int = 0,
+) -> List[Dict[str, Any]]:
+    """Measure the rows per second of each loader.
+
+    The input files are written to the directory before each loader is timed. Each loader gets its own
+    CURIEs, so each of them inserts new entities. The uploaded collections are deleted afterwards.
+    """
+    from .sql.bulk import bulk_insert_chunks
+    from .sql.io import upload_arrow_file, upload_pykeen_from_directory, upload_word2vec_embedding_file
+    from .sql.manage import delete_collection
+    from .sql.models import Collection
+
+    unknown = set(loaders).difference(LOADERS)
+    if unknown:
+        raise ValueError(f'invalid loaders: {sorted(unknown)}. Should be among {LOADERS}')
+
+    results = []
+    for loader in loaders:
+        chunks = iter_synthetic_chunks(rows, dimensions, prefix=loader, seed=seed)
+        metadata = dict(package_name='benchmark', package_version=get_version())
+        if loader == 'chunks':
+            chunks = list(chunks)
+
+            def upload():
+                collection = Collection(dimensions=dimensions, **metadata)
+                bulk_insert_chunks(session, collection, chunks)
+                return collection
+        elif loader in {'word2vec', 'word2vec-binary'}:
+            path = os.path.join(directory, f'{loader}.{"bin" if loader == "word2vec-binary" else "txt"}')
+            _write_word2vec(path, chunks, rows, dimensions, binary=(loader == 'word2vec-binary'))
+
+            def upload():
+                return upload_word2vec_embedding_file(path, session=session, **metadata)
+        elif loader == 'keen':
+            path = os.path.join(directory, loader)
+            _write_pykeen(path, chunks, dimensions)
+
+            def upload():
+                return upload_pykeen_from_directory(path, session=session)
+        else:
+            path = os.path.join(directory, f'{loader}.parquet')
+            _write_parquet(path, chunks, dimensions)
+
+            def upload():
+                return upload_arrow_file(path, session=session, **metadata)
+
+        start = time.perf_counter()
+        collection = upload()
+        seconds = time.perf_counter() - start
+        delete_collection(session, collection.id)
+        results.append({
+            'loader': loader,
+            'seconds': seconds,
+            'rows_per_second': rows / seconds,
+        })
+    return results
+
+
+def _write_word2vec(path: str, chunks: Iterable[Chunk], rows: int, dimensions: int, binary: bool) -> None:
+    from .sql.export import serialize_word2vec
+
+    with open(path, 'wb') as file:
+        if not binary:
+            file.writelines(serialize_word2vec(chunks, rows, dimensions))
+            return
+        file.write(f'{rows} {dimensions}\n'.encode('utf-8'))
+        for curies, vectors in chunks:
+            for curie, vector in zip(curies, vectors.astype('<f4')):
+                file.write(curie.encode('utf-8') + b' ' + vector.tobytes() + b'\n')
+
+
+def _write_pykeen(directory: str, chunks: Iterable[Chunk], dimensions: int) -> None:
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'configuration.json'), 'w') as file:
+        json.dump({'embedding_dim': dimensions, 'pykeen-version': get_version()}, file)
+    with open(os.path.join(directory, 'entities_to_embeddings.json'), 'w') as file:
+        separator = '{'
+        for curies, vectors in chunks:
+            for curie, vector in zip(curies, vectors.tolist()):
+                file.write(f'{separator}{json.dumps(curie)}: {json.dumps(vector)}')
+                separator = ', '
+        file.write('{}' if separator == '{' else '}')
+
+
+def _write_parquet(path: str, chunks: Iterable[Chunk], dimensions: int) -> None:
+    from .sql.export import serialize_arrow
+
+    metadata = dict(dimensions=dimensions, package_name='benchmark', package_version=get_version(), extras={})
+    with open(path, 'wb') as file:
+        file.writelines(serialize_arrow(chunks, metadata, parquet=True))
+
+
+def _summarize_latencies(latencies: Sequence[float]) -> Dict[str, float]:
+    milliseconds = 1_000 * np.asarray(latencies)
+    return {
+        'requests': len(latencies),
+        'mean_ms': float(milliseconds.mean()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+    }
+
+
+def benchmark_lookup(
+        connection: str,
+        collection,
+        *,
+        lookups: int = 200,
+        batch_size: int = 1_000,
+        seed: int = 0,
+) -> List[Dict[str, Any]]:
+    """Measure the latency of single and batch lookups through the web application's test client.
+
+    :param connection: The SQLAlchemy connection string of the database holding the collection
+    :param collection: A :class:`embeddingdb.sql.models.Collection` of synthetic embeddings
+    :param lookups: The number of single lookups. A tenth as many batch lookups are made.
+    :param batch_size: The number of CURIEs per batch lookup
+    """
+    from .web.app import get_app
+
+    client = get_app(connection).test_client()
+    n = collection.count_embeddings()
+    random_state = np.random.default_rng(seed)
+    prefix = f'/collection/{collection.id}'
+
+    single = []
+    for row in random_state.integers(n, size=lookups):
+        start = time.perf_counter()
+        response = client.get(f'{prefix}/benchmark:{row}')
+        single.append(time.perf_counter() - start)
+        _check_response(response)
+
+    batch = []
+    for _ in range(max(1, lookups // 10)):
+        curies = [f'benchmark:{row}' for row in random_state.integers(n, size=batch_size)]
+        start = time.perf_counter()
+        response = client.post(f'{prefix}/embeddings?format=base64', json={'curies': curies})
+        batch.append(time.perf_counter() - start)
+        _check_response(response)
+
+    return [
+        {'lookup': 'single', **_summarize_latencies(single)},
+        {'lookup': 'batch', 'batch_size': batch_size, **_summarize_latencies(batch)},
+    ]
+
+
+def _check_response(response) -> None:
+    if response.status_code != 200:
+        raise RuntimeError(f'lookup failed with status {response.status_code}: {response.get_data(as_text=True)}')
+
+
+def benchmark_load(collection, directory: str) -> Dict[str, Any]:
+    """Measure the throughput of loading a collection's matrix from the database and from the cache.
+
+    :param collection: A :class:`embeddingdb.sql.models.Collection`
+    :param directory: The directory for a temporary cache
+    """
+    start = time.perf_counter()
+    _, vectors = collection.load(use_cache=False)
+    database_seconds = time.perf_counter() - start
+    megabytes = vectors.nbytes / 1024 ** 2
+    del vectors
+
+    cache = CollectionCache(os.path.join(directory, 'cache'), max_size=sys.maxsize)
+    start = time.perf_counter()
+    cache.put(collection)
+    cache_put_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, vectors = cache.get(collection)
+    # reading the memory-mapped matrix is what costs something
+    vectors.sum()
+    cache_load_seconds = time.perf_counter() - start
+    del vectors
+    cache.invalidate(collection.id)
+
+    rows = collection.count_embeddings()
+    return {
+        'megabytes': megabytes,
+        'database_seconds': database_seconds,
+        'database_rows_per_second': rows / database_seconds,
+        'database_megabytes_per_second': megabytes / database_seconds,
+        'cache_put_seconds': cache_put_seconds,
+        'cache_load_seconds': cache_load_seconds,
+        'cache_megabytes_per_second': megabytes / cache_load_seconds,
+    }
+
+
+def benchmark_regression(collection_1, collection_2, models: Sequence[str] = ('linear',)) -> List[Dict[str, Any]]:
+    """Measure the wall time and peak traced memory of regressions between two collections."""
+    from .sql.analysis import perform_regression
+    from .sql.regressions import REGRESSIONS  # noqa: F401 so importing sklearn isn't timed
+
+    results = []
+    for model in models:
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            _, r2, intersection, _ = perform_regression(collection_1, collection_2, regression_cls=model)
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        results.append({
+            'model': model,
+            'seconds': seconds,
+            'peak_megabytes': peak / 1024 ** 2,
+            'r2': r2,
+            'intersection': intersection,
+        })
+    return results
+
+
+def benchmark_startup(command: Sequence[str] = ('ls',), repeats: int = 5) -> Dict[str, Any]:
+    """Measure how long it takes to start the command line interface in a fresh interpreter.
+
+    The given command is run with ``--help``, so no database is needed.
+
+    :param command: The subcommand to start
+    :param repeats: The number of times the command is run
+    :return: A dictionary with the minimum and median wall time in seconds and the heavy modules
+     that were imported by resolving the command
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, '-m', 'embeddingdb', *command, '--help'],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        times.append(time.perf_counter() - start)
+
+    output = subprocess.run(
+        [sys.executable, '-c', _IMPORTED_MODULES_SCRIPT.format(command=command[0])],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True,
+    ).stdout
+    imported = set(json.loads(output))
+    return {
+        'command': list(command),
+        'repeats': repeats,
+        'min_seconds': min(times),
+        'median_seconds': statistics.median(times),
+        'heavy_modules': [module for module in HEAVY_MODULES if module in imported],
+    }
+
+
+@click.group()
+def main():
+    """Run benchmarks."""
+
+
+@main.command()
+@click.option('-n', '--rows', type=int, multiple=True,
+              help='Rows per collection. Can be given several times. [default: 10000]')
+@click.option('-d', '--dimensions', type=int, multiple=True,
+              help='Dimensions. Can be given several times. [default: 32]')
+@click.option('-b', '--benchmark', 'benchmarks', type=click.Choice(BENCHMARKS), multiple=True,
+              help='The benchmarks to run. Can be given several times. [default: all]')
+@click.option('-l', '--loader', 'loaders', type=click.Choice(LOADERS), multiple=True,
+              help='The loaders to measure. Can be given several times. [default: all available]')
+@click.option('--lookups', type=int, default=200, show_default=True, help='The number of single lookups')
+@click.option('-m', '--model', 'models', multiple=True,
+              help='The regressions to measure. Can be given several times. [default: linear, least-squares]')
+@click.option('--seed', type=int, default=0, show_default=True)
+@click.option('-o', '--output', type=click.File('w'), default='-', help='The JSON output file')
+@click.option('-c', '--connection', help='The SQLAlchemy connection string. Defaults to a temporary SQLite database.')
+def run(
+        rows: Sequence[int],
+        dimensions: Sequence[int],
+        benchmarks: Sequence[str],
+        loaders: Sequence[str],
+        lookups: int,
+        models: Sequence[str],
+        seed: int,
+        output,
+        connection: Optional[str],
+):
+    """Run the benchmark suite on synthetic collections and write the results as JSON."""
+    result = run_benchmarks(
+        connection=connection,
+        rows=rows or (10_000,),
+        dimensions=dimensions or (32,),
+        benchmarks=benchmarks or BENCHMARKS,
+        loaders=loaders or None,
+        lookups=lookups,
+        models=models or ('linear', 'least-squares'),
+        seed=seed,
+    )
+    json.dump(result, output, indent=2)
+    output.write('\n')
+
+
+@main.command()
+@click.argument('command', nargs=-1)
+@click.option('-r', '--repeats', type=int, default=5, show_default=True)
+@click.option('--max-seconds', type=float, help='Fail if the median startup time is longer than this')
+def startup(command: Sequence[str], repeats: int, max_seconds: float):
+    """Measure the startup time of a command (ls, by default).
+
+    Fails if the command imports any heavy packages, or takes longer than the given time.
+    """
+    result = benchmark_startup(command or ('ls',), repeats=repeats)
+    click.echo(json.dumps(result, indent=2))
+    if result['heavy_modules']:
+        raise click.ClickException(f'imported heavy modules: {", ".join(result["heavy_modules"])}')
+    if max_seconds is not None and result['median_seconds'] > max_seconds:
+        raise click.ClickException(f'took {result["median_seconds"]:.3f}s, more than {max_seconds:.3f}s')
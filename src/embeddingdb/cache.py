@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+"""A local, memory-mapped cache of collections.
+
+Each cached collection is a directory holding ``vectors.npy``, a float32 matrix, and ``curies.npy``, the sorted
+CURIEs labeling its rows, encoded as fixed width UTF-8 bytes (see :func:`encode_curies`), which take a
+quarter of the space of :mod:`numpy`'s unicode strings for ASCII CURIEs. Both are memory-mapped when read,
+so loading a cached collection costs almost nothing and its pages are shared between processes. Directories
+are named by the collection's identifier and content version, so a collection that changes is never read
+from a stale entry.
+
+The total size of the cache is bounded. When it is exceeded, the least recently used entries are evicted.
+Files derived from collections that are expensive to rebuild, like approximate nearest neighbor indexes, are
+kept in the ``derived`` subdirectory, which isn't evicted, and are only removed once their collection changes.
+
+Serialized API responses are cached separately by :class:`ResponseCache`, keyed by ETags derived from the
+versions of the collections they describe.
+"""
+
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .constants import config
+
+__all__ = [
+    'CacheEntry',
+    'CollectionCache',
+    'get_cache',
+    'encode_curies',
+    'decode_curies',
+    'ResponseCache',
+    'get_response_cache',
+]
+
+_VECTORS = 'vectors.npy'
+_CURIES = 'curies.npy'
+
+#: The subdirectory holding the files derived from collections
+_DERIVED = 'derived'
+
+#: The number of rows copied at a time when reordering a cached matrix
+_COPY_SIZE = 100_000
+
+
+def encode_curies(curies: Iterable[str]) -> np.ndarray:
+    """Encode CURIEs as an array of fixed width UTF-8 bytes, unless they already are.
+
+    UTF-8 bytes sort in the same order as the code points they encode, so sorted arrays of encoded CURIEs
+    can be searched with :func:`numpy.searchsorted` just like unicode strings.
+    """
+    if isinstance(curies, np.ndarray) and curies.dtype.kind == 'S':
+        return curies
+    if not isinstance(curies, np.ndarray):
+        curies = list(curies)
+    return np.char.encode(np.asarray(curies, dtype=str), 'utf-8')
+
+
+def decode_curies(curies: np.ndarray) -> np.ndarray:
+    """Decode an array of CURIEs encoded with :func:`encode_curies` into unicode strings."""
+    if curies.dtype.kind != 'S':
+        return np.asarray(curies, dtype=str)
+    return np.char.decode(curies, 'utf-8')
+
+
+class CacheEntry(NamedTuple):
+    """Describes a cached collection."""
+
+    collection_id: int
+    version: str
+    path: str
+    size: int
+    last_used: float
+
+
+class CollectionCache:
+    """A directory of memory-mapped collections."""
+
+    def __init__(self, directory: Optional[str] = None, max_size: Optional[int] = None) -> None:
+        """Initialize the cache.
+
+        :param directory: The directory holding the cache. Defaults to :data:`Config.cache_directory`.
+        :param max_size: The maximum total size of the cache in bytes. Defaults to :data:`Config.cache_size`.
+        """
+        self.directory = directory if directory is not None else config.cache_directory
+        self.max_size = max_size if max_size is not None else config.cache_size
+
+    def get_path(self, collection) -> str:
+        """Get the path to the directory of a collection's entry, which might not exist yet.
+
+        :param collection: A :class:`embeddingdb.sql.models.Collection`
+        """
+        return os.path.join(self.directory, f'{collection.id}-{collection.version}')
+
+    def get_derived_path(self, collection, name: str) -> str:
+        """Get the path to a file or directory derived from a collection, which might not exist yet.
+
+        Derived files, like approximate nearest neighbor indexes, are kept when the collection's entry is
+        evicted and removed when the collection is invalidated or changes.
+
+        :param collection: A :class:`embeddingdb.sql.models.Collection`
+        :param name: The name of the derived file
+        """
+        return os.path.join(self.directory, _DERIVED, f'{collection.id}-{collection.version}-{name}')
+
+    def _remove_derived(self, is_stale: Callable[[int, str], bool]) -> None:
+        """Remove the derived files for which a function of their collection's identifier and version is true."""
+        directory = os.path.join(self.directory, _DERIVED)
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            collection_id, _, rest = name.partition('-')
+            version = rest.partition('-')[0]
+            if collection_id.isdigit() and '.tmp-' not in name and is_stale(int(collection_id), version):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+    def get(self, collection) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Get the memory-mapped CURIEs, encoded as bytes, and vectors for a collection, if cached.
+
+        :param collection: A :class:`embeddingdb.sql.models.Collection`
+        """
+        path = self.get_path(collection)
+        try:
+            curies = np.load(os.path.join(path, _CURIES), mmap_mode='r')
+            vectors = np.load(os.path.join(path, _VECTORS), mmap_mode='r')
+            # the entry can be evicted by another process at any time
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        # entries written by older versions stored the CURIEs as unicode strings
+        return encode_curies(curies), vectors
+
+    def load(self, collection) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Get the memory-mapped CURIEs, encoded as bytes, and vectors for a collection, caching it first if needed.
+
+        :param collection: A :class:`embeddingdb.sql.models.Collection`
+        :return: The CURIEs and vectors, or None if another process evicted the entry before it could be read
+        """
+        rv = self.get(collection)
+        if rv is not None:
+            return rv
+        self.put(collection)
+        return self.get(collection)
+
+    def put(self, collection) -> str:
+        """Download a collection into the cache and return the path to its entry.
+
+        Rows are streamed straight into a memory-mapped file, then the directory is renamed into place so
+        concurrent readers never see a partial entry. Older versions of the collection are removed.
+
+        :param collection: A :class:`embeddingdb.sql.models.Collection`
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.get_path(collection)
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        os.makedirs(tmp_path)
+        try:
+            self._write(collection, tmp_path)
+            try:
+                os.replace(tmp_path, path)
+            except OSError:  # another process cached it first
+                shutil.rmtree(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        self.invalidate(collection.id, keep=collection.version)
+        self.prune(keep=path)
+        return path
+
+    @staticmethod
+    def _write(collection, path: str) -> None:
+        n = collection.count_embeddings()
+        vectors_path = os.path.join(path, _VECTORS)
+        vectors = open_memmap(vectors_path, mode='w+', dtype=np.float32, shape=(n, collection.dimensions))
+        # each chunk's CURIEs are encoded right away, so they are never all held as Python strings
+        blocks: List[np.ndarray] = [np.empty(0, dtype='S1')]
+        total = 0
+        for chunk_curies, chunk_vectors in collection.iter_chunks():
+            vectors[total:total + len(chunk_curies)] = chunk_vectors
+            blocks.append(encode_curies(chunk_curies))
+            total += len(chunk_curies)
+        if total != n:
+            raise ValueError(f'collection {collection.id} changed while it was being cached')
+
+        curies = np.concatenate(blocks)
+        del blocks
+        # the database's collation might not sort by code point (or UTF-8 byte), as numpy.searchsorted needs
+        order = np.argsort(curies, kind='stable')
+        if np.any(order != np.arange(n)):
+            curies = curies[order]
+            sorted_path = os.path.join(path, f'sorted-{_VECTORS}')
+            sorted_vectors = open_memmap(sorted_path, mode='w+', dtype=np.float32, shape=vectors.shape)
+            for start in range(0, n, _COPY_SIZE):
+                sorted_vectors[start:start + _COPY_SIZE] = vectors[order[start:start + _COPY_SIZE]]
+            sorted_vectors.flush()
+            del vectors, sorted_vectors
+            os.replace(sorted_path, vectors_path)
+        else:
+            vectors.flush()
+            del vectors
+        np.save(os.path.join(path, _CURIES), curies)
+
+    def warm(self, collections: Iterable) -> List[str]:
+        """Make sure all of the given collections are cached.
+
+        :param collections: An iterable of :class:`embeddingdb.sql.models.Collection`
+        :return: The paths to the collections' entries
+        """
+        return [
+            self.get_path(collection)
+            if self.get(collection) is not None else
+            self.put(collection)
+            for collection in collections
+        ]
+
+    def entries(self) -> List[CacheEntry]:
+        """List the entries in the cache, from least to most recently used."""
+        if not os.path.isdir(self.directory):
+            return []
+        rv = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            collection_id, _, version = name.partition('-')
+            if not collection_id.isdigit() or '.tmp-' in version or not os.path.isdir(path):
+                continue
+            size = sum(
+                os.path.getsize(os.path.join(directory, file_name))
+                for directory, _, file_names in os.walk(path)
+                for file_name in file_names
+            )
+            rv.append(CacheEntry(int(collection_id), version, path, size, os.path.getmtime(path)))
+        return sorted(rv, key=lambda entry: entry.last_used)
+
+    def invalidate(self, collection_id: int, keep: Optional[str] = None) -> int:
+        """Remove the cached versions of a collection and the files derived from them, e.g., after it is replaced.
+
+        :param collection_id: The database identifier of the collection
+        :param keep: A version that should not be removed
+        :return: The number of entries removed
+        """
+        self._remove_derived(lambda derived_id, version: derived_id == collection_id and version != keep)
+        entries = [
+            entry
+            for entry in self.entries()
+            if entry.collection_id == collection_id and entry.version != keep
+        ]
+        for entry in entries:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        return len(entries)
+
+    def prune(
+            self,
+            versions: Optional[Mapping[int, str]] = None,
+            keep: Optional[str] = None,
+    ) -> List[CacheEntry]:
+        """Evict the least recently used entries until the cache fits in its size budget.
+
+        :param versions: If given, a mapping from the identifiers of all collections in the database to their
+         current versions. Entries and derived files for collections that were deleted or changed are removed
+         first.
+        :param keep: The path of an entry that is never evicted, even if it alone exceeds the budget
+        :return: The entries that were removed
+        """
+        entries = self.entries()
+        removed = []
+        if versions is not None:
+            self._remove_derived(lambda collection_id, version: versions.get(collection_id) != version)
+            for entry in entries:
+                if versions.get(entry.collection_id) != entry.version:
+                    removed.append(entry)
+            entries = [entry for entry in entries if entry not in removed]
+
+        size = sum(entry.size for entry in entries)
+        for entry in entries:
+            if size <= self.max_size:
+                break
+            if entry.path == keep:
+                continue
+            removed.append(entry)
+            size -= entry.size
+
+        for entry in removed:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        return removed
+
+    @staticmethod
+    def select(curies: np.ndarray, vectors: np.ndarray, subset: Iterable[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the rows for the given CURIEs from a cached collection with :func:`numpy.searchsorted`.
+
+        CURIEs that are not in the collection are skipped.
+
+        :param curies: The sorted CURIEs of the collection, encoded as bytes
+        :param vectors: The vectors of the collection
+        :param subset: The CURIEs to get
+        :return: The CURIEs that were found, as unicode strings, and their vectors
+        """
+        subset = np.unique(encode_curies(subset))
+        positions = np.searchsorted(curies, subset)
+        found = positions < len(curies)
+        found[found] = curies[positions[found]] == subset[found]
+        positions = positions[found]
+        return decode_curies(curies[positions]), vectors[positions]
+
+
+def get_cache() -> Optional[CollectionCache]:
+    """Get the cache configured with :data:`Config.cache_directory` or None if caching is disabled."""
+    if not config.cache_size:
+        return None
+    return CollectionCache()
+
+
+class ResponseCache:
+    """A bounded, least recently used cache of serialized responses, optionally backed by a directory.
+
+    Entries are keyed by ETags, which change whenever the collections a response describes change, so a
+    stale entry is never returned. Entries are also grouped by the collection they describe, or by None if
+    they describe all collections, so they can be removed as soon as a collection is replaced or deleted.
+
+    The directory is shared by all processes using it, e.g., the workers of a web server. It holds one
+    subdirectory per collection (and ``all``), with one file per entry.
+    """
+
+    def __init__(
+            self,
+            max_size: Optional[int] = None,
+            directory: Optional[str] = None,
+            max_directory_size: Optional[int] = None,
+    ) -> None:
+        """Initialize the cache.
+
+        :param max_size: The maximum total size of the entries in memory in bytes. Defaults to
+         :data:`Config.response_cache_size`.
+        :param directory: The directory holding the shared entries. Defaults to
+         :data:`Config.response_cache_directory`. If empty, entries are only kept in memory.
+        :param max_directory_size: The maximum total size of the entries in the directory in bytes. Defaults
+         to :data:`Config.response_cache_directory_size`.
+        """
+        self.max_size = max_size if max_size is not None else config.response_cache_size
+        self.directory = directory if directory is not None else config.response_cache_directory
+        self.max_directory_size = (
+            max_directory_size if max_directory_size is not None else config.response_cache_directory_size
+        )
+        self._entries: 'OrderedDict[str, Tuple[Optional[int], bytes]]' = OrderedDict()
+        self._keys: Dict[Optional[int], Set[str]] = {}
+        self._size = 0
+        # the number of bytes written to the directory since it was last pruned
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str, collection_id: Optional[int] = None) -> Optional[bytes]:
+        """Get a cached response, if there is one.
+
+        :param key: The response's ETag
+        :param collection_id: The identifier of the collection the response describes or None for all
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[1]
+        if not self.directory:
+            return None
+        path = self._get_path(key, collection_id)
+        try:
+            with open(path, 'rb') as file:
+                body = file.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # invalidated or pruned by another process since it was read
+            pass
+        self._remember(key, collection_id, body)
+        return body
+
+    def put(self, key: str, body: bytes, collection_id: Optional[int] = None) -> None:
+        """Cache a response.
+
+        :param key: The response's ETag
+        :param body: The serialized response
+        :param collection_id: The identifier of the collection the response describes or None for all
+        """
+        self._remember(key, collection_id, body)
+        if not self.directory:
+            return
+        path = self._get_path(key, collection_id)
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex}'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as file:
+                file.write(body)
+            os.replace(tmp_path, path)
+        except FileNotFoundError:  # the collection's directory was invalidated by another process
+            return
+        with self._lock:
+            self._written += len(body)
+            prune = self._written > self.max_directory_size // 10
+            if prune:
+                self._written = 0
+        if prune:
+            self.prune()
+
+    def _remember(self, key: str, collection_id: Optional[int], body: bytes) -> None:
+        if len(body) > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = collection_id, body
+            self._keys.setdefault(collection_id, set()).add(key)
+            self._size += len(body)
+            while self._size > self.max_size:
+                self._forget(next(iter(self._entries)))
+
+    def _forget(self, key: str) -> None:
+        collection_id, body = self._entries.pop(key)
+        self._keys[collection_id].discard(key)
+        self._size -= len(body)
+
+    def _get_path(self, key: str, collection_id: Optional[int]) -> str:
+        return os.path.join(self.directory, 'all' if collection_id is None else str(collection_id), key)
+
+    def invalidate(self, collection_id: int) -> None:
+        """Remove the cached responses describing a collection, e.g., after it is replaced or deleted.
+
+        Responses describing all collections are removed too.
+
+        :param collection_id: The database identifier of the collection
+        """
+        with self._lock:
+            for group in (collection_id, None):
+                for key in list(self._keys.get(group, ())):
+                    self._forget(key)
+        if self.directory:
+            for name in (str(collection_id), 'all'):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def prune(self) -> int:
+        """Evict the least recently used entries from the directory until it fits in its size budget.
+
+        :return: The number of entries removed
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        entries = []
+        for directory, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        removed = 0
+        for _, entry_size, path in entries:
+            if size <= self.max_directory_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+        return removed
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Get the response cache shared by this process or None if caching responses is disabled."""
+    global _response_cache
+    if not config.response_cache_size and not config.response_cache_directory:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
@@ -15,15 +15,63 @@ problems--the code will get executed twice:
 Also see https://click.pocoo.org/latest/setuptools/
 """
 
+import importlib
+import importlib.util
 import json
-from typing import Optional
+from typing import List, Mapping, Optional, Tuple
 
 import click
 
 from embeddingdb.constants import config
-from embeddingdb.sql.analysis import main as analyze
-from embeddingdb.sql.io import main as upload
-from embeddingdb.sql.models import Collection, get_session
+
+
+class LazyGroup(click.Group):
+    """A group that imports the module of a subcommand only when it's invoked.
+
+    Some subcommands depend on packages that are slow to import, like :mod:`sklearn` and :mod:`gensim`,
+    which would otherwise be imported by every invocation, even ``embeddingdb ls``. The help of the group
+    lists them by a given short help instead of importing them. The subcommands defined here import
+    :mod:`sqlalchemy` and :mod:`numpy` in their bodies for the same reason.
+    """
+
+    def __init__(self, *args, lazy_commands: Optional[Mapping[str, Tuple[str, str]]] = None, **kwargs) -> None:
+        """Initialize the group.
+
+        :param lazy_commands: A mapping from the names of subcommands to pairs of their import paths, in the
+         form ``module:attribute``, and their short help
+        """
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = dict(lazy_commands or {})
+
+    def list_commands(self, ctx: click.Context) -> List[str]:  # noqa: D102
+        return sorted({*super().list_commands(ctx), *self.lazy_commands})
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:  # noqa: D102
+        if name not in self.commands and name in self.lazy_commands:
+            module_name, attribute = self.lazy_commands[name][0].split(':')
+            self.add_command(getattr(importlib.import_module(module_name), attribute), name)
+        return super().get_command(ctx, name)
+
+    def format_commands(self, ctx: click.Context, formatter: click.HelpFormatter) -> None:  # noqa: D102
+        names = self.list_commands(ctx)
+        limit = formatter.width - 6 - max(map(len, names))
+        rows = []
+        for name in names:
+            if name not in self.commands:
+                rows.append((name, self.lazy_commands[name][1]))
+            elif not self.commands[name].hidden:
+                rows.append((name, self.commands[name].get_short_help_str(limit)))
+        with formatter.section('Commands'):
+            formatter.write_dl(rows)
+
+
+@click.command()
+@config.get_connection_option()
+def init(connection: str):
+    """Create the tables in the database."""
+    from embeddingdb.sql.models import create_all
+    create_all(connection)
+    click.echo(f'Created the tables at {connection}')
 
 
 @click.command()
@@ -31,6 +79,7 @@ from embeddingdb.sql.models import Collection, get_session
 @config.get_connection_option()
 def ls(limit: Optional[int], connection: str):
     """List the collections in the database."""
+    from embeddingdb.sql.models import Collection, get_session
     session = get_session(connection)
     collections = session.query(Collection)
     if limit is not None:
@@ -52,24 +101,103 @@ def ls(limit: Optional[int], connection: str):
         )))
 
 
-commands = {
-    'ls': ls,
-    'analyze': analyze,
-    'upload': upload,
-}
+@click.command()
+@click.argument('collection_ids', nargs=-1, type=int, required=True)
+@click.confirmation_option(prompt='Are you sure you want to delete these collections?')
+@config.get_connection_option()
+def delete(collection_ids, connection: str):
+    """Delete collections and their embeddings."""
+    from embeddingdb.sql.manage import delete_collection
+    from embeddingdb.sql.models import get_session
+    session = get_session(connection)
+    for collection_id in collection_ids:
+        try:
+            total = delete_collection(session, collection_id)
+        except KeyError:
+            click.secho(f'Collection {collection_id} does not exist', fg='red')
+        else:
+            click.echo(f'Deleted collection {collection_id} with {total} embeddings')
+
 
-try:
+@click.command()
+@click.argument('collection_ids', nargs=-1, type=int)
+@click.option('--min-overlap', type=int, default=0, show_default=True,
+              help='Only show pairs sharing at least this many entities')
+@config.get_connection_option()
+def overlap(collection_ids, min_overlap: int, connection: str):
+    """List the number of entities shared by each pair of collections.
+
+    Only pairs involving the given collections are listed, if any are given.
+    """
+    from embeddingdb.sql.analysis import calculate_overlap
+    from embeddingdb.sql.models import get_session
+    session = get_session(connection)
+    df = calculate_overlap(session, collection_ids=collection_ids or None)
+    df = df[df['overlap'] >= min_overlap]
+    click.echo(df.to_csv(sep='\t', index=False, float_format='%.4f'), nl=False)
+
+
+@click.group()
+def cache():
+    """Manage the local cache of collections."""
+
+
+@cache.command()
+@click.argument('collection_ids', nargs=-1, type=int)
+@config.get_connection_option()
+def warm(collection_ids, connection: str):
+    """Download collections to the cache (all of them, if none are given)."""
+    from embeddingdb.cache import CollectionCache
+    from embeddingdb.sql.models import Collection, get_session
+    session = get_session(connection)
+    collections = session.query(Collection)
+    if collection_ids:
+        collections = collections.filter(Collection.id.in_(collection_ids))
+    collections = collections.all()
+    for collection, path in zip(collections, CollectionCache().warm(collections)):
+        click.echo(f'Cached collection {collection.id} at {path}')
+
+
+@cache.command()
+@config.get_connection_option()
+def prune(connection: str):
+    """Remove stale collections from the cache and evict old ones to fit its size budget."""
+    from embeddingdb.cache import CollectionCache
+    from embeddingdb.sql.models import Collection, get_session
+    session = get_session(connection)
+    versions = dict(session.query(Collection.id, Collection.version))
+    for entry in CollectionCache().prune(versions=versions):
+        click.echo(f'Removed collection {entry.collection_id} ({entry.size} bytes) from the cache')
+
+
+@click.command()
+def web():
+    """Run the web application with Flask's development server. Use ``serve`` in production."""
     from embeddingdb.web.wsgi import app
+    app.run()
 
 
-    @click.command()
-    def web():
-        """Run the web application."""
-        app.run()
+commands = {
+    'init': init,
+    'ls': ls,
+    'delete': delete,
+    'overlap': overlap,
+    'cache': cache,
+}
 
+lazy_commands = {
+    'index': ('embeddingdb.ann:main', 'Build and evaluate approximate nearest neighbor indexes.'),
+    'analyze': ('embeddingdb.sql.analysis:main', 'Perform a regression between two collections.'),
+    'analyze-all': ('embeddingdb.sql.analysis:analyze_all', 'Perform regressions between all pairs of collections.'),
+    'upload': ('embeddingdb.sql.io:main', 'Upload embeddings.'),
+    'download': ('embeddingdb.sql.export:main', 'Download a collection.'),
+    'migrate': ('embeddingdb.sql.migrate:main', 'Migrate the database schema or convert collections.'),
+    'benchmark': ('embeddingdb.benchmark:main', 'Run benchmarks.'),
+}
 
+# the web application is only available if its extra dependencies are installed
+if importlib.util.find_spec('flask') is not None:
     commands['web'] = web
-except ImportError:
-    pass
+    lazy_commands['serve'] = 'embeddingdb.web.serve:main', 'Serve the web application with pre-forked workers.'
 
-main = click.Group(commands=commands)
+main = LazyGroup(commands=commands, lazy_commands=lazy_commands)
@@ -26,6 +26,60 @@ class Config(EasyConfig):
     #: The SQLAlchemy connection string
     connection: str
 
+    #: The number of embeddings written per batch (and per commit) during bulk uploads
+    batch_size: int = 10_000
+
+    #: The data type vectors are stored with, one of ``float32``, ``float16``, or ``int8``
+    vector_dtype: str = 'float32'
+
+    #: The directory where collections are cached as memory-mapped arrays
+    cache_directory: str = os.path.join(HOME, '.cache', 'embeddingdb')
+
+    #: The maximum size of the collection cache in bytes. Set to 0 to disable caching.
+    cache_size: int = 10 * 1024 ** 3
+
+    #: The maximum size in bytes of the API responses cached in each process. Set to 0 to disable caching them.
+    response_cache_size: int = 64 * 1024 ** 2
+
+    #: A directory where API responses are also cached, so they are shared by all workers. Empty to disable it.
+    response_cache_directory: str = ''
+
+    #: The maximum size in bytes of the API responses cached in :data:`response_cache_directory`
+    response_cache_directory_size: int = 1024 ** 3
+
+    #: The address ``embeddingdb serve`` listens on
+    web_bind: str = '127.0.0.1:5000'
+
+    #: The number of worker processes started by ``embeddingdb serve``. Set to 0 to start one per CPU.
+    web_workers: int = 0
+
+    #: The number of threads handling requests in each worker started by ``embeddingdb serve``
+    web_threads: int = 4
+
+    #: The comma-separated identifiers of the collections ``embeddingdb serve`` loads before starting workers
+    web_preload: str = ''
+
+    #: The number of connections kept open in each engine's pool
+    pool_size: int = 5
+
+    #: The number of connections that can be opened beyond the pool size when it's exhausted
+    max_overflow: int = 10
+
+    #: Should connections be tested before they are checked out of the pool?
+    pool_pre_ping: bool = True
+
+    #: The number of seconds after which pooled connections are replaced. Set to -1 to never replace them.
+    pool_recycle: int = 3600
+
+    #: Should the embedding table be partitioned by collection? Only used on PostgreSQL when creating the table.
+    partition_embeddings: bool = False
+
+    #: Should SQL statements, API requests, and uploads be timed? See :mod:`embeddingdb.metrics`.
+    metrics: bool = True
+
+    #: SQL statements taking at least this many seconds are logged as warnings. Set to 0 to disable the log.
+    slow_query_seconds: float = 0.0
+
     def get_connection_option(self) -> click.Option:
         """Get a click Option for the connection string."""
         return click.option('-c', '--connection', default=self.connection, show_default=True)
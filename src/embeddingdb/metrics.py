@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""Lightweight metrics, exposed in the Prometheus text format.
+
+Three kinds of measurements are collected in histograms of the current process when
+:data:`Config.metrics` is enabled:
+
+- ``embeddingdb_sql_seconds``: the time each SQL statement takes, labeled by its shape, which is its text
+  with whitespace collapsed, selected columns elided, and lists of bound parameters folded, so ``IN``
+  clauses of any length share a shape. Statements slower than :data:`Config.slow_query_seconds` are also logged
+  and statements that fail are counted in ``embeddingdb_sql_errors_total``.
+- ``embeddingdb_request_seconds`` and ``embeddingdb_request_sql_seconds``: the time each request to the
+  API takes and how much of that was spent executing SQL, labeled by endpoint, method, and status. The
+  rest of a request's time goes to building objects from rows and serializing the response.
+- ``embeddingdb_ingest_seconds``: the time spent in each stage of an upload (see
+  :func:`embeddingdb.sql.bulk.bulk_insert_chunks`). Batches written with PostgreSQL's ``COPY`` bypass the
+  SQL statement hooks, so they're only counted in the ``write`` stage.
+
+Recording an observation takes a lock and a bisection, so the metrics can be left on.
+"""
+
+import bisect
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .constants import config
+
+__all__ = [
+    'Histogram',
+    'Counter',
+    'REGISTRY',
+    'SQL_SECONDS',
+    'SQL_ERRORS',
+    'REQUEST_SECONDS',
+    'REQUEST_SQL_SECONDS',
+    'INGEST_SECONDS',
+    'INGEST_ROWS',
+    'timer',
+    'get_statement_shape',
+    'start_request',
+    'finish_request',
+    'install_sqlalchemy_hooks',
+    'render',
+]
+
+logger = logging.getLogger(__name__)
+
+#: The default upper bounds of the histograms' buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#: The maximum number of label combinations per metric. Further combinations are recorded as ``other``.
+_MAX_SERIES = 1_000
+
+#: The maximum length of a statement's shape
+_MAX_SHAPE_LENGTH = 200
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Metric:
+    """A metric whose series are identified by their labels."""
+
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _get_labels(self, labels: Dict[str, str], series: dict) -> Labels:
+        key = tuple((name, str(labels[name])) for name in self.label_names)
+        if key not in series and len(series) >= _MAX_SERIES:
+            key = tuple((name, 'other') for name in self.label_names)
+        return key
+
+    def render(self) -> Iterable[str]:
+        """Render this metric in the Prometheus text format."""
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.type_name}'
+
+
+class Counter(_Metric):
+    """A counter of events."""
+
+    type_name = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:  # noqa: D107
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the counter with the given labels."""
+        with self._lock:
+            key = self._get_labels(labels, self._values)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get_value(self, **labels: str) -> float:
+        """Get the value of the counter with the given labels."""
+        key = tuple((name, str(labels[name])) for name in self.label_names)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> Iterable[str]:  # noqa: D102
+        yield from super().render()
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_format_labels(labels)} {value:g}'
+
+
+class Histogram(_Metric):
+    """A histogram of durations in seconds with fixed buckets."""
+
+    type_name = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_names: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Initialize the histogram.
+
+        :param buckets: The sorted upper bounds of the buckets. An infinite bucket is added.
+        """
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+        # the counts per bucket (not cumulative), then the sum of the observations
+        self._series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record an observation with the given labels."""
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._get_labels(labels, self._series)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[position] += 1
+            series[-1] += value
+
+    def get_count(self, **labels: str) -> int:
+        """Get the number of observations with the given labels."""
+        key = tuple((name, str(labels[name])) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            return int(sum(series[:-1])) if series else 0
+
+    def get_sum(self, **labels: str) -> float:
+        """Get the sum of the observations with the given labels."""
+        key = tuple((name, str(labels[name])) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            return series[-1] if series else 0.0
+
+    def render(self) -> Iterable[str]:  # noqa: D102
+        yield from super().render()
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), series):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                yield f'{self.name}_bucket{_format_labels(labels + (("le", le),))} {cumulative:g}'
+            yield f'{self.name}_sum{_format_labels(labels)} {series[-1]:.6f}'
+            yield f'{self.name}_count{_format_labels(labels)} {cumulative:g}'
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels
+    ) + '}'
+
+
+SQL_SECONDS = Histogram(
+    'embeddingdb_sql_seconds', 'Time spent executing SQL statements, by statement shape.', ['query'],
+)
+SQL_ERRORS = Counter(
+    'embeddingdb_sql_errors_total', 'Number of SQL statements that failed, by statement shape.', ['query'],
+)
+REQUEST_SECONDS = Histogram(
+    'embeddingdb_request_seconds', 'Time spent handling API requests.', ['endpoint', 'method', 'status'],
+)
+REQUEST_SQL_SECONDS = Histogram(
+    'embeddingdb_request_sql_seconds', 'Time spent executing SQL per API request.', ['endpoint', 'method', 'status'],
+)
+INGEST_SECONDS = Histogram(
+    'embeddingdb_ingest_seconds', 'Time spent in each stage of uploading a chunk of embeddings.', ['stage'],
+)
+INGEST_ROWS = Counter(
+    'embeddingdb_ingest_rows_total', 'Number of embeddings uploaded.',
+)
+
+#: The metrics rendered by :func:`render`
+REGISTRY: List[_Metric] = [
+    SQL_SECONDS, SQL_ERRORS, REQUEST_SECONDS, REQUEST_SQL_SECONDS, INGEST_SECONDS, INGEST_ROWS,
+]
+
+
+def render(metrics: Optional[Iterable[_Metric]] = None) -> str:
+    """Render the metrics in the Prometheus text format.
+
+    :param metrics: The metrics to render. Defaults to :data:`REGISTRY`.
+    """
+    return ''.join(
+        f'{line}\n'
+        for metric in (REGISTRY if metrics is None else metrics)
+        for line in metric.render()
+    )
+
+
+@contextmanager
+def timer(histogram: Histogram, **labels: str):
+    """Observe the time spent in the context, if metrics are enabled."""
+    if not config.metrics:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, **labels)
+
+
+_PARAMETERS = re.compile(r'%\(\w+\)s|:\w+|\?|\$\d+|%s')
+_PARAMETER_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+_SELECTED_COLUMNS = re.compile(r'\bSELECT (?:DISTINCT )?(?:(?!\bFROM\b).)+? FROM\b')
+
+
+@lru_cache(maxsize=4096)
+def get_statement_shape(statement: str) -> str:
+    """Get the shape of an SQL statement, with whitespace collapsed, columns elided, and parameter lists folded."""
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _SELECTED_COLUMNS.sub('SELECT ... FROM', shape)
+    shape = _PARAMETERS.sub('?', shape)
+    shape = _PARAMETER_LISTS.sub('(?, ...)', shape)
+    if len(shape) > _MAX_SHAPE_LENGTH:
+        shape = shape[:_MAX_SHAPE_LENGTH - 3] + '...'
+    return shape
+
+
+_local = threading.local()
+
+
+def start_request() -> None:
+    """Start accumulating the time this thread spends executing SQL for a request."""
+    _local.sql_seconds = 0.0
+    _local.start = time.perf_counter()
+
+
+def finish_request(endpoint: str, method: str, status: int) -> None:
+    """Record the time spent on the request started on this thread by :func:`start_request`."""
+    start = getattr(_local, 'start', None)
+    if start is None:
+        return
+    labels = dict(endpoint=endpoint, method=method, status=str(status))
+    REQUEST_SECONDS.observe(time.perf_counter() - start, **labels)
+    REQUEST_SQL_SECONDS.observe(_local.sql_seconds, **labels)
+    _local.start = None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault('embeddingdb_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+    starts = conn.info.get('embeddingdb_query_start')
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    shape = get_statement_shape(statement)
+    SQL_SECONDS.observe(seconds, query=shape)
+    if getattr(_local, 'start', None) is not None:
+        _local.sql_seconds += seconds
+    if 0 < config.slow_query_seconds <= seconds:
+        logger.warning('slow query (%.3fs): %s', seconds, shape)
+
+
+def _handle_error(context) -> None:
+    # statements that fail never reach after_cursor_execute, so their start times are taken out here
+    try:
+        starts = context.connection.info.get('embeddingdb_query_start')
+    except Exception:  # the connection may already be unusable
+        starts = None
+    if starts:
+        starts.pop()
+    if context.statement is not None:
+        SQL_ERRORS.inc(query=get_statement_shape(context.statement))
+
+
+def install_sqlalchemy_hooks(engine) -> None:
+    """Time every SQL statement executed by the given engine and count the ones that fail, if metrics are enabled.
+
+    :param engine: A :class:`sqlalchemy.engine.Engine`
+    """
+    if not config.metrics:
+        return
+    from sqlalchemy import event
+
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
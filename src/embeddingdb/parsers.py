@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming parsers for embedding files.
+
+Each parser yields chunks of at most ``chunk_size`` entities as pairs of a list of CURIEs and a
+:class:`numpy.ndarray` of shape ``(len(curies), dimensions)`` with type ``float32``, so files of any size
+can be read with bounded memory.
+"""
+
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import BinaryIO, Iterable, List, Optional, TextIO, Tuple
+
+import numpy as np
+
+__all__ = [
+    'Chunk',
+    'DEFAULT_CHUNK_SIZE',
+    'read_word2vec_header',
+    'iter_word2vec_text_chunks',
+    'iter_word2vec_text_chunks_parallel',
+    'iter_word2vec_binary_chunks',
+    'iter_pykeen_chunks',
+    'ARROW_METADATA_KEY',
+    'read_arrow_metadata',
+    'iter_arrow_chunks',
+    'is_word2vec_binary',
+]
+
+#: A list of CURIEs and a matrix whose rows are their vectors
+Chunk = Tuple[List[str], np.ndarray]
+
+#: The default number of entities per chunk
+DEFAULT_CHUNK_SIZE = 10_000
+
+#: The number of characters (or bytes) read at a time by the parsers
+_BUFFER_SIZE = 1 << 20
+
+_WHITESPACE = ' \t\n\r'
+
+#: The key of the collection's metadata in the schema of Arrow and Parquet files
+ARROW_METADATA_KEY = 'embeddingdb'
+
+_PARQUET_MAGIC = b'PAR1'
+
+
+def _parse_block(text: str, sep: str, rows: int, dimensions: int) -> np.ndarray:
+    """Parse a block of delimited numbers into a float32 matrix."""
+    block = np.fromstring(text, dtype=np.float32, sep=sep)
+    if block.size != rows * dimensions:
+        raise ValueError(f'expected {rows}x{dimensions} values but got {block.size}')
+    return block.reshape(rows, dimensions)
+
+
+def read_word2vec_header(line: str) -> Tuple[int, int]:
+    """Parse the number of rows and dimensions from the first line of a word2vec file."""
+    rows, dimensions = map(int, line.split())
+    return rows, dimensions
+
+
+def iter_word2vec_text_chunks(
+        file: TextIO,
+        dimensions: int,
+        chunk_size: Optional[int] = None,
+) -> Iterable[Chunk]:
+    """Iterate over chunks of a word2vec text file whose header has already been consumed.
+
+    The numeric parts of all lines in a chunk are parsed at once with :func:`numpy.fromstring`.
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    while True:
+        lines = list(islice(file, chunk_size))
+        if not lines:
+            return
+        yield _parse_word2vec_text_lines(lines, dimensions)
+
+
+def _parse_word2vec_text_lines(lines: Iterable[str], dimensions: int) -> Chunk:
+    curies, vectors = [], []
+    for line in lines:
+        curie, _, vector = line.strip().partition(' ')
+        curies.append(curie)
+        vectors.append(vector)
+    return curies, _parse_block(' '.join(vectors), ' ', len(curies), dimensions)
+
+
+def _parse_word2vec_text_bytes(data: bytes, dimensions: int) -> Chunk:
+    return _parse_word2vec_text_lines(data.decode('utf-8').splitlines(), dimensions)
+
+
+def iter_word2vec_text_chunks_parallel(
+        file: BinaryIO,
+        dimensions: int,
+        chunk_size: Optional[int] = None,
+        workers: Optional[int] = None,
+) -> Iterable[Chunk]:
+    """Iterate over chunks of a word2vec text file parsed by a pool of worker processes.
+
+    The file, opened in binary mode with its header already consumed, is split into blocks of
+    ``chunk_size`` whole lines that are parsed in parallel. At most twice as many blocks as there are
+    workers are in flight, so memory stays bounded while the consumer (e.g., a database writer) is
+    busy. Chunks are yielded in the order of the file.
+
+    :param workers: The number of worker processes. Defaults to the number of CPUs. With a single
+     worker, the file is parsed in this process.
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for lines in iter(lambda: list(islice(file, chunk_size)), []):
+            yield _parse_word2vec_text_bytes(b''.join(lines), dimensions)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        try:
+            for lines in iter(lambda: list(islice(file, chunk_size)), []):
+                pending.append(executor.submit(_parse_word2vec_text_bytes, b''.join(lines), dimensions))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # don't wait for blocks that will never be consumed if iteration stops early
+            for future in pending:
+                future.cancel()
+
+
+def iter_word2vec_binary_chunks(
+        file: BinaryIO,
+        dimensions: int,
+        chunk_size: Optional[int] = None,
+) -> Iterable[Chunk]:
+    """Iterate over chunks of a word2vec binary file whose header has already been consumed.
+
+    Each entry is a space-terminated word followed by ``dimensions`` little-endian float32 values
+    and an optional newline.
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    width = 4 * dimensions
+    dtype = np.dtype('<f4')
+    buffer, position = b'', 0
+    while True:
+        curies: List[str] = []
+        block = np.empty((chunk_size, dimensions), dtype=np.float32)
+        while len(curies) < chunk_size:
+            end = buffer.find(b' ', position)
+            while end == -1 or len(buffer) < end + 1 + width:
+                data = file.read(_BUFFER_SIZE)
+                if not data:
+                    break
+                buffer, position = buffer[position:] + data, 0
+                end = buffer.find(b' ', position)
+            if end == -1 or len(buffer) < end + 1 + width:
+                if buffer[position:].strip():
+                    raise ValueError('truncated word2vec binary file')
+                if curies:
+                    yield curies, block[:len(curies)]
+                return
+            curies.append(buffer[position:end].lstrip(b'\n').decode('utf-8', errors='replace'))
+            block[len(curies) - 1] = np.frombuffer(buffer, dtype=dtype, count=dimensions, offset=end + 1)
+            position = end + 1 + width
+        yield curies, block
+
+
+def iter_pykeen_chunks(
+        file: TextIO,
+        dimensions: int,
+        chunk_size: Optional[int] = None,
+) -> Iterable[Chunk]:
+    """Iterate over chunks of a PyKEEN ``entities_to_embeddings.json`` file.
+
+    The file is a single JSON object mapping CURIEs to lists of numbers. It is read incrementally and
+    each value is handed over as raw text, so the object is never held in memory at once.
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    it = _iter_json_number_arrays(file)
+    while True:
+        items = list(islice(it, chunk_size))
+        if not items:
+            return
+        curies, vectors = zip(*items)
+        yield list(curies), _parse_block(','.join(vectors), ',', len(curies), dimensions)
+
+
+def _iter_json_number_arrays(file: TextIO) -> Iterable[Tuple[str, str]]:
+    """Iterate over the keys and raw array texts of a JSON object whose values are flat arrays of numbers."""
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+
+    def _token() -> str:
+        """Skip whitespace, refilling the buffer as needed, and return the next character."""
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in _WHITESPACE:
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not _refill():
+                raise ValueError('unexpected end of JSON document')
+
+    def _refill() -> bool:
+        nonlocal buffer, position
+        data = file.read(_BUFFER_SIZE)
+        buffer, position = buffer[position:] + data, 0
+        return bool(data)
+
+    if _token() != '{':
+        raise ValueError('expected a JSON object')
+    position += 1
+    if _token() == '}':
+        return
+
+    while True:
+        if _token() != '"':
+            raise ValueError(f'expected a key at position {position}')
+        while True:
+            try:
+                key, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not _refill():
+                    raise
+            else:
+                position = end
+                break
+
+        if _token() != ':':
+            raise ValueError(f'expected ":" after key {key}')
+        position += 1
+        if _token() != '[':
+            raise ValueError(f'expected an array for key {key}')
+        end = buffer.find(']', position)
+        while end == -1:
+            if not _refill():
+                raise ValueError(f'unterminated array for key {key}')
+            end = buffer.find(']', position)
+        yield key, buffer[position + 1:end]
+        position = end + 1
+
+        token = _token()
+        position += 1
+        if token == '}':
+            return
+        if token != ',':
+            raise ValueError(f'expected "," or "}}" after the array for key {key}')
+
+
+def _open_arrow(path: str):
+    """Open an Arrow IPC file or stream, or a Parquet file, with :mod:`pyarrow`."""
+    import pyarrow as pa
+
+    with open(path, 'rb') as file:
+        magic = file.read(len(_PARQUET_MAGIC))
+    if magic == _PARQUET_MAGIC:
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path)
+    try:
+        return pa.ipc.open_file(path)
+    except pa.ArrowInvalid:
+        return pa.ipc.open_stream(pa.OSFile(path))
+
+
+def read_arrow_metadata(path: str) -> dict:
+    """Read the collection's metadata from an Arrow or Parquet file written by ``embeddingdb download``.
+
+    :return: A dictionary with ``dimensions`` and, if the file was exported by ``embeddingdb``,
+     ``package_name``, ``package_version``, and ``extras``
+    """
+    reader = _open_arrow(path)
+    schema = reader.schema_arrow if hasattr(reader, 'schema_arrow') else reader.schema
+    metadata = schema.metadata or {}
+    rv = json.loads(metadata[ARROW_METADATA_KEY.encode()]) if ARROW_METADATA_KEY.encode() in metadata else {}
+    vector_type = schema.field('vector').type
+    if 'dimensions' not in rv and getattr(vector_type, 'list_size', -1) > 0:
+        rv['dimensions'] = vector_type.list_size
+    return rv
+
+
+def iter_arrow_chunks(path: str, dimensions: int, chunk_size: Optional[int] = None) -> Iterable[Chunk]:
+    """Iterate over chunks of an Arrow or Parquet file with a ``curie`` and a ``vector`` column.
+
+    The vectors can be fixed size or variable size lists of numbers. Each record batch is converted to a
+    matrix at once, without going through Python objects.
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    reader = _open_arrow(path)
+    if hasattr(reader, 'iter_batches'):
+        batches = reader.iter_batches(batch_size=chunk_size, columns=['curie', 'vector'])
+    elif hasattr(reader, 'num_record_batches'):
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    else:
+        batches = reader
+    for batch in batches:
+        for start in range(0, batch.num_rows, chunk_size):
+            part = batch.slice(start, chunk_size)
+            curies = part.column(part.schema.get_field_index('curie')).to_pylist()
+            values = part.column(part.schema.get_field_index('vector')).flatten()
+            vectors = values.to_numpy(zero_copy_only=False).astype(np.float32, copy=False)
+            yield curies, vectors.reshape(len(curies), dimensions)
+
+
+def is_word2vec_binary(path: str) -> bool:
+    """Guess if a word2vec file is in the binary format from its extension."""
+    return os.path.splitext(path)[1].lower() == '.bin'
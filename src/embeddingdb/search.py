@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""Exact nearest neighbor search in collections.
+
+An :class:`ExactIndex` answers top-*k* queries by cosine similarity or dot product by multiplying the queries
+with blocks of the collection's matrix and keeping the best candidates of each block with
+:func:`numpy.argpartition`. For cosine similarity, the inverse norms of the rows are computed once, so the
+matrix itself (which might be memory-mapped from the cache) is never copied.
+
+Indexes are kept in memory per process. Indexes of the same collection with different metrics share its
+matrix, and indexes pinned before a server forks its workers (see :mod:`embeddingdb.web.serve`) are shared
+by all of them.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .cache import decode_curies, encode_curies
+
+__all__ = [
+    'METRICS',
+    'Neighbor',
+    'ExactIndex',
+    'get_index',
+    'get_loaded_index',
+    'get_neighbors',
+    'sort_by_curie',
+]
+
+#: The supported similarity metrics
+METRICS = ('cosine', 'dot')
+
+#: A CURIE and its similarity to the query
+Neighbor = Tuple[str, float]
+
+#: The number of rows of the matrix multiplied with the queries at a time
+DEFAULT_BLOCK_SIZE = 65_536
+
+#: The number of indexes kept in memory per process
+_MAX_INDEXES = 8
+
+
+class ExactIndex:
+    """An exact nearest neighbor index over a matrix of vectors labeled by sorted CURIEs."""
+
+    def __init__(
+            self,
+            curies: Sequence[str],
+            vectors: np.ndarray,
+            metric: str = 'cosine',
+            block_size: Optional[int] = None,
+    ) -> None:
+        """Initialize the index.
+
+        :param curies: The CURIEs labeling the rows of the matrix. If they are not sorted, the CURIEs and
+         the matrix are sorted together. They're kept as UTF-8 bytes (see :func:`embeddingdb.cache.encode_curies`).
+        :param vectors: A float32 matrix
+        :param metric: Either ``cosine`` or ``dot``
+        :param block_size: The number of rows multiplied with the queries at a time
+        """
+        if metric not in METRICS:
+            raise ValueError(f'invalid metric: {metric}. Should be one of {METRICS}')
+        curies, vectors = sort_by_curie(curies, vectors)
+        self.curies = curies
+        self.vectors = vectors
+        self.metric = metric
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+        self.inverse_norms = self._get_inverse_norms(vectors) if metric == 'cosine' else None
+
+    def _get_inverse_norms(self, vectors: np.ndarray) -> np.ndarray:
+        norms = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), self.block_size):
+            norms[start:start + self.block_size] = np.linalg.norm(vectors[start:start + self.block_size], axis=1)
+        with np.errstate(divide='ignore'):
+            rv = np.where(norms > 0, 1 / norms, 0).astype(np.float32)
+        return rv
+
+    def __len__(self) -> int:  # noqa: D105
+        return len(self.curies)
+
+    def get_position(self, curie: str) -> Optional[int]:
+        """Get the row of the given CURIE, if it's in the index."""
+        curie = curie.encode('utf-8')
+        position = int(np.searchsorted(self.curies, curie))
+        if position < len(self.curies) and self.curies[position] == curie:
+            return position
+        return None
+
+    def get_vectors(self, curies: Iterable[str]) -> Tuple[List[str], np.ndarray, List[str]]:
+        """Get the vectors for many CURIEs at once, like :func:`embeddingdb.sql.models.get_embeddings`.
+
+        :param curies: The CURIEs to look up. Duplicates are ignored.
+        :return: The CURIEs that were found (in the order they were given), a float32 matrix of their vectors,
+         and the CURIEs that were missing
+        """
+        curies = list(dict.fromkeys(curies))
+        if not curies or not len(self):
+            return [], np.empty((0, self.vectors.shape[1]), dtype=np.float32), curies
+        queries = encode_curies(curies)
+        positions = np.searchsorted(self.curies, queries)
+        in_range = positions < len(self.curies)
+        found = in_range.copy()
+        found[in_range] = self.curies[positions[in_range]] == queries[in_range]
+        return (
+            [curie for curie, is_found in zip(curies, found) if is_found],
+            np.asarray(self.vectors[positions[found]]),
+            [curie for curie, is_found in zip(curies, found) if not is_found],
+        )
+
+    def get_vector(self, curie: str) -> Optional[np.ndarray]:
+        """Get the vector for the given CURIE, if it's in the index."""
+        position = self.get_position(curie)
+        if position is None:
+            return None
+        return np.asarray(self.vectors[position])
+
+    def search(self, queries: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the k most similar rows to each query.
+
+        :param queries: A matrix of shape ``(m, dimensions)``
+        :param k: The number of neighbors to find per query
+        :param nprobe: Ignored, for compatibility with :class:`embeddingdb.ann.IVFIndex`
+        :return: The positions and similarities of the neighbors, both of shape ``(m, k)`` and sorted by
+         decreasing similarity
+        """
+        if k < 1:
+            raise ValueError(f'k should be positive: {k}')
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(self))
+        if self.metric == 'cosine':
+            norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            queries = queries / np.where(norms > 0, norms, 1)
+
+        best_positions = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.vectors[start:start + self.block_size])
+            scores = queries @ block.T
+            if self.inverse_norms is not None:
+                scores *= self.inverse_norms[start:start + self.block_size]
+            positions = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            best_positions, best_scores = _top_k(
+                np.hstack([best_positions, positions]),
+                np.hstack([best_scores, scores]),
+                k,
+            )
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_positions, order, 1), np.take_along_axis(best_scores, order, 1)
+
+    def search_curies(self, queries: np.ndarray, k: int, nprobe: Optional[int] = None) -> List[List[Neighbor]]:
+        """Find the k most similar CURIEs to each query."""
+        positions, scores = self.search(queries, k, nprobe=nprobe)
+        return [
+            [
+                (curie, score)
+                for position, curie, score in zip(
+                    row_positions, decode_curies(self.curies[row_positions]).tolist(), row_scores.tolist(),
+                )
+                if position >= 0
+            ]
+            for row_positions, row_scores in zip(positions, scores)
+        ]
+
+
+def sort_by_curie(curies: Sequence[str], vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort CURIEs by code point, as needed by :func:`numpy.searchsorted`, and the rows of a matrix with them.
+
+    The CURIEs are returned as UTF-8 bytes (see :func:`embeddingdb.cache.encode_curies`), which sort in the same
+    order. If they are already sorted, the matrix is returned as is.
+    """
+    curies = encode_curies(curies)
+    if len(curies) > 1 and np.any(curies[:-1] > curies[1:]):
+        order = np.argsort(curies, kind='stable')
+        curies, vectors = curies[order], vectors[order]
+    return curies, vectors
+
+
+def _top_k(positions: np.ndarray, scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Keep the k highest scoring columns in each row, in no particular order."""
+    if scores.shape[1] <= k:
+        return positions, scores
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(positions, top, 1), np.take_along_axis(scores, top, 1)
+
+
+_indexes = OrderedDict()
+_pinned_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(collection, metric: str = 'cosine', exact: bool = False, pin: bool = False) -> ExactIndex:
+    """Get the index for a collection, loading it on first use.
+
+    If an approximate index was built for the collection with :mod:`embeddingdb.ann`, it is used unless
+    ``exact`` is set. The most recently used indexes are kept in memory for the lifetime of the process,
+    keyed by the collection's identifier and content version.
+
+    :param collection: A :class:`embeddingdb.sql.models.Collection`
+    :param metric: Either ``cosine`` or ``dot``
+    :param exact: Should an exact index be used even if an approximate index was built?
+    :param pin: Should the index be kept in memory until the collection changes, rather than being evicted
+     when other indexes are used?
+    """
+    key = collection.id, collection.version, metric, exact
+    with _indexes_lock:
+        index = _pinned_indexes.get(key)
+        if index is None:
+            index = _indexes.get(key)
+            if index is not None:
+                _indexes.move_to_end(key)
+        if index is not None and not pin:
+            return index
+        # pinned indexes of older versions would never be used again
+        for stale_key in [k for k in _pinned_indexes if k[0] == collection.id and k[1] != collection.version]:
+            del _pinned_indexes[stale_key]
+
+    if index is None and not exact:
+        from .ann import load_ivf_index  # the approximate index module builds on this one
+        index = load_ivf_index(collection, metric=metric)
+    if index is None:
+        loaded = get_loaded_index(collection)
+        if loaded is not None:
+            index = ExactIndex(loaded.curies, loaded.vectors, metric=metric)
+        else:
+            curies, vectors = collection.load(encoded=True)
+            index = ExactIndex(curies, vectors, metric=metric)
+
+    with _indexes_lock:
+        if pin:
+            _indexes.pop(key, None)
+            _pinned_indexes[key] = index
+        else:
+            _indexes[key] = index
+            while len(_indexes) > _MAX_INDEXES:
+                _indexes.popitem(last=False)
+    return index
+
+
+def get_loaded_index(collection) -> Optional[ExactIndex]:
+    """Get any index of the current version of a collection that's already in memory, whatever its metric.
+
+    :param collection: A :class:`embeddingdb.sql.models.Collection`
+    """
+    with _indexes_lock:
+        for indexes in (_pinned_indexes, _indexes):
+            for (collection_id, version, _, _), index in indexes.items():
+                if collection_id == collection.id and version == collection.version:
+                    return index
+    return None
+
+
+def get_neighbors(
+        collection,
+        curies: Optional[Iterable[str]] = None,
+        vectors: Optional[np.ndarray] = None,
+        k: int = 10,
+        metric: str = 'cosine',
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+) -> List[List[Neighbor]]:
+    """Get the k most similar entities in a collection to each of the given CURIEs or vectors.
+
+    When querying by CURIE, the entity itself is left out of its neighbors.
+
+    :param collection: A :class:`embeddingdb.sql.models.Collection`
+    :param curies: CURIEs of entities in the collection
+    :param vectors: A matrix of shape ``(m, dimensions)``, used if no CURIEs are given
+    :param k: The number of neighbors to find per query
+    :param metric: Either ``cosine`` or ``dot``
+    :param nprobe: The number of inverted lists visited per query if the collection has an approximate index
+    :param exact: Should exact search be used even if the collection has an approximate index?
+    :raises KeyError: If any of the CURIEs is not in the collection
+    """
+    index = get_index(collection, metric=metric, exact=exact)
+    if curies is None:
+        return index.search_curies(vectors, k, nprobe=nprobe)
+
+    curies = list(curies)
+    positions = []
+    for curie in curies:
+        position = index.get_position(curie)
+        if position is None:
+            raise KeyError(curie)
+        positions.append(position)
+
+    results = index.search_curies(np.asarray(index.vectors[positions]), k + 1, nprobe=nprobe)
+    return [
+        [neighbor for neighbor in neighbors if neighbor[0] != curie][:k]
+        for curie, neighbors in zip(curies, results)
+    ]
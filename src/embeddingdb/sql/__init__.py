@@ -2,4 +2,5 @@
 
 """A relational database structure for storing embeddings."""
 
+from .bulk import bulk_insert_embeddings
 from .io import upload_pykeen_from_directory, upload_word2vec, upload_word2vec_embedding_file
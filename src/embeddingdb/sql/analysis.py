@@ -2,85 +2,483 @@
 
 """Compute cross-correlations in embedding collections."""
 
-from typing import BinaryIO, Mapping, Optional, Type, Union
+import logging
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import combinations, combinations_with_replacement
+from typing import BinaryIO, Iterable, Mapping, Optional, Sequence, Set, TYPE_CHECKING, Tuple, Type, Union
 
 import click
-import joblib
-from sklearn.base import RegressorMixin
-from sklearn.cross_decomposition import CCA, PLSRegression
-from sklearn.linear_model import (
-    LinearRegression, MultiTaskElasticNet, MultiTaskElasticNetCV, MultiTaskLasso,
-    MultiTaskLassoCV,
-)
-from sklearn.metrics import r2_score
-from sqlalchemy.orm import Session
+import numpy as np
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session, object_session
 
 from embeddingdb.constants import config
-from embeddingdb.sql.models import Collection, get_session
+from embeddingdb.sql.models import (
+    Collection, Embedding, Overlap, RegressionResult, get_session, is_complete, iter_aligned_chunks,
+    load_aligned,
+)
+
+if TYPE_CHECKING:
+    import pandas as pd
+    from sklearn.base import RegressorMixin
 
 __all__ = [
+    'calculate_overlap',
+    'update_overlaps',
     'perform_regression',
+    'run_regressions',
     'main',
+    'analyze_all',
 ]
 
-_REGRESSIONS = {
-    'linear': LinearRegression,
-    'pls': PLSRegression,
-    'cca': CCA,
-    'elastic': MultiTaskElasticNet,
-    'elastic-cv': MultiTaskElasticNetCV,
-    'lasso': MultiTaskLasso,
-    'lasso-cv': MultiTaskLassoCV,
-    # 'svr': sklearn.svm.SVR,
-}
+logger = logging.getLogger(__name__)
+
+#: The shortcut names of the regressions in :data:`embeddingdb.sql.regressions.REGRESSIONS`
+_REGRESSIONS = ('linear', 'pls', 'cca', 'elastic', 'elastic-cv', 'lasso', 'lasso-cv')
+
+#: The shortcut names of the regressions in :data:`embeddingdb.sql.regressions.STREAMING_REGRESSIONS`
+_STREAMING_REGRESSIONS = ('least-squares', 'sgd')
+
+
+def _get_regressions():
+    """Get all of the regressions by their shortcut names, importing :mod:`sklearn`."""
+    from .regressions import REGRESSIONS, STREAMING_REGRESSIONS
+    return {**REGRESSIONS, **STREAMING_REGRESSIONS}
+
+
+def calculate_overlap(
+        session: Session,
+        collection_ids: Optional[Iterable[int]] = None,
+) -> 'pd.DataFrame':
+    """Calculate the pairwise overlap between all collections.
+
+    No vectors are loaded. The overlaps are counted by joining the embedding table with itself on the
+    entities' identifiers and are cached in the database along with the sizes of the collections, so only
+    the pairs involving collections that were added or changed since the last call are counted again.
 
+    :param session: A database session
+    :param collection_ids: If given, only get the pairs involving at least one of these collections
+    :return: A dataframe with one row per pair of collections with the columns ``collection_id_1``,
+     ``collection_id_2``, ``size_1``, ``size_2``, ``overlap``, ``jaccard`` (the overlap divided by the size
+     of the union), and ``containment`` (the overlap divided by the size of the smaller collection)
+    """
+    import pandas as pd
+
+    update_overlaps(session)
+
+    sizes = dict(
+        session.query(Overlap.collection_id_1, Overlap.overlap)
+        .filter(Overlap.collection_id_1 == Overlap.collection_id_2)
+    )
+    query = (
+        session.query(Overlap.collection_id_1, Overlap.collection_id_2, Overlap.overlap)
+        .filter(Overlap.collection_id_1 < Overlap.collection_id_2)
+    )
+    if collection_ids is not None:
+        collection_ids = list(collection_ids)
+        query = query.filter(or_(
+            Overlap.collection_id_1.in_(collection_ids),
+            Overlap.collection_id_2.in_(collection_ids),
+        ))
+    df = pd.DataFrame(
+        query.order_by(Overlap.collection_id_1, Overlap.collection_id_2).all(),
+        columns=['collection_id_1', 'collection_id_2', 'overlap'],
+    )
+    df.insert(2, 'size_1', df['collection_id_1'].map(sizes).fillna(0).astype(int))
+    df.insert(3, 'size_2', df['collection_id_2'].map(sizes).fillna(0).astype(int))
+    union = df['size_1'] + df['size_2'] - df['overlap']
+    df['jaccard'] = (df['overlap'] / union.where(union > 0)).fillna(0.0)
+    smaller = df[['size_1', 'size_2']].min(axis=1)
+    df['containment'] = (df['overlap'] / smaller.where(smaller > 0)).fillna(0.0)
+    return df
+
+
+def update_overlaps(session: Session) -> Set[int]:
+    """Count the overlaps for the pairs of collections that aren't cached yet or whose collections changed.
+
+    :param session: A database session
+    :return: The identifiers of the collections whose overlaps were counted again
+    """
+    versions = dict(session.query(Collection.id, Collection.version).filter(is_complete()))
+    cached = {
+        (collection_id_1, collection_id_2): (version_1, version_2)
+        for collection_id_1, collection_id_2, version_1, version_2 in session.query(
+            Overlap.collection_id_1, Overlap.collection_id_2, Overlap.version_1, Overlap.version_2,
+        )
+    }
 
-def calculate_overlap():
-    """Calculate the pairwise overlap between all collections."""
-    raise NotImplementedError
+    # a collection is stale if its size, cached as its overlap with itself, is missing or for an older
+    # version, or if any of its other overlaps is
+    stale = {
+        collection_id
+        for collection_id, version in versions.items()
+        if cached.get((collection_id, collection_id)) != (version, version)
+    }
+    for pair in combinations(sorted(versions), 2):
+        if stale.isdisjoint(pair) and cached.get(pair) != (versions[pair[0]], versions[pair[1]]):
+            stale.add(pair[0])
+    # otherwise, there are overlaps left over for deleted collections
+    if not stale and len(cached) == len(versions) * (len(versions) + 1) // 2:
+        return stale
+
+    overlaps = {**_count_overlaps(session, stale), **_count_sizes(session, stale)}
+    table = Overlap.__table__
+    session.execute(table.delete().where(or_(
+        table.c.collection_id_1.in_(stale),
+        table.c.collection_id_2.in_(stale),
+        table.c.collection_id_1.notin_(versions),
+        table.c.collection_id_2.notin_(versions),
+    )))
+    rows = [
+        dict(
+            collection_id_1=collection_id_1,
+            collection_id_2=collection_id_2,
+            version_1=versions[collection_id_1],
+            version_2=versions[collection_id_2],
+            overlap=overlaps.get((collection_id_1, collection_id_2), 0),
+        )
+        for collection_id_1, collection_id_2 in combinations_with_replacement(sorted(versions), 2)
+        if collection_id_1 in stale or collection_id_2 in stale
+    ]
+    if rows:
+        session.execute(table.insert(), rows)
+    session.commit()
+    return stale
+
+
+def _count_overlaps(session: Session, collection_ids: Set[int]) -> Mapping[Tuple[int, int], int]:
+    """Count the entities each of the given collections shares with every other collection in one query."""
+    if not collection_ids:
+        return {}
+    collection_ids = sorted(collection_ids)
+    left, right = Embedding.__table__.alias('left'), Embedding.__table__.alias('right')
+    query = (
+        select([left.c.collection_id, right.c.collection_id, func.count()])
+        .select_from(left.join(right, left.c.entity_id == right.c.entity_id))
+        .where(left.c.collection_id.in_(collection_ids))
+        .where(left.c.collection_id != right.c.collection_id)
+        # pairs of two stale collections are only counted once
+        .where(or_(right.c.collection_id.notin_(collection_ids), left.c.collection_id < right.c.collection_id))
+        .group_by(left.c.collection_id, right.c.collection_id)
+    )
+    return {
+        (min(collection_id_1, collection_id_2), max(collection_id_1, collection_id_2)): count
+        for collection_id_1, collection_id_2, count in session.execute(query)
+    }
+
+
+def _count_sizes(session: Session, collection_ids: Set[int]) -> Mapping[Tuple[int, int], int]:
+    """Count the entities in each of the given collections, keyed like their overlaps with themselves."""
+    if not collection_ids:
+        return {}
+    query = (
+        session.query(Embedding.collection_id, func.count(Embedding.id))
+        .filter(Embedding.collection_id.in_(sorted(collection_ids)))
+        .group_by(Embedding.collection_id)
+    )
+    return {(collection_id, collection_id): count for collection_id, count in query}
+
+
+class _R2Accumulator:
+    """Calculates the coefficient of determination, averaged uniformly over the targets, from batches."""
+
+    def __init__(self) -> None:
+        self.n = 0
+        self.sum = self.sum_of_squares = self.residual_sum_of_squares = 0.0
+
+    def update(self, y: np.ndarray, y_pred: np.ndarray) -> None:
+        y = np.asarray(y, dtype=np.float64)
+        self.n += len(y)
+        self.sum = self.sum + y.sum(axis=0)
+        self.sum_of_squares = self.sum_of_squares + (y ** 2).sum(axis=0)
+        self.residual_sum_of_squares = self.residual_sum_of_squares + ((y - y_pred) ** 2).sum(axis=0)
+
+    def score(self) -> float:
+        if self.n < 2:
+            return float('nan')
+        total_sum_of_squares = self.sum_of_squares - self.sum ** 2 / self.n
+        # targets with no variance count as perfectly predicted if their residuals are zero, like r2_score
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(
+                total_sum_of_squares > 0,
+                1 - self.residual_sum_of_squares / total_sum_of_squares,
+                np.where(self.residual_sum_of_squares > 0, 0.0, 1.0),
+            )
+        return float(np.mean(scores))
 
 
 def perform_regression(
         collection_1: Collection,
         collection_2: Collection,
-        regression_cls: Union[None, str, Type[RegressorMixin]] = None,
+        regression_cls: Union[None, str, Type['RegressorMixin']] = None,
         regression_kwargs: Optional[Mapping] = None,
         output: Union[None, str, BinaryIO] = None,
+        *,
+        streaming: Optional[bool] = None,
+        test_size: float = 0.2,
+        epochs: int = 1,
+        chunk_size: Optional[int] = None,
+        seed: int = 0,
 ):
     """Perform a regression between two collections of embeddings and evaluate the results.
 
+    Only the entities in both collections are used. By default, they are loaded into memory at once with
+    :func:`embeddingdb.sql.models.load_aligned`, the regression is fit on all of them, and evaluated on
+    the same data. In streaming mode, they are fetched in chunks with
+    :func:`embeddingdb.sql.models.iter_aligned_chunks` and fed to the regression's ``partial_fit``, so
+    neither collection has to fit in memory. Each entity is randomly assigned to the training or test
+    set, and the coefficient of determination is calculated on the test set in a final pass.
+
     :param collection_1: The first collection
     :param collection_2: The second collection
-    :param regression_cls: Class or shortcut name to class that is a ``RegressorMixin``. Valid shortcuts are 'lienar'
-     and 'pls'.
+    :param regression_cls: Class or shortcut name to class that is a ``RegressorMixin``. Valid shortcuts are
+     'linear', 'pls', 'cca', 'elastic', 'elastic-cv', 'lasso', and 'lasso-cv' as well as 'least-squares' and
+     'sgd', which are fit in streaming mode.
     :param regression_kwargs: Keyword arguments to pass to the regressor class on instantiation
     :param output: Optional path to output the regressor model using ``joblib``
-    :return:
+    :param streaming: Should the regression be fit from chunks? Defaults to streaming for the streaming
+     shortcuts.
+    :param test_size: The fraction of entities held out for evaluation in streaming mode
+    :param epochs: The number of passes over the training set in streaming mode
+    :param chunk_size: The number of entities per chunk in streaming mode. Defaults to :data:`Config.batch_size`.
+    :param seed: The seed for assigning entities to the training and test sets in streaming mode
+    :return: The regression, its coefficient of determination, the number of entities in both collections,
+     and that number divided by the size of the smaller collection
     """
+    from sklearn.base import RegressorMixin
+    from sklearn.metrics import r2_score
+
+    if streaming is None:
+        streaming = isinstance(regression_cls, str) and regression_cls in _STREAMING_REGRESSIONS
     if regression_cls is None:
-        regression_cls = LinearRegression
+        regression_cls = _get_regressions()['least-squares' if streaming else 'linear']
     elif isinstance(regression_cls, str):
-        regression_cls = _REGRESSIONS[regression_cls]
+        regression_cls = _get_regressions()[regression_cls]
     elif not issubclass(regression_cls, RegressorMixin):
         raise TypeError(f'regression_cls had invalid type: {regression_cls}')
 
     clf = regression_cls(**(regression_kwargs or {}))
-    x = collection_1.as_dataframe()
-    y = collection_2.as_dataframe()
-
-    index = x.index & y.index
-    x = x.loc[index]
-    y = y.loc[index]
-
-    clf.fit(x, y)
+    if streaming:
+        r2, intersection = _fit_streaming(
+            clf, collection_1, collection_2, test_size=test_size, epochs=epochs, chunk_size=chunk_size, seed=seed,
+        )
+    else:
+        curies, x, y = load_aligned(collection_1, collection_2)
+        intersection = len(curies)
+        clf.fit(x, y)
+        r2 = r2_score(y, clf.predict(x))
 
     if output is not None:
+        import joblib
         joblib.dump(clf, output)
 
-    y_pred = clf.predict(x)
-    r2 = r2_score(y, y_pred)
+    smaller = min(collection_1.count_embeddings(), collection_2.count_embeddings())
+    return clf, r2, intersection, intersection / smaller if smaller else 0.0
 
-    return clf, r2, len(index), len(index) / min(len(x.index), len(y.index))
+
+def _fit_streaming(
+        clf,
+        collection_1: Collection,
+        collection_2: Collection,
+        *,
+        test_size: float,
+        epochs: int,
+        chunk_size: Optional[int],
+        seed: int,
+) -> Tuple[float, int]:
+    """Fit a regression from chunks of aligned entities and evaluate it on the held out ones."""
+    session = object_session(collection_1)
+
+    def iter_splits():
+        # the chunks come in the same order each time, so reseeding gives every pass the same split
+        random_state = np.random.default_rng(seed)
+        for _, x, y in iter_aligned_chunks(session, collection_1, collection_2, chunk_size=chunk_size):
+            yield x, y, random_state.random(len(x)) < test_size
+
+    for _ in range(epochs):
+        for x, y, test in iter_splits():
+            if not test.all():
+                clf.partial_fit(x[~test], y[~test])
+
+    r2 = _R2Accumulator()
+    intersection = 0
+    for x, y, test in iter_splits():
+        intersection += len(x)
+        if test.any():
+            r2.update(y[test], clf.predict(x[test]))
+    return r2.score(), intersection
+
+
+def run_regressions(
+        session: Session,
+        collection_ids: Optional[Iterable[int]] = None,
+        models: Sequence[str] = ('linear',),
+        *,
+        min_overlap: int = 2,
+        workers: Optional[int] = None,
+        directory: Optional[str] = None,
+) -> 'pd.DataFrame':
+    """Run regressions in both directions between all pairs of collections on a process pool.
+
+    The pairs sharing fewer than the minimum number of entities are skipped, as counted by
+    :func:`calculate_overlap`. Each remaining pair is aligned once with
+    :func:`embeddingdb.sql.models.load_aligned` and saved to ``.npy`` files that the workers memory-map, so
+    the matrices aren't pickled for every job. Results are stored in the regression results table as they
+    finish, so an interrupted run resumes where it stopped. Regressions that already have results for the
+    current versions of both collections are not run again. Failed regressions are logged and skipped.
+
+    :param session: A database session
+    :param collection_ids: If given, only run regressions between these collections
+    :param models: The shortcut names of the regressions to run for each pair
+    :param min_overlap: The minimum number of entities a pair of collections must share
+    :param workers: The number of worker processes. Defaults to the number of CPUs.
+    :param directory: The directory for the aligned matrices. Defaults to the system's temporary directory.
+    :return: A dataframe of the results for the selected collections and models
+    """
+    import pandas as pd
+
+    models = list(models)
+    regressions = _get_regressions()
+    unknown = set(models).difference(regressions)
+    if unknown:
+        raise ValueError(f'invalid models: {sorted(unknown)}. Should be among {sorted(regressions)}')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if collection_ids is not None:
+        collection_ids = list(collection_ids)
+
+    query = session.query(Collection).filter(is_complete())
+    if collection_ids is not None:
+        query = query.filter(Collection.id.in_(collection_ids))
+    collections = {collection.id: collection for collection in query}
+
+    overlaps = calculate_overlap(session, collection_ids=collection_ids)
+    pairs = [
+        (collection_id_1, collection_id_2)
+        for collection_id_1, collection_id_2, overlap in overlaps[
+            ['collection_id_1', 'collection_id_2', 'overlap']
+        ].itertuples(index=False)
+        if collection_id_1 in collections and collection_id_2 in collections and overlap >= min_overlap
+    ]
+    done = {
+        (result.collection_id_1, result.collection_id_2, result.model)
+        for result in _query_results(session, collections, models)
+        if (result.version_1, result.version_2) == (
+            collections[result.collection_id_1].version, collections[result.collection_id_2].version,
+        )
+    }
+
+    with tempfile.TemporaryDirectory(dir=directory) as temporary_directory, \
+            ProcessPoolExecutor(workers) as executor:
+        pending = {}
+        remaining = {}
+
+        def collect(futures):
+            for future in futures:
+                (collection_id_1, collection_id_2, model), pair_directory, intersection, load_seconds = \
+                    pending.pop(future)
+                try:
+                    r2, fit_seconds = future.result()
+                except Exception:
+                    logger.exception('regression %s from collection %d to %d failed',
+                                     model, collection_id_1, collection_id_2)
+                else:
+                    session.merge(RegressionResult(
+                        collection_id_1=collection_id_1,
+                        collection_id_2=collection_id_2,
+                        model=model,
+                        version_1=collections[collection_id_1].version,
+                        version_2=collections[collection_id_2].version,
+                        r2=r2,
+                        intersection=intersection,
+                        load_seconds=load_seconds,
+                        fit_seconds=fit_seconds,
+                    ))
+                    session.commit()
+                remaining[pair_directory] -= 1
+                if not remaining[pair_directory]:
+                    del remaining[pair_directory]
+                    shutil.rmtree(pair_directory)
+
+        for collection_id_1, collection_id_2 in pairs:
+            jobs = [
+                (x_id, y_id, model)
+                for x_id, y_id in ((collection_id_1, collection_id_2), (collection_id_2, collection_id_1))
+                for model in models
+                if (x_id, y_id, model) not in done
+            ]
+            if not jobs:
+                continue
+
+            start = time.perf_counter()
+            curies, x, y = load_aligned(collections[collection_id_1], collections[collection_id_2])
+            pair_directory = os.path.join(temporary_directory, f'{collection_id_1}-{collection_id_2}')
+            os.makedirs(pair_directory)
+            paths = {
+                collection_id_1: os.path.join(pair_directory, f'{collection_id_1}.npy'),
+                collection_id_2: os.path.join(pair_directory, f'{collection_id_2}.npy'),
+            }
+            np.save(paths[collection_id_1], x)
+            np.save(paths[collection_id_2], y)
+            load_seconds = time.perf_counter() - start
+            del x, y
+
+            remaining[pair_directory] = len(jobs)
+            for job in jobs:
+                x_id, y_id, model = job
+                future = executor.submit(_fit_regression, paths[x_id], paths[y_id], regressions[model])
+                pending[future] = job, pair_directory, len(curies), load_seconds
+
+            # bound the number of aligned pairs waiting on disk
+            while len(remaining) > 2 * workers:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+
+        collect(list(pending))
+
+    results = _query_results(session, collections, models)
+    return pd.DataFrame(
+        [
+            (
+                result.collection_id_1, result.collection_id_2, result.model, result.intersection, result.r2,
+                result.load_seconds, result.fit_seconds,
+            )
+            for result in results
+        ],
+        columns=[
+            'collection_id_1', 'collection_id_2', 'model', 'intersection', 'r2', 'load_seconds', 'fit_seconds',
+        ],
+    )
+
+
+def _query_results(session: Session, collections: Mapping[int, Collection], models: Sequence[str]):
+    """Query the regression results between the given collections with the given models."""
+    return (
+        session.query(RegressionResult)
+        .filter(
+            RegressionResult.collection_id_1.in_(list(collections)),
+            RegressionResult.collection_id_2.in_(list(collections)),
+            RegressionResult.model.in_(models),
+        )
+        .order_by(RegressionResult.collection_id_1, RegressionResult.collection_id_2, RegressionResult.model)
+        .all()
+    )
+
+
+def _fit_regression(x_path: str, y_path: str, regression_cls) -> Tuple[float, float]:
+    """Fit a regression on memory-mapped matrices in a worker process and evaluate it on the same data."""
+    from sklearn.metrics import r2_score
+
+    start = time.perf_counter()
+    x = np.load(x_path, mmap_mode='r')
+    y = np.load(y_path, mmap_mode='r')
+    clf = regression_cls()
+    clf.fit(x, y)
+    r2 = r2_score(y, clf.predict(x))
+    return float(r2), time.perf_counter() - start
 
 
 def _get_collection(session: Session, collection_id: int) -> Collection:
@@ -91,10 +489,26 @@ def _get_collection(session: Session, collection_id: int) -> Collection:
 @click.command()
 @click.argument('id_1', type=int)
 @click.argument('id_2', type=int)
-@click.option('-m', '--model', type=click.Choice(list(_REGRESSIONS)), default='linear')
+@click.option('-m', '--model', type=click.Choice([*_REGRESSIONS, *_STREAMING_REGRESSIONS]), default='linear',
+              help='The regression. least-squares and sgd are fit from chunks of the collections.')
 @click.option('-o', '--output', type=click.File('wb'))
+@click.option('--test-size', type=float, default=0.2, show_default=True,
+              help='The fraction of entities held out for evaluating streaming regressions')
+@click.option('--epochs', type=int, default=1, show_default=True,
+              help='The number of passes over the training set for streaming regressions')
+@click.option('-b', '--batch-size', type=int, default=config.batch_size, show_default=True,
+              help='The number of entities per chunk for streaming regressions')
 @config.get_connection_option()
-def main(id_1: int, id_2: int, model: Optional[str], output: Optional[BinaryIO], connection: str):
+def main(
+        id_1: int,
+        id_2: int,
+        model: Optional[str],
+        output: Optional[BinaryIO],
+        test_size: float,
+        epochs: int,
+        batch_size: int,
+        connection: str,
+):
     """Perform a regression between two collections."""
     session = get_session(connection=connection)
     collection_1 = _get_collection(session, id_1)
@@ -105,12 +519,51 @@ def main(id_1: int, id_2: int, model: Optional[str], output: Optional[BinaryIO],
         collection_2,
         regression_cls=model,
         output=output,
+        test_size=test_size,
+        epochs=epochs,
+        chunk_size=batch_size,
     )
     click.echo(f'Model: {clf}')
-    click.echo(f'Dimensions: {clf.coef_.shape}')
-    click.echo(f'R^2: {r2:.3f}')
+    click.echo(f'Dimensions: {collection_1.dimensions} -> {collection_2.dimensions}')
+    click.echo(f'R^2: {r2:.3f}' + (' (held out)' if model in _STREAMING_REGRESSIONS else ''))
     click.echo(f'Intersection: {intersect} ({intersect_percent:.1%})')
 
 
+@click.command()
+@click.argument('collection_ids', nargs=-1, type=int)
+@click.option('-m', '--model', 'models', type=click.Choice([*_REGRESSIONS, *_STREAMING_REGRESSIONS]),
+              multiple=True, default=['linear'], show_default=True, help='The regressions to run for each pair')
+@click.option('--min-overlap', type=int, default=2, show_default=True,
+              help='Skip pairs sharing fewer than this many entities')
+@click.option('-w', '--workers', type=int, help='The number of worker processes. Defaults to the number of CPUs.')
+@click.option('-d', '--directory', type=click.Path(file_okay=False, dir_okay=True),
+              help='The directory for the aligned matrices')
+@config.get_connection_option()
+def analyze_all(
+        collection_ids: Sequence[int],
+        models: Sequence[str],
+        min_overlap: int,
+        workers: Optional[int],
+        directory: Optional[str],
+        connection: str,
+):
+    """Perform regressions in both directions between all pairs of collections.
+
+    Only the given collections are used, if any are given. Results are stored in the database, so an
+    interrupted run can be resumed by running it again.
+    """
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    session = get_session(connection=connection)
+    df = run_regressions(
+        session,
+        collection_ids=collection_ids or None,
+        models=models,
+        min_overlap=min_overlap,
+        workers=workers,
+        directory=directory,
+    )
+    click.echo(df.to_csv(sep='\t', index=False, float_format='%.4f'), nl=False)
+
+
 if __name__ == '__main__':
     main()
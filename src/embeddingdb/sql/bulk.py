@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+
+"""Bulk loading of embeddings into the relational database.
+
+Rather than building one ORM :class:`Embedding` per vector, rows are written in fixed-size batches
+with SQLAlchemy Core's ``executemany`` or, on PostgreSQL with :mod:`psycopg2`, with ``COPY FROM STDIN``.
+Each batch is committed on its own so memory use does not grow with the size of the collection.
+
+The CURIEs in each batch are resolved to the identifiers of their entities with a few bulk queries,
+inserting the entities that don't exist yet.
+
+The time spent parsing, resolving, encoding, writing, and committing each batch is recorded in
+:data:`embeddingdb.metrics.INGEST_SECONDS`.
+"""
+
+import io
+import os
+import uuid
+from itertools import islice
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, Table, and_, column, exists, table, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.orm import Session
+
+from .manage import delete_collection
+from .models import Checkpoint, Collection, Embedding, Entity, get_entity_ids, new_version
+from .partitions import create_partition, create_replacement_partition, get_partition_name, index_partition
+from .types import encode_vectors
+from ..constants import config
+from ..metrics import INGEST_ROWS, INGEST_SECONDS, timer
+
+__all__ = [
+    'iter_batches',
+    'bulk_insert_embeddings',
+    'bulk_insert_chunks',
+    'upsert_chunks',
+    'resolve_entities',
+    'get_source',
+    'get_checkpoint',
+    'skip_rows',
+]
+
+#: A pair of a CURIE and its vector
+Row = Tuple[str, Sequence[float]]
+
+#: A sequence of CURIEs and a sequence (or matrix) of their vectors
+Chunk = Tuple[Sequence[str], Sequence[Sequence[float]]]
+
+
+def iter_batches(it: Iterable[Row], batch_size: int) -> Iterable[List[Row]]:
+    """Split an iterable into lists of at most the given size."""
+    it = iter(it)
+    while True:
+        batch = list(islice(it, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def bulk_insert_embeddings(
+        session: Session,
+        collection: Collection,
+        rows: Iterable[Row],
+        *,
+        batch_size: Optional[int] = None,
+        use_copy: Optional[bool] = None,
+        dtype: Optional[str] = None,
+) -> int:
+    """Insert the embeddings for a collection in batches, committing after each one.
+
+    :param session: A database session
+    :param collection: The collection the embeddings belong to. It is committed first if it is new.
+    :param rows: An iterable of pairs of CURIEs and vectors
+    :param batch_size: The number of rows written per batch. Defaults to :data:`Config.batch_size`.
+    :param use_copy: Should PostgreSQL's ``COPY FROM STDIN`` be used? Defaults to using it when it is available.
+    :param dtype: The data type vectors are stored with. Defaults to :data:`Config.vector_dtype`.
+    :return: The number of rows inserted
+    """
+    if batch_size is None:
+        batch_size = config.batch_size
+    chunks = (
+        tuple(zip(*batch))
+        for batch in iter_batches(rows, batch_size)
+    )
+    return bulk_insert_chunks(session, collection, chunks, use_copy=use_copy, dtype=dtype)
+
+
+def bulk_insert_chunks(
+        session: Session,
+        collection: Collection,
+        chunks: Iterable[Chunk],
+        *,
+        use_copy: Optional[bool] = None,
+        dtype: Optional[str] = None,
+        source: Optional[str] = None,
+        replace: Optional[int] = None,
+) -> int:
+    """Insert pre-batched embeddings for a collection, committing after each chunk.
+
+    This is the entrypoint for the chunked parsers in :mod:`embeddingdb.parsers`, whose chunks are
+    written as they are without being split into rows first. If a chunk has several vectors for the same
+    CURIE, the last one is kept.
+
+    A new collection is committed with a :class:`embeddingdb.sql.models.Checkpoint` counting the rows written
+    so far, which is committed along with each chunk and removed once all chunks are written. Until then,
+    the collection is hidden from queries (see :func:`embeddingdb.sql.models.is_complete`). If a source is
+    given, an interrupted upload can be resumed by passing the collection from :func:`get_checkpoint` and
+    chunks that skip the rows already written, e.g., with :func:`skip_rows`. Otherwise, a new collection is
+    deleted if the upload fails.
+
+    :param session: A database session
+    :param collection: The collection the embeddings belong to. It is committed first if it is new, and its
+     version is changed once all chunks are written.
+    :param chunks: An iterable of pairs of CURIEs and their vectors
+    :param use_copy: Should PostgreSQL's ``COPY FROM STDIN`` be used? Defaults to using it when it is available.
+    :param dtype: The data type vectors are stored with. Defaults to :data:`Config.vector_dtype`.
+    :param source: Identifies the uploaded data for checkpointing, e.g., from :func:`get_source`
+    :param replace: The identifier of a collection this one will replace with
+     :func:`embeddingdb.sql.manage.replace_collection`. If the embedding table is partitioned, the rows are
+     written to a detached partition labeled with that collection, so it can be swapped in without rewriting them.
+    :return: The number of rows inserted
+    """
+    if use_copy is None:
+        use_copy = _supports_copy(session)
+
+    # a new collection is committed with a checkpoint, which hides it from queries until the upload completes
+    is_new = collection.id is None
+    if is_new:
+        session.add(collection)
+        session.flush()
+    collection_id = collection.id
+    checkpoint = session.query(Checkpoint).get(collection_id)
+    if checkpoint is None and (is_new or source is not None):
+        checkpoint = Checkpoint(collection_id=collection_id, source=source or '', rows=0)
+        session.add(checkpoint)
+    session.commit()
+
+    try:
+        total = _insert_chunks(
+            session, collection_id, chunks, checkpoint, use_copy=use_copy, dtype=dtype, replace=replace,
+        )
+    except BaseException:
+        # an upload that can't be resumed is rolled back rather than leaving a partial collection behind
+        if is_new and source is None:
+            session.rollback()
+            delete_collection(session, collection_id)
+        raise
+
+    if checkpoint is not None:
+        session.delete(checkpoint)
+    collection.version = new_version()
+    session.commit()
+    return total
+
+
+def _insert_chunks(
+        session: Session,
+        collection_id: int,
+        chunks: Iterable[Chunk],
+        checkpoint: Optional[Checkpoint],
+        *,
+        use_copy: bool,
+        dtype: Optional[str],
+        replace: Optional[int],
+) -> int:
+    # on a partitioned table, rows are written straight to the collection's partition or, for a replacement,
+    # to a detached partition whose rows are already labeled with the collection it replaces
+    table_name, label = Embedding.__tablename__, collection_id
+    if replace is not None and create_replacement_partition(session, collection_id, replace):
+        session.commit()
+        table_name, label = get_partition_name(collection_id), replace
+    elif create_partition(session, collection_id):
+        session.commit()
+        table_name = get_partition_name(collection_id)
+
+    write = _copy_batch if use_copy else _insert_batch
+    total = 0
+    for curies, vectors in _time_chunks(chunks):
+        # the checkpoint counts the rows read, so resuming skips the right number of them
+        rows = len(curies)
+        curies, vectors = _drop_duplicates(curies, vectors)
+        with timer(INGEST_SECONDS, stage='resolve'):
+            entity_ids = resolve_entities(session, curies)
+        with timer(INGEST_SECONDS, stage='encode'):
+            encoded = encode_vectors(vectors, dtype=dtype)
+        with timer(INGEST_SECONDS, stage='write'):
+            write(session, table_name, label, entity_ids, encoded)
+        if checkpoint is not None:
+            checkpoint.rows += rows
+        with timer(INGEST_SECONDS, stage='commit'):
+            session.commit()
+        _count_rows(len(curies))
+        total += len(curies)
+
+    index_partition(session, collection_id)
+    return total
+
+
+def upsert_chunks(
+        session: Session,
+        collection: Collection,
+        chunks: Iterable[Chunk],
+        *,
+        dtype: Optional[str] = None,
+        remove_missing: bool = False,
+) -> Tuple[int, int]:
+    """Insert or update the embeddings of an existing collection, committing after each chunk.
+
+    Each chunk is written with ``INSERT ... ON CONFLICT DO UPDATE`` against the unique constraint on the
+    collection and entity, and vectors are only rewritten when they changed. If a chunk has several vectors
+    for the same CURIE, the last one is kept.
+
+    To remove the missing embeddings, the entities that were seen are written to a scratch table along with
+    each chunk, then the other embeddings are deleted with a single anti-join. It is a regular table rather
+    than a temporary one, since the session can use a different connection after each commit, and it is
+    dropped afterwards.
+
+    :param session: A database session
+    :param collection: An existing collection. Its version is changed once all chunks are written.
+    :param chunks: An iterable of pairs of CURIEs and their vectors
+    :param dtype: The data type vectors are stored with. Defaults to :data:`Config.vector_dtype`.
+    :param remove_missing: Should the embeddings for entities that weren't in any of the chunks be deleted?
+    :return: The number of rows written and the number of rows deleted
+    """
+    collection_id = collection.id
+    # ON CONFLICT needs the unique index of the collection's partition, which might not be built yet
+    partitioned = index_partition(session, collection_id)
+    if partitioned:
+        # a partition's unique index is on the entity alone, since it only holds one collection
+        table_name, conflict = get_partition_name(collection_id), 'entity_id'
+    else:
+        table_name, conflict = Embedding.__tablename__, 'collection_id, entity_id'
+    statement = text(
+        f'INSERT INTO {table_name} (collection_id, entity_id, vector)'
+        f' VALUES (:collection_id, :entity_id, :vector)'
+        f' ON CONFLICT ({conflict}) DO UPDATE SET vector = excluded.vector'
+        f' WHERE {table_name}.vector <> excluded.vector'
+    )
+
+    seen = _create_seen_table(session) if remove_missing else None
+    total = removed = 0
+    try:
+        for curies, vectors in _time_chunks(chunks):
+            curies, vectors = _drop_duplicates(curies, vectors)
+            with timer(INGEST_SECONDS, stage='resolve'):
+                entity_ids = resolve_entities(session, curies)
+            with timer(INGEST_SECONDS, stage='encode'):
+                encoded = encode_vectors(vectors, dtype=dtype)
+            with timer(INGEST_SECONDS, stage='write'):
+                session.execute(statement, [
+                    dict(collection_id=collection_id, entity_id=entity_id, vector=vector)
+                    for entity_id, vector in zip(entity_ids, encoded)
+                ])
+                if seen is not None:
+                    session.execute(seen.insert(), [dict(entity_id=entity_id) for entity_id in entity_ids])
+            with timer(INGEST_SECONDS, stage='commit'):
+                session.commit()
+            _count_rows(len(curies))
+            total += len(curies)
+
+        if seen is not None:
+            embeddings = Embedding.__table__
+            removed = session.execute(embeddings.delete().where(and_(
+                embeddings.c.collection_id == collection_id,
+                ~exists().where(seen.c.entity_id == embeddings.c.entity_id),
+            ))).rowcount
+
+        collection.version = new_version()
+        session.commit()
+    finally:
+        if seen is not None:
+            session.rollback()
+            seen.drop(session.get_bind())
+    return total, removed
+
+
+def _create_seen_table(session: Session) -> Table:
+    """Create a scratch table for the identifiers of the entities written by :func:`upsert_chunks`."""
+    seen = Table(
+        f'{Embedding.__tablename__}_seen_{uuid.uuid4().hex}',
+        MetaData(),
+        Column('entity_id', Integer, nullable=False, index=True),
+    )
+    seen.create(session.get_bind())
+    return seen
+
+
+def _drop_duplicates(curies: Sequence[str], vectors: Sequence[Sequence[float]]) -> Chunk:
+    """Keep only the last vector of each CURIE in a chunk, since an embedding can't be written twice."""
+    positions = {curie: position for position, curie in enumerate(curies)}
+    if len(positions) == len(curies):
+        return curies, vectors
+    positions = sorted(positions.values())
+    return [curies[position] for position in positions], [vectors[position] for position in positions]
+
+
+def get_source(path: str) -> str:
+    """Identify a file for checkpointing by its absolute path, size, and modification time."""
+    stat = os.stat(path)
+    return f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def get_checkpoint(session: Session, source: str) -> Optional[Checkpoint]:
+    """Get the checkpoint of the most recent interrupted upload of the given source, if there is one."""
+    return (
+        session.query(Checkpoint)
+        .filter(Checkpoint.source == source)
+        .order_by(Checkpoint.collection_id.desc())
+        .first()
+    )
+
+
+def skip_rows(chunks: Iterable[Chunk], rows: int) -> Iterable[Chunk]:
+    """Skip the given number of rows from the start of an iterable of chunks."""
+    for curies, vectors in chunks:
+        if rows >= len(curies):
+            rows -= len(curies)
+            continue
+        if rows:
+            curies, vectors = curies[rows:], vectors[rows:]
+            rows = 0
+        yield curies, vectors
+
+
+def _time_chunks(chunks: Iterable[Chunk]) -> Iterable[Chunk]:
+    """Record the time spent producing each chunk, which is mostly spent parsing, as the ``parse`` stage."""
+    chunks = iter(chunks)
+    while True:
+        with timer(INGEST_SECONDS, stage='parse'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _count_rows(rows: int) -> None:
+    if config.metrics:
+        INGEST_ROWS.inc(rows)
+
+
+def resolve_entities(session: Session, curies: Sequence[str]) -> List[int]:
+    """Get the identifiers of the entities with the given CURIEs, inserting the ones that don't exist yet.
+
+    Missing entities are inserted while ignoring conflicts, so concurrent uploads that share entities
+    don't fail.
+
+    :param session: A database session
+    :param curies: A sequence of CURIEs
+    :return: The identifiers of the entities, in the same order as the CURIEs
+    """
+    entity_ids = get_entity_ids(session, curies)
+    missing = sorted(set(curies).difference(entity_ids))
+    if missing:
+        session.execute(_insert_ignore_entities(session), [dict(curie=curie) for curie in missing])
+        entity_ids.update(get_entity_ids(session, missing))
+    return [entity_ids[curie] for curie in curies]
+
+
+def _insert_ignore_entities(session: Session):
+    """Build an insert into the entity table that skips CURIEs that already exist, where supported."""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql_insert(Entity.__table__).on_conflict_do_nothing(index_elements=['curie'])
+    if dialect == 'sqlite':
+        return Entity.__table__.insert().prefix_with('OR IGNORE')
+    return Entity.__table__.insert()
+
+
+def _supports_copy(session: Session) -> bool:
+    """Check if the session is bound to a PostgreSQL database through :mod:`psycopg2`."""
+    dialect = session.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+def _insert_batch(
+        session: Session,
+        table_name: str,
+        collection_id: int,
+        entity_ids: Sequence[int],
+        vectors: Sequence[bytes],
+) -> None:
+    """Write a batch with Core ``executemany``."""
+    session.execute(
+        table(table_name, column('collection_id'), column('entity_id'), column('vector')).insert(),
+        [
+            dict(collection_id=collection_id, entity_id=entity_id, vector=vector)
+            for entity_id, vector in zip(entity_ids, vectors)
+        ],
+    )
+
+
+def _copy_batch(
+        session: Session,
+        table_name: str,
+        collection_id: int,
+        entity_ids: Sequence[int],
+        vectors: Sequence[bytes],
+) -> None:
+    """Write a batch with PostgreSQL's ``COPY FROM STDIN`` in the text format.
+
+    The packed vectors are written in ``bytea``'s hex format, whose leading backslash is escaped for ``COPY``.
+    """
+    buffer = io.StringIO()
+    for entity_id, vector in zip(entity_ids, vectors):
+        buffer.write(f'{collection_id}\t{entity_id}\t\\\\x{vector.hex()}\n')
+    buffer.seek(0)
+
+    dbapi_connection = session.connection().connection
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {table_name} (collection_id, entity_id, vector) FROM STDIN',
+            buffer,
+        )
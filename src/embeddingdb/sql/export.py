@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""Streaming export of collections.
+
+A collection is read in chunks ordered by CURIE through a server-side cursor (see
+:func:`embeddingdb.sql.models.iter_vector_chunks`) and serialized one chunk at a time, so it is never held
+in memory at once. The supported formats are:
+
+- ``ndjson``: one JSON object with a ``curie`` and a ``vector`` per line
+- ``word2vec``: the ``word2vec`` text format
+- ``npy``: a float32 matrix in NumPy's ``.npy`` format, whose rows are labeled by the ``curies`` format
+- ``curies``: the CURIEs labeling the rows of the ``npy`` format, one per line
+- ``arrow`` and ``parquet``: a table with a string ``curie`` column and a fixed size list ``vector`` column
+  in the Arrow IPC stream format or in Parquet, with the collection's metadata stored in the schema.
+  These require :mod:`pyarrow` and can be uploaded again with ``embeddingdb upload --fmt arrow`` or
+  ``--fmt parquet``.
+"""
+
+import io
+import json
+import os
+import sys
+import zlib
+from typing import Any, Dict, Iterable, List, Optional
+
+import click
+import numpy as np
+
+from .models import Collection, get_session
+from ..constants import config
+from ..parsers import ARROW_METADATA_KEY, Chunk
+
+__all__ = [
+    'EXPORT_FORMATS',
+    'EXPORT_MIMETYPES',
+    'iter_export',
+    'iter_gzip',
+    'get_collection_metadata',
+    'serialize_word2vec',
+    'serialize_arrow',
+    'main',
+]
+
+#: The formats collections can be exported in
+EXPORT_FORMATS = ('ndjson', 'word2vec', 'npy', 'curies', 'arrow', 'parquet')
+
+#: The media types of the export formats
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'word2vec': 'text/plain',
+    'npy': 'application/octet-stream',
+    'curies': 'text/plain',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+#: The format of a float32 that is parsed back to the same value
+_FLOAT_FORMAT = '%.9g'
+
+
+def iter_export(collection: Collection, fmt: str, chunk_size: Optional[int] = None) -> Iterable[bytes]:
+    """Serialize a collection in the given format, one chunk of embeddings at a time.
+
+    :param collection: A collection
+    :param fmt: One of :data:`EXPORT_FORMATS`
+    :param chunk_size: The number of embeddings read and serialized at a time. Defaults to
+     :data:`Config.batch_size`.
+    :raises ValueError: If the format is not supported or the collection changes while it's exported
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'invalid format: {fmt}. Should be one of {EXPORT_FORMATS}')
+    chunks = collection.iter_chunks(chunk_size=chunk_size)
+    if fmt == 'ndjson':
+        return _iter_ndjson(chunks, collection.dimensions)
+    if fmt == 'word2vec':
+        return serialize_word2vec(chunks, collection.count_embeddings(), collection.dimensions)
+    if fmt == 'npy':
+        return _iter_npy(chunks, collection.count_embeddings(), collection.dimensions)
+    if fmt == 'curies':
+        return _iter_curies(chunks)
+    return serialize_arrow(chunks, get_collection_metadata(collection), parquet=(fmt == 'parquet'))
+
+
+def get_collection_metadata(collection: Collection) -> Dict[str, Any]:
+    """Get the metadata of a collection that is stored in exported Arrow and Parquet files."""
+    return {
+        'dimensions': collection.dimensions,
+        'package_name': collection.package_name,
+        'package_version': collection.package_version,
+        'extras': collection.extras or {},
+    }
+
+
+def iter_gzip(chunks: Iterable[bytes], level: int = 6) -> Iterable[bytes]:
+    """Compress a stream of bytes in the gzip format as it's produced."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _iter_ndjson(chunks: Iterable[Chunk], dimensions: int) -> Iterable[bytes]:
+    row_format = '{"curie": %s, "vector": [' + ', '.join([_FLOAT_FORMAT] * dimensions) + ']}\n'
+    for curies, vectors in chunks:
+        yield ''.join(
+            row_format % (json.dumps(curie), *vector)
+            for curie, vector in zip(curies, vectors.tolist())
+        ).encode('utf-8')
+
+
+def serialize_word2vec(chunks: Iterable[Chunk], rows: int, dimensions: int) -> Iterable[bytes]:
+    """Serialize chunks of embeddings in the ``word2vec`` text format.
+
+    :param chunks: Pairs of CURIEs and their vectors
+    :param rows: The total number of embeddings, which is written in the header
+    :param dimensions: The number of dimensions of the vectors
+    :raises ValueError: If the chunks don't have the given number of embeddings
+    """
+    yield f'{rows} {dimensions}\n'.encode('utf-8')
+    row_format = '%s ' + ' '.join([_FLOAT_FORMAT] * dimensions) + '\n'
+    total = 0
+    for curies, vectors in chunks:
+        yield ''.join(
+            row_format % (curie, *vector)
+            for curie, vector in zip(curies, vectors.tolist())
+        ).encode('utf-8')
+        total += len(curies)
+    _check_rows(total, rows)
+
+
+def _iter_npy(chunks: Iterable[Chunk], rows: int, dimensions: int) -> Iterable[bytes]:
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        'descr': '<f4',
+        'fortran_order': False,
+        'shape': (rows, dimensions),
+    })
+    yield header.getvalue()
+    total = 0
+    for curies, vectors in chunks:
+        yield vectors.astype('<f4', copy=False).tobytes()
+        total += len(curies)
+    _check_rows(total, rows)
+
+
+def _iter_curies(chunks: Iterable[Chunk]) -> Iterable[bytes]:
+    for curies, _ in chunks:
+        yield ''.join(f'{curie}\n' for curie in curies).encode('utf-8')
+
+
+def _check_rows(total: int, rows: int) -> None:
+    # the header promised a number of rows, so the output is corrupt if the collection changed since
+    if total != rows:
+        raise ValueError(f'expected {rows} embeddings but exported {total}. The collection changed.')
+
+
+class _Sink:
+    """A writable file-like object whose contents are taken out as they're written."""
+
+    def __init__(self) -> None:
+        self.buffers: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.buffers.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def take(self) -> bytes:
+        rv = b''.join(self.buffers)
+        self.buffers.clear()
+        return rv
+
+
+def serialize_arrow(chunks: Iterable[Chunk], metadata: Dict[str, Any], parquet: bool = False) -> Iterable[bytes]:
+    """Serialize chunks of embeddings as a table in the Arrow IPC stream format or in Parquet.
+
+    :param chunks: Pairs of CURIEs and their vectors
+    :param metadata: The metadata stored in the schema, like from :func:`get_collection_metadata`. It must
+     have the ``dimensions`` of the vectors.
+    :param parquet: Should the table be written in Parquet?
+    """
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [
+            pa.field('curie', pa.string(), nullable=False),
+            pa.field('vector', pa.list_(pa.float32(), metadata['dimensions']), nullable=False),
+        ],
+        metadata={ARROW_METADATA_KEY: json.dumps(metadata)},
+    )
+    sink = _Sink()
+    if parquet:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+
+    for curies, vectors in chunks:
+        vector_column = pa.FixedSizeListArray.from_arrays(
+            pa.array(vectors.reshape(-1), type=pa.float32()),
+            metadata['dimensions'],
+        )
+        writer.write_batch(pa.record_batch([pa.array(curies, type=pa.string()), vector_column], schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+@click.command()
+@click.argument('collection_id', type=int)
+@click.option('-f', '--fmt', type=click.Choice(EXPORT_FORMATS), default='ndjson', show_default=True)
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default='-', show_default=True,
+              help='The output file. Compressed with gzip if it ends with .gz. For the npy format, the CURIEs '
+                   'are written next to it with the extension .curies.txt')
+@click.option('-b', '--batch-size', type=int, default=config.batch_size, show_default=True,
+              help='Number of embeddings read from the database at a time')
+@config.get_connection_option()
+def main(collection_id: int, fmt: str, output: str, batch_size: int, connection: str):
+    """Download a collection."""
+    session = get_session(connection)
+    collection = session.query(Collection).get(collection_id)
+    if collection is None:
+        raise click.ClickException(f'collection {collection_id} does not exist')
+    _write(iter_export(collection, fmt, chunk_size=batch_size), output)
+    if fmt == 'npy' and output != '-':
+        curies_path = os.path.splitext(output)[0] + '.curies.txt'
+        _write(iter_export(collection, 'curies', chunk_size=batch_size), curies_path)
+        click.echo(f'Wrote the CURIEs labeling the rows to {curies_path}', err=True)
+
+
+def _write(data: Iterable[bytes], output: str) -> None:
+    if output.endswith('.gz'):
+        data = iter_gzip(data)
+    if output == '-':
+        for chunk in data:
+            sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+        return
+    with open(output, 'wb') as file:
+        for chunk in data:
+            file.write(chunk)
@@ -6,37 +6,56 @@ import json
 import os
 import random
 import sys
-from typing import Any, Iterable, Mapping, Optional, Tuple, Union
+from functools import partial
+from typing import Any, Iterable, Mapping, Optional, TYPE_CHECKING, Union
 
 import click
-from gensim.models import Word2Vec
 from sqlalchemy.orm import Session
-from tqdm import tqdm, trange
 
-from .models import Collection, Embedding, get_session
+from .bulk import bulk_insert_chunks, get_checkpoint, get_source, skip_rows, upsert_chunks
+from .manage import replace_collection
+from .models import Collection, create_all, get_session
 from ..constants import config
+from ..parsers import (
+    Chunk, DEFAULT_CHUNK_SIZE, is_word2vec_binary, iter_arrow_chunks, iter_pykeen_chunks, iter_word2vec_binary_chunks,
+    iter_word2vec_text_chunks_parallel, read_arrow_metadata, read_word2vec_header,
+)
+from ..synthetic import DISTRIBUTIONS, get_curie_offset, iter_synthetic_chunks
+
+if TYPE_CHECKING:
+    from gensim.models import KeyedVectors, Word2Vec
 
 __all__ = [
     'upload_word2vec',
+    'iter_gensim_chunks',
     'upload_pykeen_from_directory',
     'upload_word2vec_embedding_file',
+    'upload_arrow_file',
     'main',
 ]
 
 
 def upload_word2vec(
-        model: Union[str, Word2Vec],
+        model: Union[str, 'Word2Vec'],
         *,
         package_name: str,
         package_version: str,
         extras: Optional[Mapping[str, Any]] = None,
         session: Optional[Session] = None,
         use_tqdm: bool = True,
+        batch_size: Optional[int] = None,
+        replace: Optional[int] = None,
 ) -> Collection:
+    """Load a gensim word2vec model into the database.
+
+    :param replace: The identifier of a collection the new one will replace with
+     :func:`embeddingdb.sql.manage.replace_collection`. Its embeddings are then written to be swapped in at once.
+    """
     if session is None:
         session = get_session()
 
     if isinstance(model, str):
+        from gensim.models import Word2Vec
         model = Word2Vec.load(model)
 
     collection = Collection(
@@ -46,22 +65,28 @@ def upload_word2vec(
         extras=extras,
     )
 
-    it = model.wv.vocab
+    chunks = iter_gensim_chunks(model, chunk_size=batch_size or config.batch_size)
     if use_tqdm:
-        it = tqdm(it, desc='Building SQLAlchemy models')
-    for curie in it:
-        vector = model.wv[curie]
-        embedding = Embedding(
-            collection=collection,
-            curie=curie,
-            vector=[float(x) for x in vector],
-        )
-        session.add(embedding)
-    session.add(collection)
-    session.commit()
+        chunks = _tqdm_chunks(chunks, total=len(getattr(model, 'wv', model).vectors))
+    bulk_insert_chunks(session, collection, chunks, replace=replace)
     return collection
 
 
+def iter_gensim_chunks(model: Union['Word2Vec', 'KeyedVectors'], chunk_size: Optional[int] = None) -> Iterable[Chunk]:
+    """Iterate over chunks of a gensim model's words by slicing its matrix of vectors.
+
+    :param model: A gensim model with word vectors or its :class:`gensim.models.KeyedVectors`. Both the
+     ``index_to_key`` attribute of gensim 4 and the ``index2word`` attribute of gensim 3 are supported.
+    :param chunk_size: The number of words per chunk
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+    wv = getattr(model, 'wv', model)
+    words = wv.index_to_key if hasattr(wv, 'index_to_key') else wv.index2word
+    for start in range(0, len(words), chunk_size):
+        yield list(words[start:start + chunk_size]), wv.vectors[start:start + chunk_size]
+
+
 def upload_word2vec_embedding_file(
         path: str,
         *,
@@ -69,43 +94,74 @@ def upload_word2vec_embedding_file(
         package_version: str,
         extras: Optional[Mapping[str, Any]] = None,
         session: Optional[Session] = None,
+        batch_size: Optional[int] = None,
+        binary: Optional[bool] = None,
+        resume: bool = False,
+        update: Optional[int] = None,
+        remove_missing: bool = False,
+        replace: Optional[int] = None,
+        workers: Optional[int] = None,
 ) -> Collection:
-    """Load a word2vec file into the database."""
+    """Load a word2vec file into the database.
+
+    Text files are parsed by a pool of worker processes while the embeddings parsed so far are written,
+    see :func:`embeddingdb.parsers.iter_word2vec_text_chunks_parallel`.
+
+    :param binary: Is the file in the word2vec binary format? Defaults to guessing from the ``.bin`` extension.
+    :param resume: Should an interrupted upload of the same file be resumed from its last committed batch?
+    :param update: The identifier of an existing collection to update instead of creating a new one. Only the
+     embeddings that are new or changed are written.
+    :param remove_missing: When updating a collection, should the embeddings for entities that aren't in the
+     file be deleted?
+    :param replace: The identifier of a collection the new one will replace with
+     :func:`embeddingdb.sql.manage.replace_collection`. Its embeddings are then written to be swapped in at once.
+    :param workers: The number of processes parsing a text file. Defaults to the number of CPUs.
+    """
     if session is None:
         session = get_session()
+    if batch_size is None:
+        batch_size = config.batch_size
+    if binary is None:
+        binary = is_word2vec_binary(path)
 
-    with open(path) as file:
-        it = _spliterate(file)
-        rows, dimensions = map(int, next(it))
+    with open(path, 'rb') as file:
+        rows, dimensions = read_word2vec_header(file.readline().decode('utf-8'))
         collection = Collection(
             dimensions=dimensions,
             package_name=package_name,
             package_version=package_version,
             extras=extras,
         )
-        for curie, *vector in tqdm(it, total=rows, desc='Building SQLAlchemy models'):
-            embedding = Embedding(
-                collection=collection,
-                curie=curie,
-                vector=[float(x) for x in vector],
-            )
-            session.add(embedding)
-    session.add(collection)
-    session.commit()
-    return collection
-
-
-def _spliterate(it: Iterable[str]) -> Iterable[Tuple[str, ...]]:
-    for line in it:
-        yield line.strip().split()
+        if binary:
+            chunks = iter_word2vec_binary_chunks(file, dimensions, chunk_size=batch_size)
+        else:
+            chunks = iter_word2vec_text_chunks_parallel(file, dimensions, chunk_size=batch_size, workers=workers)
+        return _upload_chunks(
+            session, collection, chunks, source=get_source(path), total=rows, resume=resume, update=update,
+            remove_missing=remove_missing, replace=replace,
+        )
 
 
 def upload_pykeen_from_directory(
         directory,
         *,
         session: Optional[Session] = None,
+        batch_size: Optional[int] = None,
+        resume: bool = False,
+        update: Optional[int] = None,
+        remove_missing: bool = False,
+        replace: Optional[int] = None,
 ) -> Collection:
-    """Load a PyKEEN output into the database."""
+    """Load a PyKEEN output into the database.
+
+    :param resume: Should an interrupted upload of the same output be resumed from its last committed batch?
+    :param update: The identifier of an existing collection to update instead of creating a new one. Only the
+     embeddings that are new or changed are written.
+    :param remove_missing: When updating a collection, should the embeddings for entities that aren't in the
+     output be deleted?
+    :param replace: The identifier of a collection the new one will replace with
+     :func:`embeddingdb.sql.manage.replace_collection`. Its embeddings are then written to be swapped in at once.
+    """
     if session is None:
         session = get_session()
 
@@ -123,63 +179,227 @@ def upload_pykeen_from_directory(
     )
 
     with open(embedding_path) as file:
-        embeddings = json.load(file)
-
-    for curie, vector in tqdm(embeddings.items()):
-        embedding = Embedding(
-            collection=collection,
-            curie=curie,
-            vector=vector,
+        chunks = iter_pykeen_chunks(file, collection.dimensions, chunk_size=batch_size or config.batch_size)
+        return _upload_chunks(
+            session, collection, chunks, source=get_source(embedding_path), resume=resume, update=update,
+            remove_missing=remove_missing, replace=replace,
         )
-        session.add(embedding)
-    session.add(collection)
-    session.commit()
-    return collection
+
+
+def upload_arrow_file(
+        path: str,
+        *,
+        package_name: Optional[str] = None,
+        package_version: Optional[str] = None,
+        extras: Optional[Mapping[str, Any]] = None,
+        session: Optional[Session] = None,
+        batch_size: Optional[int] = None,
+        resume: bool = False,
+        update: Optional[int] = None,
+        remove_missing: bool = False,
+        replace: Optional[int] = None,
+) -> Collection:
+    """Load an Arrow or Parquet file, like the ones written by ``embeddingdb download``, into the database.
+
+    The file needs a ``curie`` column and a ``vector`` column of lists of numbers. The metadata of the
+    collection it was exported from is used unless it's given.
+
+    :param resume: Should an interrupted upload of the same file be resumed from its last committed batch?
+    :param update: The identifier of an existing collection to update instead of creating a new one. Only the
+     embeddings that are new or changed are written.
+    :param remove_missing: When updating a collection, should the embeddings for entities that aren't in the
+     file be deleted?
+    :param replace: The identifier of a collection the new one will replace with
+     :func:`embeddingdb.sql.manage.replace_collection`. Its embeddings are then written to be swapped in at once.
+    """
+    if session is None:
+        session = get_session()
+
+    metadata = read_arrow_metadata(path)
+    if 'dimensions' not in metadata:
+        raise ValueError(f'the vectors in {path} should have a fixed size')
+    collection = Collection(
+        dimensions=metadata['dimensions'],
+        package_name=package_name if package_name is not None else metadata.get('package_name'),
+        package_version=package_version if package_version is not None else metadata.get('package_version'),
+        extras=extras if extras is not None else metadata.get('extras'),
+    )
+    if collection.package_name is None or collection.package_version is None:
+        raise ValueError(f'{path} has no package name and version, so they must be given')
+
+    chunks = iter_arrow_chunks(path, collection.dimensions, chunk_size=batch_size or config.batch_size)
+    return _upload_chunks(
+        session, collection, chunks, source=get_source(path), resume=resume, update=update,
+        remove_missing=remove_missing, replace=replace,
+    )
+
+
+def _upload_chunks(
+        session: Session,
+        collection: Collection,
+        chunks: Iterable[Chunk],
+        *,
+        source: str,
+        total: Optional[int] = None,
+        resume: bool = False,
+        update: Optional[int] = None,
+        remove_missing: bool = False,
+        replace: Optional[int] = None,
+) -> Collection:
+    """Upload chunks into a new collection, resume an interrupted upload, or update an existing collection."""
+    if update is not None:
+        existing = session.query(Collection).get(update)
+        if existing is None:
+            raise KeyError(update)
+        if existing.dimensions != collection.dimensions:
+            raise ValueError(f'collection {update} has {existing.dimensions} dimensions, not {collection.dimensions}')
+        existing.package_name = collection.package_name
+        existing.package_version = collection.package_version
+        existing.extras = collection.extras
+        upsert_chunks(session, existing, _tqdm_chunks(chunks, total=total), remove_missing=remove_missing)
+        return existing
+
+    checkpoint = get_checkpoint(session, source) if resume else None
+    if checkpoint is None:
+        bulk_insert_chunks(session, collection, _tqdm_chunks(chunks, total=total), source=source, replace=replace)
+        return collection
+
+    chunks = skip_rows(chunks, checkpoint.rows)
+    bulk_insert_chunks(
+        session, checkpoint.collection, _tqdm_chunks(chunks, total=total, initial=checkpoint.rows), source=source,
+        replace=replace,
+    )
+    return checkpoint.collection
+
+
+def _tqdm_chunks(
+        chunks: Iterable[Chunk],
+        total: Optional[int] = None,
+        initial: int = 0,
+        **kwargs,
+) -> Iterable[Chunk]:
+    """Report the progress of iterating over chunks by the number of entities in each."""
+    from tqdm import tqdm
+
+    kwargs.setdefault('desc', 'Uploading embeddings')
+    with tqdm(total=total, initial=initial, unit='embedding', **kwargs) as progress:
+        for chunk in chunks:
+            yield chunk
+            progress.update(len(chunk[0]))
 
 
 def load_random(
         *,
+        rows: int = 500,
         dimensions: Optional[int] = None,
+        distribution: str = 'exponential',
+        offset: int = 0,
+        seed: Optional[int] = None,
         session: Optional[Session] = None,
         tqdm_kwargs: Optional[Mapping[str, Any]] = None,
+        batch_size: Optional[int] = None,
 ) -> Collection:
+    """Load a collection of random embeddings into the database.
+
+    The vectors are generated in blocks by :func:`embeddingdb.synthetic.iter_synthetic_chunks` and written
+    as they're generated.
+
+    :param rows: The number of embeddings
+    :param dimensions: The number of dimensions. Defaults to a random multiple of 12 between 36 and 96.
+    :param distribution: One of :data:`embeddingdb.synthetic.DISTRIBUTIONS`
+    :param offset: The number of the first CURIE, like ``test:<offset>``
+    :param seed: The seed of the random number generator
+    """
     if session is None:
         session = get_session()
-
-    lamb = random.randint(1, 5)
-    dimensions = dimensions if dimensions is not None else 12 * random.randint(3, 8)
+    if dimensions is None:
+        dimensions = 12 * random.Random(seed).randint(3, 8)
 
     collection = Collection(
         dimensions=dimensions,
         package_name='test',
         package_version='0.0.0',
         extras={
-            'lamb': lamb,
+            'distribution': distribution,
+            'offset': offset,
+            'seed': seed,
         },
     )
-
-    for i in trange(500, **(tqdm_kwargs or {})):
-        embedding = Embedding(
-            collection=collection,
-            curie=f'test:{i}',
-            vector=[random.expovariate(lamb) for _ in range(dimensions)]
-        )
-        session.add(embedding)
-    session.add(collection)
-    session.commit()
+    chunks = iter_synthetic_chunks(
+        rows, dimensions, distribution=distribution, offset=offset, seed=seed,
+        chunk_size=batch_size or config.batch_size,
+    )
+    bulk_insert_chunks(session, collection, _tqdm_chunks(chunks, total=rows, **(tqdm_kwargs or {})))
     return collection
 
 
 @click.command()
-@click.option('-f', '--fmt', type=click.Choice(['keen', 'word2vec', 'word2vec-model', 'random']))
+@click.option('-f', '--fmt', type=click.Choice([
+    'keen', 'word2vec', 'word2vec-binary', 'word2vec-model', 'arrow', 'parquet', 'random',
+]))
 @click.option('-p', '--path', type=click.Path(file_okay=True, dir_okay=True, exists=True))
 @click.option('-m', '--metadata', type=click.File())
+@click.option('-b', '--batch-size', type=int, default=config.batch_size, show_default=True,
+              help='Number of embeddings written per batch')
+@click.option('-r', '--replace', type=int,
+              help='The identifier of a collection to replace. The embeddings are uploaded into a staging '
+                   'collection first, then swapped in at once.')
+@click.option('--resume', is_flag=True,
+              help='Resume an interrupted upload of the same file from its last committed batch')
+@click.option('-u', '--update', type=int,
+              help='The identifier of a collection to update in place. Only new or changed embeddings are written.')
+@click.option('--remove-missing', is_flag=True,
+              help='With --update, delete the embeddings for entities that are not in the file')
+@click.option('-w', '--workers', type=int,
+              help='The number of processes parsing word2vec text files. Defaults to the number of CPUs.')
+@click.option('--rows', type=int, default=500, show_default=True, help='Rows per random collection')
+@click.option('--dimensions', type=int, help='Dimensions of the random collections. Defaults to a random '
+                                             'multiple of 12 between 36 and 96 for each.')
+@click.option('--collections', type=int, default=5, show_default=True, help='Number of random collections')
+@click.option('--distribution', type=click.Choice(DISTRIBUTIONS), default='exponential', show_default=True,
+              help='Distribution of the random vectors')
+@click.option('--overlap', type=click.FloatRange(0, 1), default=1.0, show_default=True,
+              help='Fraction of CURIEs consecutive random collections share')
+@click.option('--seed', type=int, help='Seed for the random collections')
 @config.get_connection_option()
-def main(fmt: str, path: str, metadata, connection: str):
-    """Upload embeddings."""
+def main(
+        fmt: str,
+        path: str,
+        metadata,
+        batch_size: int,
+        replace: Optional[int],
+        resume: bool,
+        update: Optional[int],
+        remove_missing: bool,
+        workers: Optional[int],
+        rows: int,
+        dimensions: Optional[int],
+        collections: int,
+        distribution: str,
+        overlap: float,
+        seed: Optional[int],
+        connection: str,
+):
+    """Upload embeddings.
+
+    The tables are created first if they don't exist yet. With ``--fmt random``, synthetic collections
+    are generated instead.
+    """
+    create_all(connection)
     session = get_session(connection=connection)
-
-    if fmt in {'word2vec', 'word2vec-model'}:
+    if replace is not None and fmt not in {'keen', 'word2vec', 'word2vec-binary', 'word2vec-model', 'arrow', 'parquet'}:
+        raise ValueError('--replace only works with a single uploaded file')
+    if (resume or update is not None) and fmt not in {'keen', 'word2vec', 'word2vec-binary', 'arrow', 'parquet'}:
+        raise ValueError('--resume and --update only work with embedding files')
+    if update is not None and (resume or replace is not None):
+        raise ValueError('--update can not be combined with --resume or --replace')
+    if remove_missing and update is None:
+        raise ValueError('--remove-missing only works with --update')
+    incremental = {} if fmt == 'word2vec-model' else dict(resume=resume, update=update, remove_missing=remove_missing)
+    # on a partitioned table, the embeddings are written so they can be swapped in without rewriting them
+    incremental['replace'] = replace
+
+    if fmt in {'word2vec', 'word2vec-binary', 'word2vec-model'}:
         if not metadata:
             raise ValueError('Must give --metadata for word2vec')
         metadata = json.load(metadata)
@@ -187,7 +407,9 @@ def main(fmt: str, path: str, metadata, connection: str):
         if fmt == 'word2vec-model':
             upload_function = upload_word2vec
         else:
-            upload_function = upload_word2vec_embedding_file
+            upload_function = partial(
+                upload_word2vec_embedding_file, binary=(fmt == 'word2vec-binary'), workers=workers,
+            )
 
         collection = upload_function(
             path,
@@ -195,28 +417,62 @@ def main(fmt: str, path: str, metadata, connection: str):
             package_name=metadata.pop('package_name'),
             package_version=metadata.pop('package_version'),
             extras=metadata,
+            batch_size=batch_size,
+            **incremental,
         )
-
-        click.echo(f'Uploaded collection {collection.id}')
+        _echo_uploaded(session, collection, replace, update)
         return sys.exit(0)
 
     elif fmt == 'keen':
-        collection = upload_pykeen_from_directory(directory=path, session=session)
-        click.echo(f'Uploaded collection {collection.id}')
+        collection = upload_pykeen_from_directory(
+            directory=path, session=session, batch_size=batch_size, **incremental,
+        )
+        _echo_uploaded(session, collection, replace, update)
+        return sys.exit(0)
+
+    elif fmt in {'arrow', 'parquet'}:
+        metadata = json.load(metadata) if metadata else {}
+        collection = upload_arrow_file(
+            path,
+            session=session,
+            package_name=metadata.pop('package_name', None),
+            package_version=metadata.pop('package_version', None),
+            extras=metadata or None,
+            batch_size=batch_size,
+            **incremental,
+        )
+        _echo_uploaded(session, collection, replace, update)
         return sys.exit(0)
 
     else:
-        n_random = 5
-        it = trange(n_random, desc=f'Loading {n_random} random data sets')
-        for _ in it:
+        from tqdm import trange
+
+        it = trange(collections, desc=f'Loading {collections} random data sets')
+        for index in it:
             collection = load_random(
+                rows=rows,
+                dimensions=dimensions,
+                distribution=distribution,
+                offset=get_curie_offset(index, rows, overlap),
+                seed=None if seed is None else seed + index,
                 session=session,
-                dimensions=12 * random.randint(3, 8),
                 tqdm_kwargs=dict(leave=False),
+                batch_size=batch_size,
             )
             it.write(f'Uploaded collection {collection.id}')
         return sys.exit(0)
 
 
+def _echo_uploaded(session: Session, collection: Collection, replace: Optional[int], update: Optional[int]) -> None:
+    if update is not None:
+        click.echo(f'Updated collection {collection.id}')
+        return
+    if replace is None:
+        click.echo(f'Uploaded collection {collection.id}')
+        return
+    total = replace_collection(session, replace, collection.id)
+    click.echo(f'Replaced collection {replace} with {total} embeddings')
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+"""Delete and replace collections with set-based SQL.
+
+Deleting a collection through the ORM would load every embedding before deleting it. Instead, the rows
+belonging to a collection are removed with one ``DELETE ... WHERE collection_id = ?`` per table or, if the
+embedding table is partitioned (see :mod:`embeddingdb.sql.partitions`), by dropping its partition.
+
+A collection is replaced by uploading the new embeddings into a staging collection, then moving them
+under the original collection's identifier in a single transaction, so readers see either the old or the
+new embeddings but never a partially uploaded collection. If the embedding table is partitioned, the
+staging collection's partition takes the place of the original one instead.
+"""
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .models import Collection, Embedding, Overlap, RegressionResult, new_version
+from .partitions import drop_partition, is_partitioned, swap_partition, truncate_partition
+from ..cache import CollectionCache, get_response_cache
+
+__all__ = [
+    'delete_collection',
+    'replace_collection',
+]
+
+
+def delete_collection(session: Session, collection_id: int) -> int:
+    """Delete a collection, its embeddings, and the results calculated from it.
+
+    :param session: A database session
+    :param collection_id: The database identifier of the collection
+    :return: The number of embeddings deleted
+    :raises KeyError: If the collection does not exist
+    """
+    if session.query(Collection.id).filter(Collection.id == collection_id).scalar() is None:
+        raise KeyError(collection_id)
+    total = _delete_rows(session, collection_id)
+    session.commit()
+    _invalidate_cache(collection_id)
+    return total
+
+
+def replace_collection(session: Session, collection_id: int, staging_id: int) -> int:
+    """Replace the embeddings of a collection with those of a staging collection in one transaction.
+
+    The staging collection's embeddings, dimensions, and metadata are moved to the original collection,
+    whose identifier stays the same, and the staging collection is deleted. The original collection gets
+    a new version, so caches and cached analyses are refreshed.
+
+    :param session: A database session
+    :param collection_id: The database identifier of the collection to replace
+    :param staging_id: The database identifier of the collection holding the new embeddings
+    :return: The number of embeddings in the replaced collection
+    :raises KeyError: If either collection does not exist
+    """
+    if collection_id == staging_id:
+        raise ValueError('a collection can not be replaced with itself')
+    collection = session.query(Collection).get(collection_id)
+    if collection is None:
+        raise KeyError(collection_id)
+    staging = session.query(Collection).get(staging_id)
+    if staging is None:
+        raise KeyError(staging_id)
+
+    table = Embedding.__table__
+    try:
+        if is_partitioned(session.connection()):
+            _delete_results(session, collection_id)
+            total = swap_partition(session, collection_id, staging_id)
+        else:
+            _delete_rows(session, collection_id, delete_collection=False)
+            total = session.execute(
+                table.update().where(table.c.collection_id == staging_id).values(collection_id=collection_id)
+            ).rowcount
+        collection.dimensions = staging.dimensions
+        collection.package_name = staging.package_name
+        collection.package_version = staging.package_version
+        collection.extras = staging.extras
+        collection.version = new_version()
+        session.flush()
+        _delete_rows(session, staging_id)
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+
+    _invalidate_cache(collection_id)
+    _invalidate_cache(staging_id)
+    return total
+
+
+def _delete_rows(session: Session, collection_id: int, delete_collection: bool = True) -> int:
+    """Delete the rows referencing a collection (and the collection itself) without committing.
+
+    The rows are deleted explicitly rather than relying on ``ON DELETE CASCADE``, which databases created
+    by older versions of ``embeddingdb`` don't have.
+    """
+    _delete_results(session, collection_id)
+    if is_partitioned(session.connection()):
+        total = session.query(func.count(Embedding.id)).filter(Embedding.collection_id == collection_id).scalar()
+        if delete_collection:
+            drop_partition(session, collection_id)
+        else:
+            truncate_partition(session, collection_id)
+    else:
+        table = Embedding.__table__
+        total = session.execute(table.delete().where(table.c.collection_id == collection_id)).rowcount
+    if delete_collection:
+        # evaluating the criterion removes the collection from the session, in case its identifier is reused
+        session.query(Collection).filter(Collection.id == collection_id).delete(synchronize_session='evaluate')
+    return total
+
+
+def _delete_results(session: Session, collection_id: int) -> None:
+    """Delete the overlaps and regression results calculated from a collection without committing."""
+    for model in (Overlap, RegressionResult):
+        session.query(model).filter(
+            (model.collection_id_1 == collection_id) | (model.collection_id_2 == collection_id)
+        ).delete(synchronize_session=False)
+
+
+def _invalidate_cache(collection_id: int) -> None:
+    # files derived from the collection, like indexes, are kept even if caching is disabled
+    CollectionCache().invalidate(collection_id)
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        response_cache.invalidate(collection_id)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""Migrate stored vectors between storage formats.
+
+Databases created before vectors were stored with :class:`embeddingdb.sql.types.Vector` have a PostgreSQL
+``ARRAY(Float)`` column. :func:`upgrade_vector_column` converts it in place, and :func:`convert_collection`
+re-encodes the vectors of a collection with another data type, e.g., to shrink it to ``float16``.
+Databases created before entities were normalized into their own table are upgraded with
+:func:`upgrade_entity_table`.
+"""
+
+from typing import Iterable, Optional
+
+import click
+from sqlalchemy import LargeBinary, bindparam, inspect, select, text, type_coerce
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from .models import (
+    COLLECTION_TABLE_NAME, Collection, EMBEDDING_TABLE_NAME, ENTITY_TABLE_NAME, Embedding, Entity, get_engine,
+    get_session, new_version,
+)
+from .types import DTYPES, decode_vectors, encode_vector, encode_vectors
+from ..constants import config
+
+__all__ = [
+    'upgrade_collection_table',
+    'upgrade_entity_table',
+    'upgrade_vector_column',
+    'convert_collection',
+    'main',
+]
+
+_PACKED_COLUMN = 'vector_packed'
+
+
+def upgrade_collection_table(engine: Engine) -> bool:
+    """Add the columns to the collection table that were added after it was created.
+
+    :param engine: A database engine
+    :return: If the table needed to be upgraded
+    """
+    columns = {column['name'] for column in inspect(engine).get_columns(COLLECTION_TABLE_NAME)}
+    if 'version' in columns:
+        return False
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {COLLECTION_TABLE_NAME} ADD COLUMN version VARCHAR(32)'))
+        for collection_id, in connection.execute(text(f'SELECT id FROM {COLLECTION_TABLE_NAME}')).fetchall():
+            connection.execute(
+                text(f'UPDATE {COLLECTION_TABLE_NAME} SET version = :version WHERE id = :collection_id'),
+                version=new_version(),
+                collection_id=collection_id,
+            )
+    return True
+
+
+def upgrade_entity_table(engine: Engine) -> bool:
+    """Replace the CURIEs stored in each embedding with references to the entity table.
+
+    Each distinct CURIE is inserted into the entity table, then embeddings get the identifiers of their
+    entities and the CURIE column is removed. PostgreSQL alters the embedding table in place. Other
+    databases, like SQLite, can't drop a column that's part of a unique constraint, so the table is
+    rebuilt instead.
+
+    :param engine: A database engine
+    :return: If the table needed to be upgraded
+    """
+    columns = {column['name'] for column in inspect(engine).get_columns(EMBEDDING_TABLE_NAME)}
+    if 'curie' not in columns:
+        return False
+
+    Entity.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as connection:
+        connection.execute(text(
+            f'INSERT INTO {ENTITY_TABLE_NAME} (curie)'
+            f' SELECT DISTINCT curie FROM {EMBEDDING_TABLE_NAME} e'
+            f' WHERE NOT EXISTS (SELECT 1 FROM {ENTITY_TABLE_NAME} n WHERE n.curie = e.curie)'
+        ))
+
+    if engine.dialect.name == 'postgresql':
+        _upgrade_entity_column_in_place(engine, add_column='entity_id' not in columns)
+    else:
+        _rebuild_embedding_table(engine)
+    return True
+
+
+def _upgrade_entity_column_in_place(engine: Engine, add_column: bool) -> None:
+    with engine.begin() as connection:
+        if add_column:
+            connection.execute(text(f'ALTER TABLE {EMBEDDING_TABLE_NAME} ADD COLUMN entity_id INTEGER'))
+        connection.execute(text(
+            f'UPDATE {EMBEDDING_TABLE_NAME} e SET entity_id = n.id FROM {ENTITY_TABLE_NAME} n'
+            f' WHERE n.curie = e.curie AND e.entity_id IS NULL'
+        ))
+        for statement in (
+            f'ALTER TABLE {EMBEDDING_TABLE_NAME} ALTER COLUMN entity_id SET NOT NULL',
+            f'ALTER TABLE {EMBEDDING_TABLE_NAME} ADD FOREIGN KEY (entity_id) REFERENCES {ENTITY_TABLE_NAME} (id)',
+            f'CREATE INDEX ix_{EMBEDDING_TABLE_NAME}_entity_id ON {EMBEDDING_TABLE_NAME} (entity_id)',
+            f'ALTER TABLE {EMBEDDING_TABLE_NAME} ADD UNIQUE (collection_id, entity_id)',
+            # also drops the CURIE's index and the old unique constraint
+            f'ALTER TABLE {EMBEDDING_TABLE_NAME} DROP COLUMN curie',
+        ):
+            connection.execute(text(statement))
+
+
+def _rebuild_embedding_table(engine: Engine) -> None:
+    old_name = f'{EMBEDDING_TABLE_NAME}_old'
+    index_names = [index['name'] for index in inspect(engine).get_indexes(EMBEDDING_TABLE_NAME)]
+    with engine.begin() as connection:
+        # index names are global, so the old ones are dropped before the new table creates them again
+        for index_name in index_names:
+            connection.execute(text(f'DROP INDEX {index_name}'))
+        connection.execute(text(f'ALTER TABLE {EMBEDDING_TABLE_NAME} RENAME TO {old_name}'))
+        Embedding.__table__.create(bind=connection)
+        connection.execute(text(
+            f'INSERT INTO {EMBEDDING_TABLE_NAME} (id, entity_id, vector, collection_id)'
+            f' SELECT e.id, n.id, e.vector, e.collection_id FROM {old_name} e'
+            f' JOIN {ENTITY_TABLE_NAME} n ON n.curie = e.curie'
+        ))
+        connection.execute(text(f'DROP TABLE {old_name}'))
+
+
+def upgrade_vector_column(
+        engine: Engine,
+        *,
+        dtype: Optional[str] = None,
+        batch_size: Optional[int] = None,
+) -> bool:
+    """Convert a legacy ``ARRAY(Float)`` vector column to packed bytes.
+
+    The vectors are copied into a new column in batches that are committed one at a time, so an
+    interrupted upgrade can be resumed by running it again.
+
+    :param engine: A database engine
+    :param dtype: The data type vectors are stored with. Defaults to :data:`Config.vector_dtype`.
+    :param batch_size: The number of vectors converted per batch. Defaults to :data:`Config.batch_size`.
+    :return: If the column needed to be upgraded
+    """
+    if batch_size is None:
+        batch_size = config.batch_size
+
+    columns = {
+        column['name']: column['type']
+        for column in inspect(engine).get_columns(EMBEDDING_TABLE_NAME)
+    }
+    if isinstance(columns['vector'], LargeBinary):
+        return False
+
+    if _PACKED_COLUMN not in columns:
+        engine.execute(text(f'ALTER TABLE {EMBEDDING_TABLE_NAME} ADD COLUMN {_PACKED_COLUMN} BYTEA'))
+
+    select_batch = text(
+        f'SELECT id, vector FROM {EMBEDDING_TABLE_NAME} WHERE {_PACKED_COLUMN} IS NULL LIMIT :limit'
+    )
+    update_batch = text(
+        f'UPDATE {EMBEDDING_TABLE_NAME} SET {_PACKED_COLUMN} = :vector WHERE id = :embedding_id'
+    )
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select_batch, limit=batch_size).fetchall()
+            if not rows:
+                break
+            # a batch can span collections with different dimensions, so vectors are encoded one at a time
+            connection.execute(update_batch, [
+                dict(embedding_id=embedding_id, vector=encode_vector(vector, dtype=dtype))
+                for embedding_id, vector in rows
+            ])
+
+    with engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE {EMBEDDING_TABLE_NAME} DROP COLUMN vector'))
+        connection.execute(text(f'ALTER TABLE {EMBEDDING_TABLE_NAME} RENAME COLUMN {_PACKED_COLUMN} TO vector'))
+        connection.execute(text(f'ALTER TABLE {EMBEDDING_TABLE_NAME} ALTER COLUMN vector SET NOT NULL'))
+    return True
+
+
+def convert_collection(
+        session: Session,
+        collection_id: int,
+        *,
+        dtype: str,
+        batch_size: Optional[int] = None,
+) -> int:
+    """Re-encode the vectors in a collection with the given data type.
+
+    Vectors already stored with the data type are left as they are, so converting a collection again
+    doesn't lose precision. The collection only gets a new version, which invalidates its cache entries
+    and analyses, if any vectors were converted.
+
+    :param session: A database session
+    :param collection_id: The database identifier of the collection
+    :param dtype: The data type vectors are stored with
+    :param batch_size: The number of vectors converted per batch. Defaults to :data:`Config.batch_size`.
+    :return: The number of vectors converted
+    :raises KeyError: If the collection does not exist
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f'invalid vector dtype: {dtype}. Should be one of {sorted(DTYPES)}')
+    tag = DTYPES[dtype]
+    if batch_size is None:
+        batch_size = config.batch_size
+    dimensions = session.query(Collection.dimensions).filter(Collection.id == collection_id).scalar()
+    if dimensions is None:
+        raise KeyError(collection_id)
+
+    table = Embedding.__table__
+    update = table.update().where(table.c.id == bindparam('embedding_id')).values(vector=bindparam('packed'))
+    last_id, total = 0, 0
+    while True:
+        # the packed bytes are read as they are, so their data type tags can be checked before decoding
+        rows = session.execute(
+            select([table.c.id, type_coerce(table.c.vector, LargeBinary)])
+            .where(table.c.collection_id == collection_id)
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        rows = [(embedding_id, bytes(value)) for embedding_id, value in rows if value[0] != tag]
+        if not rows:
+            continue
+        ids, values = zip(*rows)
+        session.execute(update, [
+            dict(embedding_id=embedding_id, packed=packed)
+            for embedding_id, packed in zip(ids, encode_vectors(decode_vectors(values, dimensions), dtype=dtype))
+        ])
+        session.commit()
+        total += len(ids)
+
+    if total:
+        session.query(Collection).filter(Collection.id == collection_id).update({'version': new_version()})
+        session.commit()
+    return total
+
+
+@click.command()
+@click.argument('collection_ids', nargs=-1, type=int)
+@click.option('-d', '--dtype', type=click.Choice(sorted(DTYPES)), default=config.vector_dtype, show_default=True)
+@click.option('-b', '--batch-size', type=int, default=config.batch_size, show_default=True)
+@config.get_connection_option()
+def main(collection_ids: Iterable[int], dtype: str, batch_size: int, connection: str):
+    """Migrate the database schema or convert collections to another data type.
+
+    Columns missing from older versions of the collection table are added and CURIEs are moved from the
+    embedding table to the entity table. If the database still stores vectors as arrays, all of them are
+    converted. Otherwise, the vectors in the given collections (or all collections, if none are given)
+    that aren't already stored with the data type are re-encoded.
+    """
+    engine = get_engine(connection)
+    if upgrade_collection_table(engine):
+        click.echo('Added content versions to the collection table')
+    if upgrade_entity_table(engine):
+        click.echo('Moved CURIEs to the entity table')
+    if upgrade_vector_column(engine, dtype=dtype, batch_size=batch_size):
+        click.echo(f'Converted the vector column to packed {dtype}')
+        return
+
+    session = get_session(connection=connection)
+    if not collection_ids:
+        collection_ids = [collection_id for collection_id, in session.query(Collection.id)]
+    for collection_id in collection_ids:
+        try:
+            total = convert_collection(session, collection_id, dtype=dtype, batch_size=batch_size)
+        except KeyError:
+            click.echo(f'Collection {collection_id} does not exist', err=True)
+            continue
+        if total:
+            click.echo(f'Converted {total} vectors in collection {collection_id} to {dtype}')
+        else:
+            click.echo(f'Collection {collection_id} is already stored as {dtype}')
+
+
+if __name__ == '__main__':
+    main()
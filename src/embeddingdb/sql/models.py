@@ -2,39 +2,147 @@
 
 """SQLAlchemy models for storing embeddings."""
 
-from typing import Optional
+import sqlite3
+import threading
+import uuid
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Sequence, TYPE_CHECKING, Tuple
 
 import numpy as np
-import pandas as pd
-from sqlalchemy import ARRAY, Column, Float, ForeignKey, Integer, JSON, String, UniqueConstraint, create_engine
+from sqlalchemy import (
+    Column, Float, ForeignKey, Integer, JSON, LargeBinary, String, UniqueConstraint, create_engine, event, exists,
+    func, type_coerce,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session, backref, relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import Session, aliased, backref, object_session, relationship, scoped_session, sessionmaker
 
+from .types import Vector, decode_vector, decode_vectors
+from ..cache import decode_curies, encode_curies, get_cache
 from ..constants import config
+from ..metrics import install_sqlalchemy_hooks
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 __all__ = [
     'Base',
     'Collection',
+    'Entity',
     'Embedding',
+    'Overlap',
+    'RegressionResult',
+    'Checkpoint',
+    'is_complete',
+    'get_engine',
+    'get_engine_options',
+    'create_all',
     'get_session',
+    'get_entity_ids',
+    'iter_vector_chunks',
+    'get_embeddings',
+    'get_entity_embeddings',
+    'iter_aligned_chunks',
+    'load_aligned',
 ]
 
 Base = declarative_base()
 
 
-def get_session(connection: Optional[str] = None) -> Session:
-    """Get a scoped session at the given connection."""
+_engines: Dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine_options(connection: str) -> Dict[str, Any]:
+    """Get the keyword arguments for :func:`sqlalchemy.create_engine` configured in :class:`Config`.
+
+    SQLite doesn't use a queue pool, so it only gets the options that apply to all pools.
+    """
+    options = dict(
+        pool_pre_ping=config.pool_pre_ping,
+        pool_recycle=config.pool_recycle,
+    )
+    if make_url(connection).get_backend_name() != 'sqlite':
+        options.update(
+            pool_size=config.pool_size,
+            max_overflow=config.max_overflow,
+        )
+    return options
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record) -> None:
+    """Make SQLite enforce foreign keys, including ``ON DELETE CASCADE``, which it doesn't by default."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+def get_engine(connection: Optional[str] = None) -> Engine:
+    """Get the engine for the given connection, creating it on first use.
+
+    Engines are shared by all sessions in the process, so each connection string gets a single pool. If
+    :data:`Config.metrics` is enabled, their statements are timed (see :mod:`embeddingdb.metrics`).
+    """
     if connection is None:
         connection = config.connection
-    engine = create_engine(connection)
-    Base.metadata.create_all(bind=engine, checkfirst=True)
-    session_maker = sessionmaker(bind=engine)
+    with _engines_lock:
+        engine = _engines.get(connection)
+        if engine is None:
+            engine = _engines[connection] = create_engine(connection, **get_engine_options(connection))
+            install_sqlalchemy_hooks(engine)
+    return engine
+
+
+def create_all(connection: Optional[str] = None) -> None:
+    """Create the tables that don't exist yet at the given connection.
+
+    If :data:`Config.partition_embeddings` is set and the database is PostgreSQL, the embedding table is
+    partitioned by collection (see :mod:`embeddingdb.sql.partitions`).
+    """
+    engine = get_engine(connection)
+    if not config.partition_embeddings or engine.dialect.name != 'postgresql':
+        Base.metadata.create_all(bind=engine, checkfirst=True)
+        return
+
+    from .partitions import create_partitioned_embedding_table  # the partitions module builds on this one
+    embedding_table = Base.metadata.tables[EMBEDDING_TABLE_NAME]
+    with engine.begin() as connection:
+        Base.metadata.create_all(
+            bind=connection,
+            tables=[table for table in Base.metadata.sorted_tables if table is not embedding_table],
+            checkfirst=True,
+        )
+        create_partitioned_embedding_table(connection)
+
+
+def get_session(connection: Optional[str] = None) -> Session:
+    """Get a scoped session at the given connection.
+
+    The tables aren't created automatically. Run ``embeddingdb init`` or :func:`create_all` first.
+    """
+    session_maker = sessionmaker(bind=get_engine(connection))
     session: Session = scoped_session(session_maker)  # override type annotations
     return session
 
 
+def new_version() -> str:
+    """Generate a new content version for a collection."""
+    return uuid.uuid4().hex
+
+
 EMBEDDING_TABLE_NAME = 'embeddingdb_embedding'
 COLLECTION_TABLE_NAME = 'embeddingdb_collection'
+ENTITY_TABLE_NAME = 'embeddingdb_entity'
+OVERLAP_TABLE_NAME = 'embeddingdb_overlap'
+REGRESSION_TABLE_NAME = 'embeddingdb_regression'
+CHECKPOINT_TABLE_NAME = 'embeddingdb_checkpoint'
+
+#: The maximum number of values in a single ``IN`` clause
+_MAX_IN_SIZE = 1_000
 
 
 class Collection(Base):
@@ -51,24 +159,105 @@ class Collection(Base):
                              doc='The version of the package used to generate the entity embeddings')
     extras = Column(JSON, index=False, unique=False, nullable=True,
                     doc='Extra information associated with the collection')
+    version = Column(String(32), nullable=False, default=new_version,
+                     doc='Changes whenever the embeddings in this collection change, e.g., to invalidate caches')
+
+    def iter_chunks(
+            self,
+            curies: Optional[Iterable[str]] = None,
+            chunk_size: Optional[int] = None,
+    ) -> Iterable[Tuple[List[str], np.ndarray]]:
+        """Iterate over chunks of CURIEs and their vectors as float32 matrices, ordered by CURIE.
 
-    def as_ndarray(self) -> np.ndarray:
-        """Get this collection as a numpy array (with no labels)."""
-        return np.array([
-            embedding.vector
-            for embedding in self.embeddings.order_by(Embedding.curie)
-        ])
-
-    def as_dataframe(self) -> pd.DataFrame:
-        """Get this collection as a pandas DataFrame."""
-        return pd.DataFrame.from_dict(
-            {
-                embedding.curie: embedding.vector
-                for embedding in self.embeddings.order_by(Embedding.curie)
-            },
-            orient='index',
+        Only the CURIE and packed vector columns are selected and rows are streamed from a server-side cursor,
+        so no ORM objects are built and only one chunk is held in memory at a time.
+
+        :param curies: An optional subset of CURIEs to get. Ones not in this collection are skipped.
+        :param chunk_size: The number of embeddings per chunk. Defaults to :data:`Config.batch_size`.
+        """
+        return iter_vector_chunks(
+            object_session(self), self.id, self.dimensions, curies=curies, chunk_size=chunk_size,
         )
 
+    def count_embeddings(self) -> int:
+        """Count the embeddings in this collection."""
+        session = object_session(self)
+        return session.query(func.count(Embedding.id)).filter(Embedding.collection_id == self.id).scalar()
+
+    def load(
+            self,
+            curies: Optional[Iterable[str]] = None,
+            use_cache: bool = True,
+            encoded: bool = False,
+    ) -> Tuple[Sequence[str], np.ndarray]:
+        """Get the CURIEs and a float32 matrix of the vectors in this collection, ordered by CURIE.
+
+        If caching is enabled, the whole collection is downloaded to the cache (see :mod:`embeddingdb.cache`)
+        on first use and memory-mapped afterwards. A subset of CURIEs is read from the cache only if it
+        already has the collection. Otherwise, the matrix is preallocated from the number of embeddings
+        and the dimensions of the collection then filled chunk by chunk.
+
+        :param curies: An optional subset of CURIEs to get. Ones not in this collection are skipped.
+        :param use_cache: Should the local cache be used?
+        :param encoded: Should the CURIEs be returned as an array of UTF-8 bytes (see
+         :func:`embeddingdb.cache.encode_curies`)? For a whole cached collection, that's the memory-mapped
+         array rather than a decoded copy of it.
+        """
+        cache = get_cache() if use_cache else None
+        if cache is not None:
+            # the entry can be evicted by another process at any time, then the database is read instead
+            cached = cache.load(self) if curies is None else cache.get(self)
+            if cached is not None and curies is None:
+                rv_curies, rv = cached
+                return (rv_curies if encoded else decode_curies(rv_curies)), rv
+            elif cached is not None:
+                rv_curies, rv = cache.select(*cached, curies)
+                return (encode_curies(rv_curies) if encoded else rv_curies), rv
+
+        if curies is not None:
+            curies = set(curies)
+            n = len(curies)
+        else:
+            n = self.count_embeddings()
+
+        rv_curies = []
+        rv = np.empty((n, self.dimensions), dtype=np.float32)
+        for chunk_curies, vectors in self.iter_chunks(curies=curies):
+            rv[len(rv_curies):len(rv_curies) + len(chunk_curies)] = vectors
+            rv_curies.extend(chunk_curies)
+        return (encode_curies(rv_curies) if encoded else rv_curies), rv[:len(rv_curies)]
+
+    def as_ndarray(self, curies: Optional[Iterable[str]] = None) -> np.ndarray:
+        """Get this collection as a float32 numpy array (with no labels), ordered by CURIE.
+
+        :param curies: An optional subset of CURIEs to get. Ones not in this collection are skipped.
+        """
+        _, vectors = self.load(curies=curies)
+        return vectors
+
+    def as_dataframe(self, curies: Optional[Iterable[str]] = None) -> 'pd.DataFrame':
+        """Get this collection as a pandas DataFrame indexed by CURIE.
+
+        :param curies: An optional subset of CURIEs to get. Ones not in this collection are skipped.
+        """
+        import pandas as pd
+
+        curies, vectors = self.load(curies=curies)
+        return pd.DataFrame(vectors, index=curies)
+
+
+class Entity(Base):
+    """Represents an entity, which can have embeddings in many collections.
+
+    Embeddings reference their entity by its integer identifier, so each CURIE is stored once and
+    embeddings from different collections are aligned by joining on integers.
+    """
+
+    __tablename__ = ENTITY_TABLE_NAME
+    id = Column(Integer, primary_key=True)
+
+    curie = Column(String(1023), index=True, unique=True, nullable=False, doc='CURIE for the entity')
+
 
 class Embedding(Base):
     """Represents the embedding for an entity."""
@@ -76,13 +265,296 @@ class Embedding(Base):
     __tablename__ = EMBEDDING_TABLE_NAME
     id = Column(Integer, primary_key=True)
 
-    # Consider normalizing out entity to new table
-    curie = Column(String(1023), index=True, unique=False, nullable=False, doc='CURIE for the entity')
-    vector = Column(ARRAY(Float), nullable=False, doc='Embedding for entity')
+    entity_id = Column(Integer, ForeignKey(f'{Entity.__tablename__}.id'), nullable=False, index=True)
+    entity = relationship(Entity, lazy='joined')
+    curie = association_proxy('entity', 'curie')
 
-    collection_id = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id'), nullable=False, index=True)
-    collection = relationship(Collection, backref=backref('embeddings', lazy='dynamic', cascade="all, delete-orphan"))
+    vector = Column(Vector, nullable=False, doc='Embedding for entity')
+
+    collection_id = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id', ondelete='CASCADE'), nullable=False,
+                           index=True)
+    collection = relationship(Collection, backref=backref(
+        'embeddings', lazy='dynamic', cascade="all, delete-orphan", passive_deletes=True,
+    ))
 
     __table_args__ = (
-        UniqueConstraint(collection_id, curie),
+        UniqueConstraint(collection_id, entity_id),
+    )
+
+
+class Overlap(Base):
+    """Caches the number of entities shared by two collections.
+
+    The versions of both collections are stored along with the count, so it's recalculated once either
+    collection changes. The size of each collection is cached as its overlap with itself.
+    """
+
+    __tablename__ = OVERLAP_TABLE_NAME
+
+    collection_id_1 = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id', ondelete='CASCADE'),
+                             primary_key=True, doc='The collection with the lower (or the same) identifier')
+    collection_id_2 = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id', ondelete='CASCADE'),
+                             primary_key=True, index=True, doc='The collection with the higher identifier')
+    version_1 = Column(String(32), nullable=False, doc='The version of the first collection')
+    version_2 = Column(String(32), nullable=False, doc='The version of the second collection')
+    overlap = Column(Integer, nullable=False, doc='The number of entities in both collections')
+
+
+class RegressionResult(Base):
+    """Records the evaluation of a regression from the embeddings in one collection to those in another.
+
+    The versions of both collections are stored along with the results, so the regression is run again
+    once either collection changes.
+    """
+
+    __tablename__ = REGRESSION_TABLE_NAME
+
+    collection_id_1 = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id', ondelete='CASCADE'),
+                             primary_key=True, doc='The collection whose embeddings are the features')
+    collection_id_2 = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id', ondelete='CASCADE'),
+                             primary_key=True, index=True, doc='The collection whose embeddings are the targets')
+    model = Column(String(32), primary_key=True, doc='The name of the regression')
+    version_1 = Column(String(32), nullable=False, doc='The version of the first collection')
+    version_2 = Column(String(32), nullable=False, doc='The version of the second collection')
+    r2 = Column(Float, nullable=True, doc='The coefficient of determination')
+    intersection = Column(Integer, nullable=False, doc='The number of entities in both collections')
+    load_seconds = Column(Float, nullable=False, doc='The time spent aligning the collections')
+    fit_seconds = Column(Float, nullable=False, doc='The time spent fitting and evaluating the regression')
+
+
+class Checkpoint(Base):
+    """Records the progress of an upload, so an interrupted upload can be resumed.
+
+    The checkpoint is created along with its collection, updated in the same transaction as each batch of
+    embeddings, and removed once the upload is complete. Until then, the collection is incomplete and hidden
+    from queries (see :func:`is_complete`).
+    """
+
+    __tablename__ = CHECKPOINT_TABLE_NAME
+
+    collection_id = Column(Integer, ForeignKey(f'{Collection.__tablename__}.id', ondelete='CASCADE'),
+                           primary_key=True)
+    collection = relationship(Collection)
+    source = Column(String(1023), nullable=False, index=True,
+                    doc='Identifies the uploaded file by its path, size, and modification time. Empty if the '
+                        'upload is not of a file and can not be resumed.')
+    rows = Column(Integer, nullable=False, default=0, doc='The number of rows of the source uploaded so far')
+
+
+def is_complete():
+    """Get a condition on collections that's true for the ones whose uploads are complete."""
+    return ~exists().where(Checkpoint.collection_id == Collection.id)
+
+
+def get_entity_ids(session: Session, curies: Iterable[str]) -> Dict[str, int]:
+    """Look up the identifiers of the entities with the given CURIEs, if they exist.
+
+    :param session: A database session
+    :param curies: The CURIEs to look up
+    :return: A dictionary from the CURIEs that were found to their entities' identifiers
+    """
+    curies = sorted(set(curies))
+    rv = {}
+    for start in range(0, len(curies), _MAX_IN_SIZE):
+        rv.update(
+            session.query(Entity.curie, Entity.id).filter(Entity.curie.in_(curies[start:start + _MAX_IN_SIZE]))
+        )
+    return rv
+
+
+def _query_vectors(session: Session, collection_id: int):
+    """Query the CURIEs and undecoded vectors in a collection, ordered by CURIE."""
+    return (
+        session.query(Entity.curie, type_coerce(Embedding.vector, LargeBinary))
+        .join(Embedding, Embedding.entity_id == Entity.id)
+        .filter(Embedding.collection_id == collection_id)
+        .order_by(Entity.curie)
     )
+
+
+def iter_vector_chunks(
+        session: Session,
+        collection_id: int,
+        dimensions: int,
+        curies: Optional[Iterable[str]] = None,
+        chunk_size: Optional[int] = None,
+) -> Iterable[Tuple[List[str], np.ndarray]]:
+    """Iterate over chunks of CURIEs and their vectors in a collection as float32 matrices, ordered by CURIE.
+
+    :param session: A database session
+    :param collection_id: The database identifier of the collection
+    :param dimensions: The dimensions of the collection
+    :param curies: An optional subset of CURIEs to get. Ones not in the collection are skipped.
+    :param chunk_size: The number of embeddings per chunk. Defaults to :data:`Config.batch_size`.
+    """
+    if chunk_size is None:
+        chunk_size = config.batch_size
+
+    if curies is None:
+        queries = [_query_vectors(session, collection_id)]
+    else:
+        curies = sorted(set(curies))
+        queries = (
+            _query_vectors(session, collection_id).filter(Entity.curie.in_(curies[start:start + _MAX_IN_SIZE]))
+            for start in range(0, len(curies), _MAX_IN_SIZE)
+        )
+
+    for query in queries:
+        rows = iter(query.yield_per(chunk_size))
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            chunk_curies, vectors = zip(*chunk)
+            yield list(chunk_curies), decode_vectors(vectors, dimensions)
+
+
+def get_embeddings(
+        session: Session,
+        collection_id: int,
+        curies: Iterable[str],
+) -> Tuple[List[str], np.ndarray, List[str]]:
+    """Get the vectors for many CURIEs in a collection at once.
+
+    The CURIEs are looked up with one ``IN`` query per chunk rather than one query each.
+
+    :param session: A database session
+    :param collection_id: The database identifier of the collection
+    :param curies: The CURIEs to look up. Duplicates are ignored.
+    :return: The CURIEs that were found (in the order they were given), a float32 matrix of their vectors,
+     and the CURIEs that were missing
+    :raises KeyError: If the collection does not exist
+    """
+    dimensions = session.query(Collection.dimensions).filter(Collection.id == collection_id).scalar()
+    if dimensions is None:
+        raise KeyError(collection_id)
+
+    curies = list(dict.fromkeys(curies))
+    found_curies, blocks = [], [np.empty((0, dimensions), dtype=np.float32)]
+    for chunk_curies, vectors in iter_vector_chunks(session, collection_id, dimensions, curies=curies):
+        found_curies.extend(chunk_curies)
+        blocks.append(vectors)
+    vectors = np.concatenate(blocks)
+
+    positions = {curie: position for position, curie in enumerate(found_curies)}
+    found = [curie for curie in curies if curie in positions]
+    missing = [curie for curie in curies if curie not in positions]
+    return found, vectors[[positions[curie] for curie in found]], missing
+
+
+def get_entity_embeddings(
+        session: Session,
+        curies: Iterable[str],
+        collection_ids: Optional[Iterable[int]] = None,
+        package_name: Optional[str] = None,
+        dimensions: Optional[int] = None,
+) -> Tuple[List[Collection], List[Tuple[str, int, np.ndarray]]]:
+    """Get the embeddings for entities across collections.
+
+    Each chunk of CURIEs is looked up with a single query that joins the embeddings on their entities'
+    integer identifiers and joins the collections, so the collections are not lazy-loaded row by row.
+
+    :param session: A database session
+    :param curies: The CURIEs to look up
+    :param collection_ids: If given, only look in these collections
+    :param package_name: If given, only look in collections made by this package
+    :param dimensions: If given, only look in collections with this dimensionality
+    :return: The collections the entities appeared in and triples of CURIEs, collection identifiers, and vectors
+    """
+    curies = sorted(set(curies))
+    collections = {}
+    embeddings = []
+    for start in range(0, len(curies), _MAX_IN_SIZE):
+        query = (
+            session.query(Entity.curie, type_coerce(Embedding.vector, LargeBinary), Collection)
+            .join(Embedding, Embedding.entity_id == Entity.id)
+            .join(Collection, Embedding.collection_id == Collection.id)
+            .filter(Entity.curie.in_(curies[start:start + _MAX_IN_SIZE]))
+            .filter(is_complete())
+        )
+        if collection_ids is not None:
+            query = query.filter(Collection.id.in_(list(collection_ids)))
+        if package_name is not None:
+            query = query.filter(Collection.package_name == package_name)
+        if dimensions is not None:
+            query = query.filter(Collection.dimensions == dimensions)
+
+        for curie, vector, collection in query.order_by(Entity.curie, Collection.id):
+            collections[collection.id] = collection
+            embeddings.append((curie, collection.id, decode_vector(vector)))
+    return list(collections.values()), embeddings
+
+
+def iter_aligned_chunks(
+        session: Session,
+        collection_1: Collection,
+        collection_2: Collection,
+        chunk_size: Optional[int] = None,
+) -> Iterable[Tuple[List[str], np.ndarray, np.ndarray]]:
+    """Iterate over chunks of the entities in both collections and their vectors in each, ordered by entity.
+
+    The embeddings of the two collections are joined on their entities' identifiers in a single query, so
+    only the shared entities are fetched and the rows of each pair of matrices are already aligned.
+
+    :param session: A database session
+    :param collection_1: The first collection
+    :param collection_2: The second collection
+    :param chunk_size: The number of entities per chunk. Defaults to :data:`Config.batch_size`.
+    """
+    if chunk_size is None:
+        chunk_size = config.batch_size
+
+    left, right = aliased(Embedding), aliased(Embedding)
+    query = (
+        session.query(Entity.curie, type_coerce(left.vector, LargeBinary), type_coerce(right.vector, LargeBinary))
+        .join(left, left.entity_id == Entity.id)
+        .join(right, right.entity_id == Entity.id)
+        .filter(left.collection_id == collection_1.id, right.collection_id == collection_2.id)
+        .order_by(Entity.id)
+    )
+    rows = iter(query.yield_per(chunk_size))
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        curies, vectors_1, vectors_2 = zip(*chunk)
+        yield (
+            list(curies),
+            decode_vectors(vectors_1, collection_1.dimensions),
+            decode_vectors(vectors_2, collection_2.dimensions),
+        )
+
+
+def load_aligned(
+        collection_1: Collection,
+        collection_2: Collection,
+        use_cache: bool = True,
+) -> Tuple[Sequence[str], np.ndarray, np.ndarray]:
+    """Get the entities in both collections and float32 matrices of their vectors in each, with aligned rows.
+
+    If both collections are already cached, their sorted CURIEs are intersected in memory. Otherwise, only
+    the shared entities are fetched with :func:`iter_aligned_chunks`.
+
+    :param collection_1: The first collection
+    :param collection_2: The second collection
+    :param use_cache: Should the local cache be used?
+    """
+    cache = get_cache() if use_cache else None
+    if cache is not None:
+        cached_1, cached_2 = cache.get(collection_1), cache.get(collection_2)
+        if cached_1 is not None and cached_2 is not None:
+            (curies_1, vectors_1), (curies_2, vectors_2) = cached_1, cached_2
+            curies, indices_1, indices_2 = np.intersect1d(
+                curies_1, curies_2, assume_unique=True, return_indices=True,
+            )
+            return decode_curies(curies), vectors_1[indices_1], vectors_2[indices_2]
+
+    curies = []
+    blocks_1 = [np.empty((0, collection_1.dimensions), dtype=np.float32)]
+    blocks_2 = [np.empty((0, collection_2.dimensions), dtype=np.float32)]
+    chunks = iter_aligned_chunks(object_session(collection_1), collection_1, collection_2)
+    for chunk_curies, vectors_1, vectors_2 in chunks:
+        curies.extend(chunk_curies)
+        blocks_1.append(vectors_1)
+        blocks_2.append(vectors_2)
+    return curies, np.concatenate(blocks_1), np.concatenate(blocks_2)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""Optional partitioning of the embedding table by collection on PostgreSQL.
+
+When :data:`Config.partition_embeddings` is set, :func:`embeddingdb.sql.models.create_all` creates the
+embedding table on PostgreSQL as a table partitioned by ``LIST (collection_id)`` with one partition per
+collection. Queries that filter on a single collection are then pruned to its partition by the planner,
+and deleting a collection drops its partition instead of deleting its rows.
+
+A collection uploaded to replace another one (see :func:`embeddingdb.sql.manage.replace_collection`) is
+written to a table that isn't attached yet, whose rows are already labeled with the replaced collection.
+Replacing the collection then drops its partition and attaches that table in its place, which doesn't touch
+the rows at all.
+
+The parent table has no indexes. Each partition's primary key and unique index on the entity are built
+once its collection has been uploaded, rather than being maintained row by row during the upload.
+
+Other databases, and PostgreSQL databases whose embedding table was created without partitioning, keep
+the single table with global indexes. All functions here are no-ops for them.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connectable
+from sqlalchemy.orm import Session
+
+from .models import COLLECTION_TABLE_NAME, EMBEDDING_TABLE_NAME, ENTITY_TABLE_NAME
+
+__all__ = [
+    'is_partitioned',
+    'get_partition_name',
+    'create_partitioned_embedding_table',
+    'create_partition',
+    'create_replacement_partition',
+    'index_partition',
+    'truncate_partition',
+    'drop_partition',
+    'swap_partition',
+]
+
+
+def is_partitioned(bind: Connectable) -> bool:
+    """Check if the embedding table is partitioned by collection at the given engine or connection."""
+    if bind.dialect.name != 'postgresql':
+        return False
+    return bool(bind.execute(
+        text('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table_name)'),
+        table_name=EMBEDDING_TABLE_NAME,
+    ).scalar())
+
+
+def get_partition_name(collection_id: int) -> str:
+    """Get the name of the partition of the embedding table holding the given collection."""
+    return f'{EMBEDDING_TABLE_NAME}_{int(collection_id)}'
+
+
+def create_partitioned_embedding_table(bind: Connectable) -> None:
+    """Create the embedding table partitioned by collection, if it doesn't exist yet."""
+    bind.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS {EMBEDDING_TABLE_NAME} (
+            id SERIAL NOT NULL,
+            entity_id INTEGER NOT NULL REFERENCES {ENTITY_TABLE_NAME} (id),
+            vector BYTEA NOT NULL,
+            collection_id INTEGER NOT NULL REFERENCES {COLLECTION_TABLE_NAME} (id) ON DELETE CASCADE
+        ) PARTITION BY LIST (collection_id)
+    '''))
+
+
+def create_partition(session: Session, collection_id: int) -> bool:
+    """Create the partition for a collection without indexes, if the table is partitioned.
+
+    :return: If the embedding table is partitioned
+    """
+    if not is_partitioned(session.connection()):
+        return False
+    session.execute(text(
+        f'CREATE TABLE IF NOT EXISTS {get_partition_name(collection_id)}'
+        f' PARTITION OF {EMBEDDING_TABLE_NAME} FOR VALUES IN ({int(collection_id)})'
+    ))
+    return True
+
+
+def create_replacement_partition(session: Session, staging_id: int, collection_id: int) -> bool:
+    """Create a detached partition for a staging collection that will replace another one, if it doesn't exist.
+
+    The rows written to it should be labeled with the replaced collection, which is enforced by a check
+    constraint. The constraint, along with the same foreign keys as the embedding table, lets
+    :func:`swap_partition` attach it without scanning it.
+
+    :param session: A database session
+    :param staging_id: The database identifier of the staging collection, which names the partition
+    :param collection_id: The database identifier of the collection to replace, which labels the rows
+    :return: If the embedding table is partitioned
+    """
+    if not is_partitioned(session.connection()):
+        return False
+    name = get_partition_name(staging_id)
+    session.execute(text(f'''
+        CREATE TABLE IF NOT EXISTS {name} (
+            LIKE {EMBEDDING_TABLE_NAME} INCLUDING DEFAULTS,
+            FOREIGN KEY (entity_id) REFERENCES {ENTITY_TABLE_NAME} (id),
+            FOREIGN KEY (collection_id) REFERENCES {COLLECTION_TABLE_NAME} (id) ON DELETE CASCADE,
+            CONSTRAINT {name}_collection_id_check CHECK (collection_id = {int(collection_id)})
+        )
+    '''))
+    return True
+
+
+def index_partition(session: Session, collection_id: int) -> bool:
+    """Build the primary key and the unique index on the entity for a collection's partition, if missing.
+
+    This is done after a collection is uploaded, since building an index at once is much faster than
+    maintaining it for every inserted row.
+
+    :return: If the embedding table is partitioned
+    """
+    if not is_partitioned(session.connection()):
+        return False
+    name = get_partition_name(collection_id)
+    session.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {name}_entity_id ON {name} (entity_id)'))
+    has_primary_key = session.execute(
+        text("SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(:name) AND contype = 'p'"),
+        dict(name=name),
+    ).scalar()
+    if not has_primary_key:
+        session.execute(text(f'ALTER TABLE {name} ADD PRIMARY KEY (id)'))
+    session.execute(text(f'ANALYZE {name}'))
+    return True
+
+
+def truncate_partition(session: Session, collection_id: int) -> bool:
+    """Remove all of the rows in a collection's partition, if the table is partitioned.
+
+    :return: If the embedding table is partitioned
+    """
+    if not is_partitioned(session.connection()):
+        return False
+    session.execute(text(f'TRUNCATE TABLE {get_partition_name(collection_id)}'))
+    return True
+
+
+def drop_partition(session: Session, collection_id: int) -> bool:
+    """Drop a collection's partition, if the table is partitioned.
+
+    :return: If the embedding table is partitioned
+    """
+    if not is_partitioned(session.connection()):
+        return False
+    session.execute(text(f'DROP TABLE IF EXISTS {get_partition_name(collection_id)}'))
+    return True
+
+
+def swap_partition(session: Session, collection_id: int, staging_id: int) -> int:
+    """Replace a collection's partition with a staging collection's partition, without committing.
+
+    If the staging partition was created by :func:`create_replacement_partition`, the collection's partition
+    is dropped, then the staging partition and its indexes are renamed and it is attached in its place, so
+    the swap takes constant time. Otherwise, the staging partition's rows are still labeled with the staging
+    collection and have to be relabeled first, after detaching it and dropping its indexes so they're built
+    again at once rather than maintained row by row.
+
+    :param session: A database session whose embedding table is partitioned
+    :param collection_id: The database identifier of the collection to replace
+    :param staging_id: The database identifier of the collection holding the new embeddings
+    :return: The number of embeddings moved
+    """
+    name, staging_name = get_partition_name(collection_id), get_partition_name(staging_id)
+    create_partition(session, staging_id)
+    is_attached = session.execute(
+        text('SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(:name)'),
+        dict(name=staging_name),
+    ).scalar()
+    session.execute(text(f'DROP TABLE IF EXISTS {name}'))
+    if is_attached:
+        for statement in (
+            f'ALTER TABLE {EMBEDDING_TABLE_NAME} DETACH PARTITION {staging_name}',
+            f'ALTER TABLE {staging_name} DROP CONSTRAINT IF EXISTS {staging_name}_pkey',
+            f'DROP INDEX IF EXISTS {staging_name}_entity_id',
+        ):
+            session.execute(text(statement))
+        total = session.execute(
+            text(f'UPDATE {staging_name} SET collection_id = :collection_id'),
+            dict(collection_id=int(collection_id)),
+        ).rowcount
+    else:
+        total = session.execute(text(f'SELECT count(*) FROM {staging_name}')).scalar()
+
+    for statement in (
+        f'ALTER TABLE {staging_name} RENAME TO {name}',
+        f'ALTER INDEX IF EXISTS {staging_name}_entity_id RENAME TO {name}_entity_id',
+        f'ALTER INDEX IF EXISTS {staging_name}_pkey RENAME TO {name}_pkey',
+        f'ALTER TABLE {EMBEDDING_TABLE_NAME} ATTACH PARTITION {name} FOR VALUES IN ({int(collection_id)})',
+        # the partition's bound makes the check constraint of a replacement partition redundant
+        f'ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {staging_name}_collection_id_check',
+    ):
+        session.execute(text(statement))
+    index_partition(session, collection_id)
+    return total
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""The regressions used to compare collections, by their shortcut names.
+
+This module imports :mod:`sklearn`, which is slow, so :mod:`embeddingdb.sql.analysis` only imports it
+once a regression is run.
+"""
+
+import numpy as np
+from sklearn.base import BaseEstimator, RegressorMixin
+from sklearn.cross_decomposition import CCA, PLSRegression
+from sklearn.linear_model import (
+    LinearRegression, MultiTaskElasticNet, MultiTaskElasticNetCV, MultiTaskLasso,
+    MultiTaskLassoCV, SGDRegressor,
+)
+from sklearn.multioutput import MultiOutputRegressor
+
+__all__ = [
+    'REGRESSIONS',
+    'STREAMING_REGRESSIONS',
+    'StreamingLinearRegression',
+]
+
+
+class StreamingLinearRegression(BaseEstimator, RegressorMixin):
+    """Ordinary least squares fit from mini-batches.
+
+    Each call to :meth:`partial_fit` adds the batch to the accumulated ``X^T X`` and ``X^T Y`` (with a
+    column of ones for the intercept), then the normal equations are solved again, so the coefficients
+    always match a fit on all of the batches seen so far.
+    """
+
+    def __init__(self, alpha: float = 0.0) -> None:
+        """Initialize the regression.
+
+        :param alpha: An optional ridge penalty on the coefficients (not the intercept), which keeps the
+         normal equations solvable when features are collinear
+        """
+        self.alpha = alpha
+
+    def partial_fit(self, x: np.ndarray, y: np.ndarray) -> 'StreamingLinearRegression':
+        """Add a batch to the fit."""
+        x = np.hstack([np.asarray(x, dtype=np.float64), np.ones((len(x), 1))])
+        y = np.asarray(y, dtype=np.float64)
+        if not hasattr(self, 'xtx_'):
+            self.xtx_ = np.zeros((x.shape[1], x.shape[1]))
+            self.xty_ = np.zeros((x.shape[1], y.shape[1]))
+        self.xtx_ += x.T @ x
+        self.xty_ += x.T @ y
+
+        penalty = np.full(len(self.xtx_), self.alpha)
+        penalty[-1] = 0
+        beta, *_ = np.linalg.lstsq(self.xtx_ + np.diag(penalty), self.xty_, rcond=None)
+        self.coef_ = beta[:-1].T
+        self.intercept_ = beta[-1]
+        return self
+
+    def fit(self, x: np.ndarray, y: np.ndarray) -> 'StreamingLinearRegression':
+        """Fit on all of the data at once."""
+        for attribute in ('xtx_', 'xty_'):
+            if hasattr(self, attribute):
+                delattr(self, attribute)
+        return self.partial_fit(x, y)
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """Predict the targets for the given features."""
+        return np.asarray(x, dtype=np.float64) @ self.coef_.T + self.intercept_
+
+
+def _get_sgd_regression(**kwargs) -> MultiOutputRegressor:
+    """Get a multi-output regression that fits one stochastic gradient descent regression per target."""
+    return MultiOutputRegressor(SGDRegressor(**kwargs))
+
+
+#: Regressions that are fit on all of the aligned entities at once
+REGRESSIONS = {
+    'linear': LinearRegression,
+    'pls': PLSRegression,
+    'cca': CCA,
+    'elastic': MultiTaskElasticNet,
+    'elastic-cv': MultiTaskElasticNetCV,
+    'lasso': MultiTaskLasso,
+    'lasso-cv': MultiTaskLassoCV,
+    # 'svr': sklearn.svm.SVR,
+}
+
+#: Regressions that can be fit from mini-batches with ``partial_fit``
+STREAMING_REGRESSIONS = {
+    'least-squares': StreamingLinearRegression,
+    'sgd': _get_sgd_regression,
+}
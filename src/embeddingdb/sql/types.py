@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""A compact binary column type for storing vectors.
+
+Each vector is stored as packed little-endian bytes preceded by a one byte tag for its data type:
+
+- ``float32``: the values as 4-byte floats
+- ``float16``: the values as 2-byte floats
+- ``int8``: a 4-byte float scale followed by the values quantized to signed bytes,
+  such that ``value ~= scale * quantized``
+
+Since the encoding is self-describing, collections stored with different data types can live in the same
+table and every vector decodes straight into a :class:`numpy.ndarray` with :func:`numpy.frombuffer`.
+"""
+
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+from ..constants import config
+
+__all__ = [
+    'DTYPES',
+    'Vector',
+    'encode_vector',
+    'encode_vectors',
+    'decode_vector',
+    'decode_vectors',
+]
+
+_FLOAT32, _FLOAT16, _INT8 = 1, 2, 3
+
+#: The names of the supported data types mapped to their tags
+DTYPES = {
+    'float32': _FLOAT32,
+    'float16': _FLOAT16,
+    'int8': _INT8,
+}
+
+_TAG_TO_DTYPE = {
+    _FLOAT32: np.dtype('<f4'),
+    _FLOAT16: np.dtype('<f2'),
+    _INT8: np.dtype('i1'),
+}
+
+_SCALE_DTYPE = np.dtype('<f4')
+
+
+def _get_tag(dtype: Optional[str]) -> int:
+    if dtype is None:
+        dtype = config.vector_dtype
+    try:
+        return DTYPES[dtype]
+    except KeyError:
+        raise ValueError(f'invalid vector dtype: {dtype}. Should be one of {sorted(DTYPES)}') from None
+
+
+def encode_vector(vector: Sequence[float], dtype: Optional[str] = None) -> bytes:
+    """Encode a vector as packed bytes.
+
+    :param vector: A one dimensional sequence of numbers
+    :param dtype: The data type to store, one of :data:`DTYPES`. Defaults to :data:`Config.vector_dtype`.
+    """
+    return encode_vectors(np.asarray(vector, dtype=np.float32)[np.newaxis, :], dtype=dtype)[0]
+
+
+def encode_vectors(vectors: np.ndarray, dtype: Optional[str] = None) -> List[bytes]:
+    """Encode the rows of a matrix as packed bytes.
+
+    :param vectors: A two dimensional array whose rows are vectors
+    :param dtype: The data type to store, one of :data:`DTYPES`. Defaults to :data:`Config.vector_dtype`.
+    """
+    tag = _get_tag(dtype)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    prefix = bytes([tag])
+    if tag != _INT8:
+        data = vectors.astype(_TAG_TO_DTYPE[tag], copy=False)
+        return [prefix + row.tobytes() for row in data]
+
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    data = np.rint(vectors / scales[:, np.newaxis]).astype(np.int8)
+    return [
+        prefix + scale.tobytes() + row.tobytes()
+        for scale, row in zip(scales.astype(_SCALE_DTYPE), data)
+    ]
+
+
+def decode_vector(value: bytes) -> np.ndarray:
+    """Decode packed bytes into a float32 vector."""
+    tag = value[0]
+    if tag == _INT8:
+        scale = np.frombuffer(value, dtype=_SCALE_DTYPE, count=1, offset=1)[0]
+        return np.frombuffer(value, dtype=_TAG_TO_DTYPE[tag], offset=5) * scale
+    try:
+        dtype = _TAG_TO_DTYPE[tag]
+    except KeyError:
+        raise ValueError(f'invalid vector tag: {tag}') from None
+    return np.frombuffer(value, dtype=dtype, offset=1).astype(np.float32, copy=False)
+
+
+def decode_vectors(values: Iterable[bytes], dimensions: int) -> np.ndarray:
+    """Decode many packed vectors of the same dimension into a float32 matrix.
+
+    When all vectors share the same tag, the joined buffer is decoded with a single call to
+    :func:`numpy.frombuffer`.
+    """
+    values = list(values)
+    if not values:
+        return np.empty((0, dimensions), dtype=np.float32)
+    tags = {value[0] for value in values}
+    if len(tags) != 1:
+        return np.vstack([decode_vector(value) for value in values])
+
+    tag = tags.pop()
+    dtype = _TAG_TO_DTYPE[tag]
+    header = 5 if tag == _INT8 else 1
+    width = header + dimensions * dtype.itemsize
+    buffer = np.frombuffer(b''.join(values), dtype=np.uint8)
+    if buffer.size != width * len(values):
+        raise ValueError(f'vectors do not all have {dimensions} dimensions')
+    rows = buffer.reshape(len(values), width)
+    result = rows[:, header:].copy().view(dtype).astype(np.float32)
+    if tag == _INT8:
+        result *= rows[:, 1:5].copy().view(_SCALE_DTYPE)
+    return result
+
+
+class Vector(TypeDecorator):
+    """A column type for vectors stored as packed bytes.
+
+    Values are bound from any one dimensional sequence of numbers (or already encoded bytes) and loaded
+    as float32 :class:`numpy.ndarray` instances.
+    """
+
+    impl = LargeBinary
+
+    def __init__(self, dtype: Optional[str] = None, *args, **kwargs) -> None:
+        """Initialize the column type.
+
+        :param dtype: The data type to store, one of :data:`DTYPES`. Defaults to :data:`Config.vector_dtype`
+         at the time each value is bound.
+        """
+        super().__init__(*args, **kwargs)
+        if dtype is not None:
+            _get_tag(dtype)
+        self.dtype = dtype
+
+    def process_bind_param(self, value, dialect):  # noqa: D102
+        if value is None or isinstance(value, bytes):
+            return value
+        return encode_vector(value, dtype=self.dtype)
+
+    def process_result_value(self, value, dialect):  # noqa: D102
+        if value is None:
+            return None
+        return decode_vector(bytes(value))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Generate synthetic collections for testing and benchmarking.
+
+Vectors are drawn with :mod:`numpy` one block of rows at a time and yielded as chunks that can be
+passed straight to :func:`embeddingdb.sql.bulk.bulk_insert_chunks`, so collections of millions of rows
+are generated with bounded memory.
+
+The CURIEs of the ``i``-th of several generated collections are the rows ``i * shift`` to
+``i * shift + rows`` with ``shift = round(rows * (1 - overlap))``, so consecutive collections share the
+given fraction of their entities, which exercises the code aligning and overlapping collections.
+"""
+
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .constants import config
+from .parsers import Chunk
+
+__all__ = [
+    'DISTRIBUTIONS',
+    'iter_synthetic_chunks',
+    'get_curie_offset',
+]
+
+#: The distributions vectors can be drawn from
+DISTRIBUTIONS = ('normal', 'uniform', 'exponential', 'clustered')
+
+#: The number of clusters the ``clustered`` distribution's vectors are drawn around
+_CLUSTERS = 32
+
+
+def get_curie_offset(index: int, rows: int, overlap: float) -> int:
+    """Get the first row of the ``index``-th of several collections sharing the given fraction of rows.
+
+    :param index: The position of the collection among the generated collections
+    :param rows: The number of rows per collection
+    :param overlap: The fraction of rows consecutive collections share, between 0 and 1
+    """
+    if not 0 <= overlap <= 1:
+        raise ValueError(f'overlap should be between 0 and 1: {overlap}')
+    return index * round(rows * (1 - overlap))
+
+
+def iter_synthetic_chunks(
+        rows: int,
+        dimensions: int,
+        *,
+        distribution: str = 'normal',
+        offset: int = 0,
+        prefix: str = 'test',
+        seed: Optional[int] = 0,
+        chunk_size: Optional[int] = None,
+) -> Iterable[Chunk]:
+    """Generate chunks of random float32 vectors labeled ``<prefix>:<row>``.
+
+    :param rows: The number of rows
+    :param dimensions: The number of dimensions
+    :param distribution: One of :data:`DISTRIBUTIONS`. ``normal`` and ``uniform`` are centered on zero,
+     ``exponential`` has a random rate between 1 and 5, and ``clustered`` draws vectors around random centers.
+    :param offset: The number of the first row, e.g., from :func:`get_curie_offset`
+    :param prefix: The prefix of the CURIEs
+    :param seed: The seed of the random number generator
+    :param chunk_size: The number of rows per chunk. Defaults to :data:`Config.batch_size`.
+    """
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f'invalid distribution: {distribution}. Should be one of {DISTRIBUTIONS}')
+    if chunk_size is None:
+        chunk_size = config.batch_size
+
+    random_state = np.random.default_rng(seed)
+    if distribution == 'exponential':
+        scale = 1 / random_state.integers(1, 6)
+    elif distribution == 'clustered':
+        centers = random_state.standard_normal((_CLUSTERS, dimensions), dtype=np.float32)
+
+    for start in range(0, rows, chunk_size):
+        size = min(chunk_size, rows - start)
+        if distribution == 'normal':
+            vectors = random_state.standard_normal((size, dimensions), dtype=np.float32)
+        elif distribution == 'uniform':
+            vectors = random_state.random((size, dimensions), dtype=np.float32)
+            vectors *= 2
+            vectors -= 1
+        elif distribution == 'exponential':
+            vectors = random_state.standard_exponential((size, dimensions), dtype=np.float32)
+            vectors *= scale
+        else:
+            vectors = random_state.standard_normal((size, dimensions), dtype=np.float32)
+            vectors *= 0.1
+            vectors += centers[random_state.integers(_CLUSTERS, size=size)]
+
+        first = offset + start
+        yield [f'{prefix}:{i}' for i in range(first, first + size)], vectors
@@ -2,11 +2,25 @@
 
 """A blueprint for a RESTful API."""
 
-from flask import Blueprint, jsonify
+import base64
+import hashlib
+import io
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from flask import Blueprint, Response, abort, jsonify, request, stream_with_context
 from sqlalchemy import and_
 
+from embeddingdb import metrics
+from embeddingdb.cache import get_response_cache
+from embeddingdb.constants import config
+from embeddingdb.search import METRICS, Neighbor, get_loaded_index, get_neighbors
+from embeddingdb.sql.analysis import calculate_overlap
+from embeddingdb.sql.export import EXPORT_FORMATS, EXPORT_MIMETYPES, iter_export, iter_gzip
 from embeddingdb.sql.io import load_random
-from embeddingdb.sql.models import Base, Collection, Embedding
+from embeddingdb.sql.models import (
+    Collection, Embedding, Entity, get_embeddings, get_entity_embeddings, is_complete,
+)
 from embeddingdb.web.ext import db
 
 __all__ = [
@@ -20,6 +34,19 @@ api = Blueprint(
 )
 
 
+@api.before_request
+def _start_request():
+    if config.metrics:
+        metrics.start_request()
+
+
+@api.after_request
+def _finish_request(response: Response) -> Response:
+    # streamed responses are timed until their headers are ready
+    metrics.finish_request(request.endpoint, request.method, response.status_code)
+    return response
+
+
 def _collection_to_json(collection: Collection):
     return {
         'id': collection.id,
@@ -35,32 +62,134 @@ def _collection_to_json(collection: Collection):
 def _embedding_to_json(embedding: Embedding):
     return {
         'curie': embedding.curie,
-        'vector': embedding.vector,
+        'vector': embedding.vector.tolist(),
         'collection': _collection_to_json(embedding.collection),
     }
 
 
+def _neighbors_to_json(neighbors: List[Neighbor]):
+    return [
+        {
+            'curie': curie,
+            'similarity': similarity,
+        }
+        for curie, similarity in neighbors
+    ]
+
+
+def _get_collection_or_404(collection_id: int) -> Collection:
+    collection = db.session.query(Collection).filter(Collection.id == collection_id, is_complete()).first()
+    if collection is None:
+        abort(404, f'collection {collection_id} does not exist')
+    return collection
+
+
+def _get_etag(versions: Sequence[Tuple[int, str]]) -> str:
+    """Derive an ETag for the current request from the versions of the collections its response describes."""
+    key = request.full_path + ''.join(f'|{collection_id}:{version}' for collection_id, version in versions)
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _cached_json(
+        versions: Sequence[Tuple[int, str]],
+        build: Callable[[], Any],
+        collection_id: Optional[int] = None,
+) -> Response:
+    """Respond with JSON that only changes with the versions of the given collections.
+
+    Clients sending a matching ``If-None-Match`` get a 304. Otherwise, the response is served from the
+    response cache or built, serialized, and cached.
+
+    :param versions: Pairs of identifiers and versions of the collections the response describes
+    :param build: A function building the JSON-serializable response
+    :param collection_id: The identifier of the collection the response describes or None for all
+    """
+    etag = _get_etag(versions)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        cache = get_response_cache()
+        body = cache.get(etag, collection_id) if cache is not None else None
+        if body is None:
+            body = jsonify(build()).get_data()
+            if cache is not None:
+                cache.put(etag, body, collection_id)
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # collections can be replaced, so clients should revalidate
+    response.cache_control.no_cache = True
+    return response
+
+
+def _get_version_or_404(collection_id: int) -> str:
+    version = db.session.query(Collection.version).filter(Collection.id == collection_id, is_complete()).scalar()
+    if version is None:
+        abort(404, f'collection {collection_id} does not exist')
+    return version
+
+
+def _get_search_args(args):
+    """Get the keyword arguments for :func:`get_neighbors` from query arguments or a JSON body."""
+    try:
+        k = int(args.get('k', 10))
+        nprobe = args.get('nprobe')
+        nprobe = None if nprobe is None else int(nprobe)
+    except (TypeError, ValueError):
+        return abort(400, 'k and nprobe should be integers')
+    metric = args.get('metric', 'cosine')
+    if metric not in METRICS:
+        abort(400, f'invalid metric: {metric}. Should be one of {METRICS}')
+    if k < 1 or (nprobe is not None and nprobe < 1):
+        abort(400, 'k and nprobe should be positive')
+    exact = args.get('exact', False) in {True, 'true', '1'}
+    return dict(k=k, metric=metric, nprobe=nprobe, exact=exact)
+
+
 @api.route('/test')
 def add_test_data():
-    """Add test data."""
-    Base.metadata.create_all(db.engine, checkfirst=True)
+    """Add test data.
+
+    The tables have to be created first with ``embeddingdb init``.
+    """
     collection = load_random(session=db.session, tqdm_kwargs=dict(desc='Adding test collection'))
     return jsonify(
         _collection_to_json(collection)
     )
 
 
+@api.route('/metrics')
+def get_metrics():
+    """Return the metrics of this process in the Prometheus text format.
+
+    These are the latencies of API requests by endpoint, the time spent executing SQL by statement shape
+    and per request, and the time spent in each stage of uploads.
+
+    ---
+    tags:
+        - metrics
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @api.route('/collection')
 def get_collections():
     """Return all collections.
 
+    The response has an ETag that changes when any collection is added, changed, or deleted.
+
     ---
     tags:
         - collection
     """
-    return jsonify([
+    versions = (
+        db.session.query(Collection.id, Collection.version)
+        .filter(is_complete())
+        .order_by(Collection.id)
+        .all()
+    )
+    return _cached_json(versions, lambda: [
         _collection_to_json(collection)
-        for collection in db.session.query(Collection)
+        for collection in db.session.query(Collection).filter(is_complete()).order_by(Collection.id)
     ])
 
 
@@ -68,6 +197,8 @@ def get_collections():
 def get_collection(collection_id: int):
     """Return a collection.
 
+    The response has an ETag that changes when the collection changes.
+
     ---
     tags:
         - collection
@@ -78,17 +209,63 @@ def get_collection(collection_id: int):
         required: true
         type: integer
     """
-    collection = db.session.query(Collection).get(collection_id)
-
-    return jsonify(
-        _collection_to_json(collection)
+    version = _get_version_or_404(collection_id)
+    return _cached_json(
+        [(collection_id, version)],
+        lambda: _collection_to_json(_get_collection_or_404(collection_id)),
+        collection_id,
     )
 
 
+@api.route('/collection/<int:collection_id>/export')
+def export_collection(collection_id: int):
+    """Stream a whole collection.
+
+    The embeddings are read from the database in chunks and sent as they're serialized, with chunked
+    transfer encoding and compressed with gzip if the client accepts it. The ``npy`` format is a float32
+    matrix whose rows are labeled by the ``curies`` format, both ordered by CURIE. The ``arrow`` and
+    ``parquet`` formats require ``pyarrow`` and can be uploaded again with ``embeddingdb upload``.
+
+    ---
+    tags:
+        - collection
+    parameters:
+      - name: collection_id
+        in: path
+        description: The database collection identifier
+        required: true
+        type: integer
+      - name: format
+        in: query
+        description: The export format
+        required: false
+        type: string
+        enum: [ndjson, word2vec, npy, curies, arrow, parquet]
+        default: ndjson
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return abort(400, f'invalid format: {fmt}. Should be one of {EXPORT_FORMATS}')
+    collection = _get_collection_or_404(collection_id)
+
+    data = iter_export(collection, fmt)
+    headers = {
+        'Content-Disposition': f'attachment; filename=collection-{collection_id}.{fmt}',
+        'X-Collection-Version': collection.version,
+    }
+    # arrow and parquet are compressed by their own encodings
+    if fmt not in {'arrow', 'parquet'} and 'gzip' in request.accept_encodings:
+        data = iter_gzip(data)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(data), mimetype=EXPORT_MIMETYPES[fmt], headers=headers)
+
+
 @api.route('/collection/<int:collection_id>/<curie>')
 def get_collection_embedding(collection_id: int, curie: str):
     """Return an entity in a collection.
 
+    The response has an ETag that changes when the collection changes.
+
     ---
     tags:
         - collection
@@ -105,22 +282,149 @@ def get_collection_embedding(collection_id: int, curie: str):
         required: true
         type: string
     """
-    conditions = and_(
-        Embedding.curie == curie,
-        Embedding.collection_id == collection_id
-    )
+    version = _get_version_or_404(collection_id)
 
-    embedding = db.session.query(Embedding).filter(conditions).one_or_none()
+    def build():
+        conditions = and_(
+            Entity.curie == curie,
+            Embedding.collection_id == collection_id
+        )
+        embedding = db.session.query(Embedding).join(Entity).filter(conditions).one_or_none()
+        if embedding is None:
+            abort(404, f'{curie} is not in collection {collection_id}')
+        return _embedding_to_json(embedding)
 
-    return jsonify(
-        _embedding_to_json(embedding)
+    return _cached_json([(collection_id, version)], build, collection_id)
+
+
+#: The formats of batch lookup responses
+EMBEDDING_FORMATS = ('json', 'base64', 'npz')
+
+
+@api.route('/collection/<int:collection_id>/embeddings', methods=['POST'])
+def post_collection_embeddings(collection_id: int):
+    """Return the embeddings for many entities in a collection.
+
+    The body is a JSON object with a list of CURIEs under ``curies``. The response lists the CURIEs that
+    were found, their vectors in the same order, and the CURIEs that were missing. With the ``base64``
+    format, the vectors are a base64-encoded little-endian float32 matrix. With the ``npz`` format, the
+    response is a NumPy ``.npz`` archive with the arrays ``curies``, ``vectors``, and ``missing``.
+
+    ---
+    tags:
+        - collection
+        - entity
+    parameters:
+      - name: collection_id
+        in: path
+        description: The database collection identifier
+        required: true
+        type: integer
+      - name: format
+        in: query
+        description: The response format
+        required: false
+        type: string
+        enum: [json, base64, npz]
+        default: json
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            curies:
+              type: array
+              items:
+                type: string
+    """
+    fmt = request.args.get('format', 'json')
+    if fmt not in EMBEDDING_FORMATS:
+        return abort(400, f'invalid format: {fmt}. Should be one of {EMBEDDING_FORMATS}')
+    body = request.get_json(force=True)
+    curies = body.get('curies') if isinstance(body, dict) else None
+    if not isinstance(curies, list) or not all(isinstance(curie, str) for curie in curies):
+        return abort(400, 'curies should be a list of strings')
+
+    # collections already in memory, e.g., preloaded by ``embeddingdb serve``, are read without the database
+    collection = _get_collection_or_404(collection_id)
+    index = get_loaded_index(collection)
+    if index is not None:
+        found, vectors, missing = index.get_vectors(curies)
+    else:
+        found, vectors, missing = get_embeddings(db.session, collection_id, curies)
+
+    if fmt == 'npz':
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            curies=np.array(found, dtype=str),
+            vectors=vectors,
+            missing=np.array(missing, dtype=str),
+        )
+        return Response(buffer.getvalue(), mimetype='application/octet-stream')
+
+    rv = {
+        'collection': collection_id,
+        'curies': found,
+        'missing': missing,
+    }
+    if fmt == 'base64':
+        rv['vectors'] = base64.b64encode(vectors.astype('<f4').tobytes()).decode('ascii')
+        rv['dtype'] = '<f4'
+        rv['shape'] = list(vectors.shape)
+    else:
+        rv['vectors'] = vectors.tolist()
+    return jsonify(rv)
+
+
+def _entity_filters_from_args(args):
+    """Get the collection filters for entity lookups from query arguments."""
+    return dict(
+        collection_ids=args.getlist('collection_id', type=int) or None,
+        package_name=args.get('package_name'),
+        dimensions=args.get('dimensions', type=int),
     )
 
 
+def _entity_filters_from_json(body):
+    """Get the collection filters for entity lookups from a JSON body."""
+    try:
+        collection_ids = body.get('collection_ids')
+        dimensions = body.get('dimensions')
+        return dict(
+            collection_ids=None if collection_ids is None else [int(x) for x in collection_ids],
+            package_name=body.get('package_name'),
+            dimensions=None if dimensions is None else int(dimensions),
+        )
+    except (TypeError, ValueError):
+        return abort(400, 'collection_ids should be a list of integers and dimensions should be an integer')
+
+
+def _entities_to_json(collections: List[Collection], embeddings):
+    return {
+        'collections': {
+            collection.id: _collection_to_json(collection)
+            for collection in collections
+        },
+        'embeddings': [
+            {
+                'curie': curie,
+                'collection': collection_id,
+                'vector': vector.tolist(),
+            }
+            for curie, collection_id, vector in embeddings
+        ],
+    }
+
+
 @api.route('/entity/<curie>')
 def get_entity(curie: str):
     """Return an entity in all collections.
 
+    Each collection is described once under ``collections`` and referenced by its identifier from the
+    entries under ``embeddings``.
+
     ---
     tags:
         - entity
@@ -130,8 +434,230 @@ def get_entity(curie: str):
         description: The entity's CURIE
         required: true
         type: string
+      - name: collection_id
+        in: query
+        description: Only look in these collections
+        required: false
+        type: array
+        items:
+          type: integer
+        collectionFormat: multi
+      - name: package_name
+        in: query
+        description: Only look in collections made by this package
+        required: false
+        type: string
+      - name: dimensions
+        in: query
+        description: Only look in collections with this dimensionality
+        required: false
+        type: integer
     """
+    collections, embeddings = get_entity_embeddings(db.session, [curie], **_entity_filters_from_args(request.args))
+    return jsonify(_entities_to_json(collections, embeddings))
+
+
+@api.route('/entity', methods=['POST'])
+def post_entities():
+    """Return many entities in all collections.
+
+    The body is a JSON object with a list of CURIEs under ``curies`` and optionally the filters
+    ``collection_ids``, ``package_name``, and ``dimensions``. Each collection is described once under
+    ``collections`` and referenced by its identifier from the entries under ``embeddings``. CURIEs that
+    were not found in any collection are listed under ``missing``.
+
+    ---
+    tags:
+        - entity
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            curies:
+              type: array
+              items:
+                type: string
+            collection_ids:
+              type: array
+              items:
+                type: integer
+            package_name:
+              type: string
+            dimensions:
+              type: integer
+    """
+    body = request.get_json(force=True)
+    curies = body.get('curies') if isinstance(body, dict) else None
+    if not isinstance(curies, list) or not all(isinstance(curie, str) for curie in curies):
+        return abort(400, 'curies should be a list of strings')
+
+    collections, embeddings = get_entity_embeddings(db.session, curies, **_entity_filters_from_json(body))
+    rv = _entities_to_json(collections, embeddings)
+    found = {curie for curie, _, _ in embeddings}
+    rv['missing'] = [curie for curie in dict.fromkeys(curies) if curie not in found]
+    return jsonify(rv)
+
+
+@api.route('/overlap')
+def get_overlap():
+    """Return the number of entities shared by each pair of collections.
+
+    Each pair also has the Jaccard index of the collections' entities and their containment, i.e., the
+    overlap divided by the size of the smaller collection.
+
+    ---
+    tags:
+        - collection
+    parameters:
+      - name: collection_id
+        in: query
+        description: Only return the pairs involving these collections
+        required: false
+        type: array
+        items:
+          type: integer
+        collectionFormat: multi
+      - name: min_overlap
+        in: query
+        description: Only return the pairs sharing at least this many entities
+        required: false
+        type: integer
+    """
+    collection_ids = request.args.getlist('collection_id', type=int) or None
+    df = calculate_overlap(db.session, collection_ids=collection_ids)
+    df = df[df['overlap'] >= request.args.get('min_overlap', 0, type=int)]
+    return jsonify(df.to_dict(orient='records'))
+
+
+@api.route('/collection/<int:collection_id>/<curie>/neighbors')
+def get_collection_embedding_neighbors(collection_id: int, curie: str):
+    """Return the most similar entities to an entity in a collection.
+
+    ---
+    tags:
+        - collection
+        - entity
+        - search
+    parameters:
+      - name: collection_id
+        in: path
+        description: The database collection identifier
+        required: true
+        type: integer
+      - name: curie
+        in: path
+        description: The entity's CURIE
+        required: true
+        type: string
+      - name: k
+        in: query
+        description: The number of neighbors
+        required: false
+        type: integer
+        default: 10
+      - name: metric
+        in: query
+        description: The similarity metric
+        required: false
+        type: string
+        enum: [cosine, dot]
+        default: cosine
+      - name: nprobe
+        in: query
+        description: The number of inverted lists visited if the collection has an approximate index
+        required: false
+        type: integer
+      - name: exact
+        in: query
+        description: Use exact search even if the collection has an approximate index
+        required: false
+        type: boolean
+        default: false
+    """
+    search_kwargs = _get_search_args(request.args)
+    collection = _get_collection_or_404(collection_id)
+    try:
+        neighbors, = get_neighbors(collection, curies=[curie], **search_kwargs)
+    except KeyError:
+        return abort(404, f'{curie} is not in collection {collection_id}')
+    return jsonify(_neighbors_to_json(neighbors))
+
+
+@api.route('/collection/<int:collection_id>/neighbors', methods=['POST'])
+def post_collection_neighbors(collection_id: int):
+    """Return the most similar entities in a collection to each of several entities or vectors.
+
+    The body is a JSON object with either a list of CURIEs under ``curies`` or a list of vectors under
+    ``vectors``, and optionally ``k``, ``metric``, ``nprobe``, and ``exact``.
+
+    ---
+    tags:
+        - collection
+        - search
+    parameters:
+      - name: collection_id
+        in: path
+        description: The database collection identifier
+        required: true
+        type: integer
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            curies:
+              type: array
+              items:
+                type: string
+            vectors:
+              type: array
+              items:
+                type: array
+                items:
+                  type: number
+            k:
+              type: integer
+              default: 10
+            metric:
+              type: string
+              enum: [cosine, dot]
+              default: cosine
+            nprobe:
+              type: integer
+            exact:
+              type: boolean
+              default: false
+    """
+    body = request.get_json(force=True)
+    if not isinstance(body, dict):
+        return abort(400, 'must give a JSON object with either curies or vectors')
+    search_kwargs = _get_search_args(body)
+    collection = _get_collection_or_404(collection_id)
+
+    if 'curies' in body:
+        curies = body['curies']
+        if not isinstance(curies, list) or not all(isinstance(curie, str) for curie in curies):
+            return abort(400, 'curies should be a list of strings')
+        try:
+            results = get_neighbors(collection, curies=curies, **search_kwargs)
+        except KeyError as e:
+            return abort(404, f'{e.args[0]} is not in collection {collection_id}')
+    elif 'vectors' in body:
+        try:
+            vectors = np.asarray(body['vectors'], dtype=np.float32)
+        except (TypeError, ValueError):
+            return abort(400, f'vectors should be a list of lists of length {collection.dimensions}')
+        if vectors.ndim != 2 or vectors.shape[1] != collection.dimensions:
+            return abort(400, f'vectors should be a list of lists of length {collection.dimensions}')
+        results = get_neighbors(collection, vectors=vectors, **search_kwargs)
+    else:
+        return abort(400, 'must give either curies or vectors')
+
     return jsonify([
-        _embedding_to_json(embedding)
-        for embedding in db.session.query(Embedding).filter(Embedding.curie == curie)
+        _neighbors_to_json(neighbors)
+        for neighbors in results
     ])
@@ -2,9 +2,13 @@
 
 """A wrapper around creation of the web application."""
 
+from typing import Optional
+
 from flask import Flask
 
 from embeddingdb.constants import config
+from embeddingdb.metrics import install_sqlalchemy_hooks
+from embeddingdb.sql.models import get_engine_options
 from embeddingdb.web.api import api
 from embeddingdb.web.ext import db, swagger
 
@@ -13,16 +17,25 @@ __all__ = [
 ]
 
 
-def get_app() -> Flask:
-    """Build a Flask instance."""
+def get_app(connection: Optional[str] = None) -> Flask:
+    """Build a Flask instance.
+
+    :param connection: The SQLAlchemy connection string. Defaults to :data:`Config.connection`.
+    """
+    if connection is None:
+        connection = config.connection
+
     app = Flask(__name__)
 
     # Set configuration
-    app.config['SQLALCHEMY_DATABASE_URI'] = config.connection
+    app.config['SQLALCHEMY_DATABASE_URI'] = connection
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(connection)
 
     # Initialize extensions
     db.init_app(app)
+    with app.app_context():
+        install_sqlalchemy_hooks(db.engine)
     swagger.init_app(app)
 
     # Register blueprints
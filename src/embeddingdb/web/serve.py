@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+"""Serve the web application with :mod:`gunicorn`'s pre-forked workers.
+
+The collections listed in :data:`Config.web_preload` (or given with ``--preload``) are loaded into pinned
+indexes (see :func:`embeddingdb.search.get_index`) before the workers are forked, so all workers read the
+same matrices rather than each loading its own copy. Matrices memory-mapped from the cache (see
+:mod:`embeddingdb.cache`) are shared through the page cache, and matrices loaded into memory are shared
+copy-on-write, since they're never written. The similarity and batch lookup endpoints are served from
+these matrices.
+
+Database connections opened while preloading are closed before forking, since they can't be shared by
+processes.
+"""
+
+import gc
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import click
+
+from ..constants import config
+from ..search import ExactIndex, METRICS, get_index
+from ..sql.models import Collection, get_engine, get_session
+
+__all__ = [
+    'get_preload_ids',
+    'preload_collections',
+    'serve',
+    'main',
+]
+
+
+def get_preload_ids(value: Optional[str] = None) -> List[int]:
+    """Parse comma-separated identifiers of collections.
+
+    :param value: The identifiers. Defaults to :data:`Config.web_preload`.
+    """
+    if value is None:
+        value = config.web_preload
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+def preload_collections(
+        collection_ids: Iterable[int],
+        metrics: Sequence[str] = ('cosine',),
+        connection: Optional[str] = None,
+) -> List[ExactIndex]:
+    """Load the indexes of collections and pin them in memory, before forking workers that share them.
+
+    :param collection_ids: The identifiers of the collections
+    :param metrics: The metrics to load indexes for. Indexes of the same collection share its matrix.
+    :param connection: The SQLAlchemy connection string. Defaults to :data:`Config.connection`.
+    :raises KeyError: If a collection does not exist
+    """
+    session = get_session(connection)
+    try:
+        indexes = []
+        for collection_id in collection_ids:
+            collection = session.query(Collection).get(collection_id)
+            if collection is None:
+                raise KeyError(collection_id)
+            for metric in metrics:
+                indexes.append(get_index(collection, metric=metric, pin=True))
+    finally:
+        session.close()
+        get_engine(connection).dispose()
+    # keep the garbage collector from writing to (and so copying) the pages of the preloaded objects
+    gc.collect()
+    gc.freeze()
+    return indexes
+
+
+def serve(
+        app,
+        bind: Optional[str] = None,
+        workers: Optional[int] = None,
+        threads: Optional[int] = None,
+        options: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Serve a WSGI application with :mod:`gunicorn`, forking the workers from this process.
+
+    :param app: A WSGI application, e.g., from :func:`embeddingdb.web.app.get_app`
+    :param bind: The address to listen on. Defaults to :data:`Config.web_bind`.
+    :param workers: The number of worker processes. Defaults to :data:`Config.web_workers`. If 0, one per CPU.
+    :param threads: The number of threads per worker. Defaults to :data:`Config.web_threads`.
+    :param options: Other gunicorn settings
+    """
+    from gunicorn.app.base import BaseApplication
+
+    workers = workers if workers is not None else config.web_workers
+    threads = threads if threads is not None else config.web_threads
+    settings = {
+        'bind': bind if bind is not None else config.web_bind,
+        'workers': workers or os.cpu_count() or 1,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'preload_app': True,
+        **(options or {}),
+    }
+
+    class Application(BaseApplication):
+        def load_config(self) -> None:
+            for key, value in settings.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+@click.command()
+@click.option('-b', '--bind', default=config.web_bind, show_default=True)
+@click.option('-w', '--workers', type=int, default=config.web_workers, show_default=True,
+              help='Number of worker processes. 0 starts one per CPU.')
+@click.option('-t', '--threads', type=int, default=config.web_threads, show_default=True,
+              help='Number of threads per worker')
+@click.option('-p', '--preload', type=int, multiple=True, default=get_preload_ids(), show_default=True,
+              help='The identifier of a collection to load before forking the workers. Can be given multiple times.')
+@click.option('-m', '--metric', 'metrics', type=click.Choice(METRICS), multiple=True, default=['cosine'],
+              show_default=True, help='The similarity metric to preload indexes for. Can be given multiple times.')
+@click.option('--log-level', default='info', show_default=True)
+@config.get_connection_option()
+def main(
+        bind: str,
+        workers: int,
+        threads: int,
+        preload: Sequence[int],
+        metrics: Sequence[str],
+        log_level: str,
+        connection: str,
+):
+    """Serve the web application with pre-forked workers sharing preloaded collections."""
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        raise click.ClickException('gunicorn is required. Install it with: pip install embeddingdb[web]')
+    from .app import get_app
+
+    try:
+        indexes = preload_collections(preload, metrics=metrics, connection=connection)
+    except KeyError as e:
+        raise click.ClickException(f'collection {e.args[0]} does not exist')
+    for collection_id, index in zip((i for i in preload for _ in metrics), indexes):
+        click.echo(f'Preloaded collection {collection_id} ({len(index)} embeddings, {index.metric})', err=True)
+
+    serve(get_app(connection), bind=bind, workers=workers, threads=threads, options={'loglevel': log_level})
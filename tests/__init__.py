@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for :mod:`embeddingdb`.
+
+The configuration is read when :mod:`embeddingdb` is imported, so a connection string is set here if there
+isn't one. The tests that need a database make their own in a temporary directory (see :mod:`tests.cases`).
+"""
+
+import os
+
+os.environ.setdefault('EMBEDDINGDB_CONNECTION', 'sqlite://')
+os.environ['EMBEDDINGDB_CACHE_SIZE'] = '0'
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""Test cases for :mod:`embeddingdb`."""
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from embeddingdb.sql.models import Collection, create_all, get_engine, get_session
+
+__all__ = [
+    'TemporaryDatabaseCase',
+]
+
+
+class TemporaryDatabaseCase(unittest.TestCase):
+    """A test case with a fresh SQLite database in a temporary directory."""
+
+    def setUp(self) -> None:
+        """Create the database and open a session."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.connection = f'sqlite:///{os.path.join(self.directory.name, "test.db")}'
+        create_all(self.connection)
+        self.session = get_session(self.connection)
+
+    def tearDown(self) -> None:
+        """Close the session and remove the database."""
+        self.session.remove()
+        get_engine(self.connection).dispose()
+        self.directory.cleanup()
+
+    def load(self, collection: Collection):
+        """Get the CURIEs and vectors of a collection as a dictionary."""
+        curies, vectors = collection.load(use_cache=False)
+        return dict(zip(curies, np.asarray(vectors)))
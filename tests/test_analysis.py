@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the analyses of collections."""
+
+import numpy as np
+
+from embeddingdb.sql.analysis import calculate_overlap, update_overlaps
+from embeddingdb.sql.bulk import bulk_insert_chunks
+from embeddingdb.sql.models import Collection
+from tests.cases import TemporaryDatabaseCase
+
+
+class TestOverlap(TemporaryDatabaseCase):
+    """Test the cached overlaps between collections."""
+
+    def upload(self, start: int, stop: int) -> Collection:
+        """Upload a collection with a range of CURIEs."""
+        collection = Collection(dimensions=2, package_name='test', package_version='0.0.0')
+        curies = [f'test:{i:02}' for i in range(start, stop)]
+        bulk_insert_chunks(self.session, collection, [(curies, np.ones((len(curies), 2), dtype=np.float32))])
+        return collection
+
+    def test_single_collection(self):
+        """Test that the size of a single collection is only counted once."""
+        collection = self.upload(0, 10)
+        self.assertEqual({collection.id}, update_overlaps(self.session))
+        self.assertEqual(set(), update_overlaps(self.session))
+        self.assertTrue(calculate_overlap(self.session).empty)
+
+    def test_overlaps(self):
+        """Test that overlaps and sizes are counted and only counted again for changed collections."""
+        collection_1 = self.upload(0, 10)
+        collection_2 = self.upload(5, 20)
+        collection_3 = self.upload(30, 32)
+        self.assertEqual({collection_1.id, collection_2.id, collection_3.id}, update_overlaps(self.session))
+        self.assertEqual(set(), update_overlaps(self.session))
+
+        df = calculate_overlap(self.session)
+        self.assertEqual(
+            [
+                (collection_1.id, collection_2.id, 10, 15, 5),
+                (collection_1.id, collection_3.id, 10, 2, 0),
+                (collection_2.id, collection_3.id, 15, 2, 0),
+            ],
+            list(df[['collection_id_1', 'collection_id_2', 'size_1', 'size_2', 'overlap']].itertuples(
+                index=False, name=None,
+            )),
+        )
+        self.assertAlmostEqual(5 / 20, df['jaccard'][0])
+        self.assertAlmostEqual(5 / 10, df['containment'][0])
+
+        collection_4 = self.upload(0, 3)
+        self.assertEqual({collection_4.id}, update_overlaps(self.session))
+        df = calculate_overlap(self.session, [collection_4.id])
+        self.assertEqual([3, 0, 0], df['overlap'].tolist())
+        self.assertEqual([3, 3, 3], df['size_2'].tolist())
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for approximate nearest neighbor search."""
+
+import os
+import unittest
+
+import numpy as np
+
+from embeddingdb.ann import build_ivf_index, get_ivf_index_path, load_ivf_index
+from embeddingdb.cache import CollectionCache
+from embeddingdb.search import ExactIndex, METRICS
+from embeddingdb.sql.bulk import bulk_insert_chunks
+from embeddingdb.sql.models import Collection
+from tests.cases import TemporaryDatabaseCase
+
+
+class TestIVFIndex(unittest.TestCase):
+    """Test :class:`embeddingdb.ann.IVFIndex`."""
+
+    def setUp(self) -> None:
+        """Make a random matrix and queries."""
+        random_state = np.random.RandomState(0)
+        self.vectors = random_state.normal(size=(400, 16)).astype(np.float32)
+        self.curies = [f'test:{i:03}' for i in range(len(self.vectors))]
+        self.queries = random_state.normal(size=(20, 16)).astype(np.float32)
+
+    def test_all_lists(self):
+        """Test that visiting every list finds the exact neighbors."""
+        for metric in METRICS:
+            with self.subTest(metric=metric):
+                index = build_ivf_index(self.curies, self.vectors, metric=metric, n_lists=8)
+                positions, _ = ExactIndex(self.curies, self.vectors, metric=metric).search(self.queries, 10)
+                ivf_positions, _ = index.search(self.queries, 10, nprobe=index.n_lists)
+                np.testing.assert_array_equal(positions, ivf_positions)
+
+    def test_product_quantization(self):
+        """Test that re-ranking the candidates of quantized codes keeps most of the exact neighbors."""
+        index = build_ivf_index(self.curies, self.vectors, n_lists=8, subspaces=4, refine=10)
+        positions, _ = ExactIndex(self.curies, self.vectors).search(self.queries, 10)
+        ivf_positions, _ = index.search(self.queries, 10, nprobe=index.n_lists)
+        recall = np.mean([len(set(a) & set(b)) / 10 for a, b in zip(positions, ivf_positions)])
+        self.assertGreaterEqual(recall, 0.9)
+
+    def test_lists(self):
+        """Test that the number of lists is capped at the number of rows and that empty collections fail."""
+        index = build_ivf_index(self.curies[:5], self.vectors[:5], n_lists=8)
+        self.assertEqual(5, index.n_lists)
+        positions, _ = index.search(self.queries, 3, nprobe=5)
+        np.testing.assert_array_equal(ExactIndex(self.curies[:5], self.vectors[:5]).search(self.queries, 3)[0],
+                                      positions)
+        with self.assertRaises(ValueError):
+            build_ivf_index([], np.empty((0, 16), dtype=np.float32))
+        with self.assertRaises(ValueError):
+            build_ivf_index(self.curies, self.vectors, n_lists=0)
+
+
+class TestIVFIndexStorage(TemporaryDatabaseCase):
+    """Test storing :class:`embeddingdb.ann.IVFIndex` with the files derived from a collection."""
+
+    def test_eviction(self):
+        """Test that an index outlives the eviction of its collection's cache entry but not its invalidation."""
+        random_state = np.random.RandomState(0)
+        vectors = random_state.normal(size=(50, 8)).astype(np.float32)
+        curies = [f'test:{i:03}' for i in range(len(vectors))]
+        collection = Collection(dimensions=8, package_name='test', package_version='0.0.0')
+        bulk_insert_chunks(self.session, collection, [(curies, vectors)])
+
+        cache = CollectionCache(directory=os.path.join(self.directory.name, 'cache'), max_size=0)
+        build_ivf_index(curies, vectors, n_lists=4).save(get_ivf_index_path(collection, cache=cache))
+        self.assertIsNotNone(cache.load(collection))
+        self.assertEqual(1, len(cache.prune()))
+        self.assertEqual([], cache.entries())
+
+        index = load_ivf_index(collection, cache=cache)
+        self.assertIsNotNone(index)
+        self.assertEqual(4, index.n_lists)
+        np.testing.assert_array_equal(vectors, index.vectors)
+
+        cache.prune(versions={collection.id: collection.version})
+        self.assertIsNotNone(load_ivf_index(collection, cache=cache))
+        cache.invalidate(collection.id)
+        self.assertIsNone(load_ivf_index(collection, cache=cache))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the normalized entity table."""
+
+import numpy as np
+from sqlalchemy import text
+
+from embeddingdb.sql.bulk import bulk_insert_chunks, resolve_entities
+from embeddingdb.sql.migrate import upgrade_entity_table
+from embeddingdb.sql.models import (
+    COLLECTION_TABLE_NAME, Collection, EMBEDDING_TABLE_NAME, Embedding, Entity, get_engine, load_aligned,
+)
+from embeddingdb.sql.types import encode_vector
+from tests.cases import TemporaryDatabaseCase
+
+
+class TestEntities(TemporaryDatabaseCase):
+    """Test that embeddings reference shared entities by their integer identifiers."""
+
+    def upload(self, curies, vectors) -> Collection:
+        """Upload a collection."""
+        collection = Collection(dimensions=vectors.shape[1], package_name='test', package_version='0.0.0')
+        bulk_insert_chunks(self.session, collection, [(curies, vectors)])
+        return collection
+
+    def test_shared_entities(self):
+        """Test that collections with the same CURIEs share their entities and are aligned by them."""
+        random_state = np.random.RandomState(0)
+        curies_1 = [f'test:{i:02}' for i in range(0, 20)]
+        curies_2 = [f'test:{i:02}' for i in range(10, 30)]
+        vectors_1 = random_state.normal(size=(20, 4)).astype(np.float32)
+        vectors_2 = random_state.normal(size=(20, 6)).astype(np.float32)
+        collection_1 = self.upload(curies_1, vectors_1)
+        collection_2 = self.upload(curies_2, vectors_2)
+
+        entity_ids = dict(self.session.query(Entity.curie, Entity.id))
+        self.assertEqual(set(curies_1) | set(curies_2), set(entity_ids))
+        for collection, curies in ((collection_1, curies_1), (collection_2, curies_2)):
+            rows = self.session.query(Embedding.entity_id).filter(Embedding.collection_id == collection.id)
+            self.assertEqual({entity_ids[curie] for curie in curies}, {entity_id for entity_id, in rows})
+
+        # resolving again doesn't insert anything and keeps the order and duplicates of the CURIEs
+        curies = ['test:29', 'test:new', 'test:00', 'test:29']
+        resolved = resolve_entities(self.session, curies)
+        self.assertEqual([entity_ids['test:29'], resolved[1], entity_ids['test:00'], entity_ids['test:29']], resolved)
+        self.assertNotIn(resolved[1], entity_ids.values())
+        self.assertEqual(len(entity_ids) + 1, self.session.query(Entity).count())
+
+        curies, aligned_1, aligned_2 = load_aligned(collection_1, collection_2, use_cache=False)
+        self.assertEqual([f'test:{i:02}' for i in range(10, 20)], sorted(curies))
+        for curie, vector_1, vector_2 in zip(curies, aligned_1, aligned_2):
+            np.testing.assert_array_equal(vectors_1[curies_1.index(curie)], vector_1)
+            np.testing.assert_array_equal(vectors_2[curies_2.index(curie)], vector_2)
+
+    def test_upgrade(self):
+        """Test that upgrading embeddings that store their CURIEs fills in their entities."""
+        for _ in range(2):
+            self.session.add(Collection(dimensions=2, package_name='test', package_version='0.0.0'))
+        self.session.commit()
+        engine = get_engine(self.connection)
+        vectors = {
+            (1, 'test:a'): [1, 2],
+            (1, 'test:b'): [3, 4],
+            (2, 'test:b'): [5, 6],
+            (2, 'test:c'): [7, 8],
+        }
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE {EMBEDDING_TABLE_NAME}'))
+            connection.execute(text(
+                f'CREATE TABLE {EMBEDDING_TABLE_NAME} ('
+                f' id INTEGER PRIMARY KEY, curie VARCHAR(1023) NOT NULL, vector BLOB NOT NULL,'
+                f' collection_id INTEGER NOT NULL REFERENCES {COLLECTION_TABLE_NAME} (id),'
+                f' UNIQUE (collection_id, curie))'
+            ))
+            connection.execute(text(f'CREATE INDEX ix_{EMBEDDING_TABLE_NAME}_curie ON {EMBEDDING_TABLE_NAME} (curie)'))
+            for (collection_id, curie), vector in vectors.items():
+                connection.execute(
+                    text(
+                        f'INSERT INTO {EMBEDDING_TABLE_NAME} (curie, vector, collection_id)'
+                        f' VALUES (:curie, :vector, :collection_id)'
+                    ),
+                    curie=curie, vector=encode_vector(vector), collection_id=collection_id,
+                )
+
+        self.assertTrue(upgrade_entity_table(engine))
+        self.assertFalse(upgrade_entity_table(engine))
+
+        self.assertEqual({'test:a', 'test:b', 'test:c'}, {curie for curie, in self.session.query(Entity.curie)})
+        embeddings = self.session.query(Embedding).all()
+        self.assertEqual(len(vectors), len(embeddings))
+        for embedding in embeddings:
+            self.assertIsNotNone(embedding.entity_id)
+            np.testing.assert_array_equal(vectors[embedding.collection_id, embedding.curie], embedding.vector)
+        shared = {embedding.entity_id for embedding in embeddings if embedding.curie == 'test:b'}
+        self.assertEqual(1, len(shared))
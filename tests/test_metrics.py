@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the SQL metrics."""
+
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from embeddingdb.constants import config
+from embeddingdb.metrics import SQL_ERRORS, SQL_SECONDS, get_statement_shape
+from embeddingdb.sql.models import get_engine
+from tests.cases import TemporaryDatabaseCase
+
+
+@unittest.skipUnless(config.metrics, 'metrics are disabled')
+class TestSQLMetrics(TemporaryDatabaseCase):
+    """Test that the statements executed by engines are timed and failures are counted."""
+
+    def test_failed_statement(self):
+        """Test that a failing statement is counted as an error and doesn't skew later timings."""
+        statement = 'SELECT * FROM embeddingdb_missing'
+        shape = get_statement_shape(statement)
+        errors = SQL_ERRORS.get_value(query=shape)
+
+        with get_engine(self.connection).connect() as connection:
+            with self.assertRaises(OperationalError):
+                connection.execute(text(statement))
+            self.assertEqual(errors + 1, SQL_ERRORS.get_value(query=shape))
+            self.assertEqual([], connection.info.get('embeddingdb_query_start'))
+
+            count = SQL_SECONDS.get_count(query='SELECT 1')
+            connection.execute(text('SELECT 1'))
+            self.assertEqual(count + 1, SQL_SECONDS.get_count(query='SELECT 1'))
+            self.assertEqual([], connection.info['embeddingdb_query_start'])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for converting collections to another data type."""
+
+import numpy as np
+
+from embeddingdb.sql.bulk import bulk_insert_chunks
+from embeddingdb.sql.migrate import convert_collection
+from embeddingdb.sql.models import Collection
+from tests.cases import TemporaryDatabaseCase
+
+
+class TestConvertCollection(TemporaryDatabaseCase):
+    """Test :func:`embeddingdb.sql.migrate.convert_collection`."""
+
+    def setUp(self) -> None:
+        """Upload a float32 collection."""
+        super().setUp()
+        self.vectors = np.random.RandomState(0).normal(size=(30, 8)).astype(np.float32)
+        self.curies = [f'test:{i:02}' for i in range(len(self.vectors))]
+        self.collection = Collection(dimensions=8, package_name='test', package_version='0.0.0')
+        bulk_insert_chunks(self.session, self.collection, [(self.curies, self.vectors)], dtype='float32')
+
+    def test_idempotent(self):
+        """Test that converting again leaves the vectors and the version as they are."""
+        version = self.collection.version
+        converted = convert_collection(self.session, self.collection.id, dtype='int8', batch_size=7)
+        self.assertEqual(len(self.curies), converted)
+        self.session.refresh(self.collection)
+        self.assertNotEqual(version, self.collection.version)
+        converted = self.load(self.collection)
+
+        version = self.collection.version
+        self.assertEqual(0, convert_collection(self.session, self.collection.id, dtype='int8', batch_size=7))
+        self.session.refresh(self.collection)
+        self.assertEqual(version, self.collection.version)
+        again = self.load(self.collection)
+        self.assertEqual(set(converted), set(again))
+        for curie, vector in converted.items():
+            np.testing.assert_array_equal(vector, again[curie])
+
+    def test_unchanged(self):
+        """Test that converting to the data type a collection is stored with changes nothing."""
+        version = self.collection.version
+        self.assertEqual(0, convert_collection(self.session, self.collection.id, dtype='float32'))
+        self.session.refresh(self.collection)
+        self.assertEqual(version, self.collection.version)
+        loaded = self.load(self.collection)
+        for curie, vector in zip(self.curies, self.vectors):
+            np.testing.assert_array_equal(vector, loaded[curie])
+
+    def test_missing(self):
+        """Test that converting a collection that doesn't exist raises an error."""
+        with self.assertRaises(KeyError):
+            convert_collection(self.session, self.collection.id + 1, dtype='int8')
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming parsers."""
+
+import io
+import json
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from embeddingdb import parsers
+from embeddingdb.parsers import (
+    iter_pykeen_chunks, iter_word2vec_binary_chunks, iter_word2vec_text_chunks, iter_word2vec_text_chunks_parallel,
+    read_word2vec_header,
+)
+
+#: A small buffer, so entries span the blocks the parsers read
+SMALL_BUFFER = mock.patch.object(parsers, '_BUFFER_SIZE', 37)
+
+
+class TestParsers(unittest.TestCase):
+    """Test that the parsers round trip embeddings in several chunks."""
+
+    def setUp(self) -> None:
+        """Make a random matrix labeled by CURIEs, some not ASCII."""
+        self.vectors = np.random.RandomState(0).normal(size=(23, 5)).astype(np.float32)
+        self.curies = [f'test:{i:02}' for i in range(len(self.vectors))]
+        self.curies[4] = 'test:ünïcode'
+
+    def assert_chunks(self, chunks, chunk_size: int = 10):
+        """Assert that the chunks have the expected sizes and join to the CURIEs and vectors."""
+        chunks = list(chunks)
+        self.assertEqual(
+            [min(chunk_size, len(self.curies) - start) for start in range(0, len(self.curies), chunk_size)],
+            [len(curies) for curies, _ in chunks],
+        )
+        for curies, vectors in chunks:
+            self.assertEqual(np.float32, vectors.dtype)
+            self.assertEqual((len(curies), self.vectors.shape[1]), vectors.shape)
+        self.assertEqual(self.curies, [curie for curies, _ in chunks for curie in curies])
+        np.testing.assert_array_equal(self.vectors, np.vstack([vectors for _, vectors in chunks]))
+
+    def get_word2vec_text(self) -> str:
+        """Write the embeddings in the word2vec text format."""
+        lines = [f'{len(self.curies)} {self.vectors.shape[1]}']
+        lines.extend(
+            ' '.join([curie, *(repr(float(value)) for value in vector)])
+            for curie, vector in zip(self.curies, self.vectors)
+        )
+        return '\n'.join(lines) + '\n'
+
+    def test_word2vec_header(self):
+        """Test reading the header of a word2vec file."""
+        self.assertEqual((23, 5), read_word2vec_header('23 5\n'))
+
+    def test_word2vec_text(self):
+        """Test parsing a word2vec text file."""
+        file = io.StringIO(self.get_word2vec_text())
+        self.assertEqual((23, 5), read_word2vec_header(file.readline()))
+        self.assert_chunks(iter_word2vec_text_chunks(file, 5, chunk_size=10))
+
+    def test_word2vec_text_parallel(self):
+        """Test parsing a word2vec text file in this process and with a pool of workers."""
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                file = io.BytesIO(self.get_word2vec_text().encode('utf-8'))
+                file.readline()
+                self.assert_chunks(iter_word2vec_text_chunks_parallel(file, 5, chunk_size=10, workers=workers))
+
+    def test_word2vec_binary(self):
+        """Test parsing a word2vec binary file, with and without newlines after the vectors."""
+        for newline in (b'', b'\n'):
+            with self.subTest(newline=newline):
+                data = b''.join(
+                    curie.encode('utf-8') + b' ' + vector.astype('<f4').tobytes() + newline
+                    for curie, vector in zip(self.curies, self.vectors)
+                )
+                file = io.BytesIO(b'23 5\n' + data)
+                self.assertEqual((23, 5), read_word2vec_header(file.readline().decode('utf-8')))
+                with SMALL_BUFFER:
+                    self.assert_chunks(iter_word2vec_binary_chunks(file, 5, chunk_size=10))
+
+    def test_word2vec_binary_truncated(self):
+        """Test that a truncated word2vec binary file raises an error."""
+        file = io.BytesIO(b'test:00 ' + self.vectors[0].astype('<f4').tobytes()[:-1])
+        with self.assertRaises(ValueError):
+            list(iter_word2vec_binary_chunks(file, 5))
+
+    def test_pykeen(self):
+        """Test parsing a PyKEEN embedding file."""
+        text = json.dumps(
+            {curie: vector.tolist() for curie, vector in zip(self.curies, self.vectors)},
+            ensure_ascii=False,
+            indent=2,
+        )
+        with SMALL_BUFFER:
+            self.assert_chunks(iter_pykeen_chunks(io.StringIO(text), 5, chunk_size=10))
+        self.assertEqual([], list(iter_pykeen_chunks(io.StringIO('{ }'), 5)))
+
+    def test_pykeen_invalid(self):
+        """Test that invalid PyKEEN embedding files raise errors."""
+        for text in ('[]', '{"test:00": 1}', '{"test:00": [1, 2, 3, 4, 5]', '{"test:00": [1, 2, 3, 4, 5'):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                list(iter_pykeen_chunks(io.StringIO(text), 5))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for exact nearest neighbor search."""
+
+import unittest
+
+import numpy as np
+
+from embeddingdb.search import ExactIndex, METRICS
+
+
+def brute_force(vectors: np.ndarray, queries: np.ndarray, metric: str) -> np.ndarray:
+    """Score all pairs of queries and rows in float64."""
+    vectors, queries = vectors.astype(np.float64), queries.astype(np.float64)
+    if metric == 'cosine':
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries @ vectors.T
+
+
+class TestExactIndex(unittest.TestCase):
+    """Test :class:`embeddingdb.search.ExactIndex`."""
+
+    def setUp(self) -> None:
+        """Make a random matrix labeled by shuffled CURIEs, some not ASCII."""
+        random_state = np.random.RandomState(0)
+        self.vectors = random_state.normal(size=(500, 16)).astype(np.float32)
+        self.curies = [f'test:{i:03}' for i in range(len(self.vectors))]
+        self.curies[7] = 'test:ünïcode'
+        self.queries = random_state.normal(size=(20, 16)).astype(np.float32)
+
+    def test_top_k(self):
+        """Test that the neighbors match a brute force search, across several blocks."""
+        for metric in METRICS:
+            with self.subTest(metric=metric):
+                index = ExactIndex(self.curies, self.vectors, metric=metric, block_size=64)
+                expected = brute_force(self.vectors, self.queries, metric)
+                for k in (1, 10):
+                    neighbors = index.search_curies(self.queries, k)
+                    for row, query_neighbors in zip(expected, neighbors):
+                        top = np.argsort(-row)[:k]
+                        self.assertEqual([self.curies[i] for i in top], [curie for curie, _ in query_neighbors])
+                        np.testing.assert_allclose(row[top], [score for _, score in query_neighbors], rtol=1e-4,
+                                                   atol=1e-5)
+
+    def test_k_larger_than_index(self):
+        """Test that asking for more neighbors than rows returns all rows."""
+        index = ExactIndex(self.curies[:5], self.vectors[:5])
+        positions, scores = index.search(self.queries, 10)
+        self.assertEqual((len(self.queries), 5), positions.shape)
+        self.assertTrue((np.diff(scores, axis=1) <= 0).all())
+
+    def test_lookup(self):
+        """Test that vectors are found by CURIE, whatever order the CURIEs were given in."""
+        index = ExactIndex(self.curies, self.vectors)
+        self.assertEqual(len(self.curies), len(index))
+        np.testing.assert_array_equal(self.vectors[7], index.get_vector('test:ünïcode'))
+        self.assertIsNone(index.get_vector('test:missing'))
+
+        found, vectors, missing = index.get_vectors(['test:010', 'test:missing', 'test:ünïcode', 'test:010'])
+        self.assertEqual(['test:010', 'test:ünïcode'], found)
+        self.assertEqual(['test:missing'], missing)
+        np.testing.assert_array_equal(self.vectors[[10, 7]], vectors)
+
+    def test_invalid(self):
+        """Test that invalid metrics and values of k are rejected."""
+        with self.assertRaises(ValueError):
+            ExactIndex(self.curies, self.vectors, metric='euclidean')
+        with self.assertRaises(ValueError):
+            ExactIndex(self.curies, self.vectors).search(self.queries, 0)
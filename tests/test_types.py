@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the packed vector encoding."""
+
+import unittest
+
+import numpy as np
+
+from embeddingdb.sql.types import DTYPES, decode_vector, decode_vectors, encode_vector, encode_vectors
+
+
+class TestVectorEncoding(unittest.TestCase):
+    """Test round trips through :func:`encode_vectors` and :func:`decode_vector`."""
+
+    def setUp(self) -> None:
+        """Make a random matrix with a row of zeros."""
+        self.vectors = np.random.RandomState(0).normal(size=(50, 24)).astype(np.float32)
+        self.vectors[3] = 0
+
+    def test_float32(self):
+        """Test that float32 vectors are decoded exactly."""
+        for packed, vector in zip(encode_vectors(self.vectors, dtype='float32'), self.vectors):
+            self.assertEqual(DTYPES['float32'], packed[0])
+            self.assertEqual(1 + 4 * len(vector), len(packed))
+            np.testing.assert_array_equal(vector, decode_vector(packed))
+
+    def test_float16(self):
+        """Test that float16 vectors are decoded within half precision."""
+        for packed, vector in zip(encode_vectors(self.vectors, dtype='float16'), self.vectors):
+            self.assertEqual(DTYPES['float16'], packed[0])
+            self.assertEqual(1 + 2 * len(vector), len(packed))
+            decoded = decode_vector(packed)
+            self.assertEqual(np.float32, decoded.dtype)
+            np.testing.assert_allclose(vector, decoded, rtol=1e-3, atol=1e-4)
+
+    def test_int8(self):
+        """Test that int8 vectors are decoded within half of their scale."""
+        for packed, vector in zip(encode_vectors(self.vectors, dtype='int8'), self.vectors):
+            self.assertEqual(DTYPES['int8'], packed[0])
+            self.assertEqual(1 + 4 + len(vector), len(packed))
+            scale = np.frombuffer(packed, dtype='<f4', count=1, offset=1)[0]
+            if not vector.any():
+                self.assertEqual(1, scale)
+            else:
+                self.assertAlmostEqual(np.abs(vector).max() / 127, scale, places=6)
+            decoded = decode_vector(packed)
+            self.assertEqual(np.float32, decoded.dtype)
+            self.assertLessEqual(np.abs(vector - decoded).max(), scale / 2 + 1e-6)
+
+    def test_encode_vector(self):
+        """Test that a single vector is encoded like a row of a matrix."""
+        for dtype in DTYPES:
+            with self.subTest(dtype=dtype):
+                expected = encode_vectors(self.vectors[:1], dtype=dtype)[0]
+                self.assertEqual(expected, encode_vector(self.vectors[0], dtype=dtype))
+
+    def test_decode_vectors(self):
+        """Test that decoding many vectors at once matches decoding them one by one, even with mixed tags."""
+        dimensions = self.vectors.shape[1]
+        mixed = []
+        for i, dtype in enumerate(DTYPES):
+            values = encode_vectors(self.vectors, dtype=dtype)
+            mixed.extend(values[i::len(DTYPES)])
+            with self.subTest(dtype=dtype):
+                np.testing.assert_array_equal(
+                    np.vstack([decode_vector(value) for value in values]),
+                    decode_vectors(values, dimensions),
+                )
+        np.testing.assert_array_equal(
+            np.vstack([decode_vector(value) for value in mixed]),
+            decode_vectors(mixed, dimensions),
+        )
+        self.assertEqual((0, dimensions), decode_vectors([], dimensions).shape)
+
+    def test_invalid_dtype(self):
+        """Test that an unknown data type is rejected."""
+        with self.assertRaises(ValueError):
+            encode_vectors(self.vectors, dtype='float64')
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for resuming and updating uploads on SQLite."""
+
+import json
+import os
+from typing import Iterable, Mapping
+
+import numpy as np
+from click.testing import CliRunner
+
+from embeddingdb.sql.bulk import bulk_insert_chunks, get_source, upsert_chunks
+from embeddingdb.sql.io import main
+from embeddingdb.sql.models import Checkpoint, Collection, Embedding, Entity, get_entity_embeddings, is_complete
+from tests.cases import TemporaryDatabaseCase
+
+
+class Interrupted(Exception):
+    """Raised to interrupt an upload."""
+
+
+def interrupt(chunks: Iterable, after: int) -> Iterable:
+    """Yield the given number of chunks then raise :class:`Interrupted`."""
+    for i, chunk in enumerate(chunks):
+        if i == after:
+            raise Interrupted
+        yield chunk
+
+
+class TestUpload(TemporaryDatabaseCase):
+    """Test the ``--resume`` and ``--update`` options of ``embeddingdb upload``."""
+
+    def setUp(self) -> None:
+        """Write the metadata of the uploads."""
+        super().setUp()
+        self.random_state = np.random.RandomState(0)
+        self.metadata_path = os.path.join(self.directory.name, 'metadata.json')
+        with open(self.metadata_path, 'w') as file:
+            json.dump(dict(package_name='test', package_version='0.0.0'), file)
+
+    def write_word2vec(self, name: str, embeddings: Mapping[str, np.ndarray]) -> str:
+        """Write embeddings to a word2vec text file."""
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as file:
+            print(len(embeddings), 8, file=file)
+            for curie, vector in embeddings.items():
+                print(curie, *(repr(float(value)) for value in vector), file=file)
+        return path
+
+    def make_embeddings(self, start: int, stop: int) -> Mapping[str, np.ndarray]:
+        """Make random embeddings for a range of CURIEs."""
+        return {f'test:{i:03}': self.random_state.normal(size=8).astype(np.float32) for i in range(start, stop)}
+
+    def upload(self, path: str, *args: str) -> str:
+        """Upload a word2vec file with the command line interface and return its output."""
+        result = CliRunner().invoke(main, [
+            '-f', 'word2vec', '-p', path, '-m', self.metadata_path, '-b', '10', '-w', '1', '-c', self.connection,
+            *args,
+        ])
+        self.assertEqual(0, result.exit_code, msg=result.output)
+        return result.output
+
+    def assert_embeddings(self, collection_id: int, expected: Mapping[str, np.ndarray]) -> None:
+        """Assert that a collection has exactly the expected embeddings."""
+        self.session.expire_all()
+        loaded = self.load(self.session.query(Collection).get(collection_id))
+        self.assertEqual(set(expected), set(loaded))
+        for curie, vector in expected.items():
+            np.testing.assert_array_equal(vector, loaded[curie])
+
+    def test_resume(self):
+        """Test that an interrupted upload is resumed into the same collection without duplicates."""
+        embeddings = self.make_embeddings(0, 45)
+        path = self.write_word2vec('test.txt', embeddings)
+        items = list(embeddings.items())
+        chunks = [
+            ([curie for curie, _ in batch], np.vstack([vector for _, vector in batch]))
+            for batch in (items[start:start + 10] for start in range(0, len(items), 10))
+        ]
+        collection = Collection(dimensions=8, package_name='test', package_version='0.0.0')
+        with self.assertRaises(Interrupted):
+            bulk_insert_chunks(self.session, collection, interrupt(chunks, 2), source=get_source(path))
+        self.session.rollback()
+        checkpoint = self.session.query(Checkpoint).one()
+        self.assertEqual(collection.id, checkpoint.collection_id)
+        self.assertEqual(20, checkpoint.rows)
+        # the partial collection is hidden until the upload completes
+        self.assertEqual(0, self.session.query(Collection).filter(is_complete()).count())
+        self.assertEqual(([], []), get_entity_embeddings(self.session, ['test:000']))
+        self.session.commit()
+
+        self.assertRegex(self.upload(path, '--resume'), rf'Uploaded collection {collection.id}\n$')
+        self.assertEqual(0, self.session.query(Checkpoint).count())
+        self.assertEqual(1, self.session.query(Collection).count())
+        self.assertEqual(len(embeddings), self.session.query(Embedding).count())
+        self.assert_embeddings(collection.id, embeddings)
+
+        # resuming without a checkpoint starts a new upload
+        self.assertRegex(self.upload(path, '--resume'), rf'Uploaded collection {collection.id + 1}\n$')
+        self.assert_embeddings(collection.id + 1, embeddings)
+        self.assertEqual(2, self.session.query(Collection).filter(is_complete()).count())
+
+    def test_rollback(self):
+        """Test that a failed upload that can't be resumed is rolled back."""
+        chunks = [([f'test:{i:03}'], self.random_state.normal(size=(1, 8)).astype(np.float32)) for i in range(5)]
+        collection = Collection(dimensions=8, package_name='test', package_version='0.0.0')
+        with self.assertRaises(Interrupted):
+            bulk_insert_chunks(self.session, collection, interrupt(chunks, 2))
+        self.assertEqual(0, self.session.query(Collection).count())
+        self.assertEqual(0, self.session.query(Checkpoint).count())
+        self.assertEqual(0, self.session.query(Embedding).count())
+
+    def test_replace(self):
+        """Test that replacing a collection keeps its identifier and removes the staging collection."""
+        self.upload(self.write_word2vec('old.txt', self.make_embeddings(0, 30)))
+        collection = self.session.query(Collection).one()
+        version = collection.version
+
+        new = self.make_embeddings(20, 45)
+        output = self.upload(self.write_word2vec('new.txt', new), '-r', str(collection.id))
+        self.assertRegex(output, rf'Replaced collection {collection.id} with {len(new)} embeddings\n$')
+        self.assertEqual(1, self.session.query(Collection).count())
+        self.assert_embeddings(collection.id, new)
+        self.session.refresh(collection)
+        self.assertNotEqual(version, collection.version)
+
+    def test_update(self):
+        """Test that updating a collection writes new and changed embeddings and keeps the rest."""
+        old = self.make_embeddings(0, 30)
+        self.upload(self.write_word2vec('old.txt', old))
+        collection = self.session.query(Collection).one()
+        version = collection.version
+
+        new = {**old, **self.make_embeddings(20, 40)}
+        del new['test:000']
+        output = self.upload(self.write_word2vec('new.txt', new), '-u', str(collection.id))
+        self.assertRegex(output, rf'Updated collection {collection.id}\n$')
+        self.assert_embeddings(collection.id, {**old, **new})
+        self.session.refresh(collection)
+        self.assertNotEqual(version, collection.version)
+        self.assertEqual(40, self.session.query(Entity).count())
+
+    def test_update_remove_missing(self):
+        """Test that updating a collection with ``--remove-missing`` deletes the embeddings not in the file."""
+        old = self.make_embeddings(0, 30)
+        self.upload(self.write_word2vec('old.txt', old))
+        collection = self.session.query(Collection).one()
+
+        new = {**self.make_embeddings(10, 20), **{curie: old[curie] for curie in list(old)[20:]}}
+        self.upload(self.write_word2vec('new.txt', new), '-u', str(collection.id), '--remove-missing')
+        self.assert_embeddings(collection.id, new)
+        self.assertEqual(len(new), self.session.query(Embedding).count())
+
+    def test_duplicates(self):
+        """Test that the last vector of a CURIE repeated in a chunk is kept when inserting and updating."""
+        vectors = self.random_state.normal(size=(4, 8)).astype(np.float32)
+        collection = Collection(dimensions=8, package_name='test', package_version='0.0.0')
+        bulk_insert_chunks(self.session, collection, [(['test:000', 'test:001', 'test:000'], vectors[:3])])
+        self.assert_embeddings(collection.id, {'test:000': vectors[2], 'test:001': vectors[1]})
+
+        upsert_chunks(self.session, collection, [(['test:001', 'test:002', 'test:001'], vectors[1:])],
+                      remove_missing=True)
+        self.assert_embeddings(collection.id, {'test:001': vectors[3], 'test:002': vectors[2]})
+        # the scratch table of the seen entities is dropped
+        self.assertEqual([], [name for name in self.session.get_bind().table_names() if '_seen_' in name])
+
+    def test_update_missing_collection(self):
+        """Test that updating a collection that doesn't exist fails."""
+        result = CliRunner().invoke(main, [
+            '-f', 'word2vec', '-p', self.write_word2vec('test.txt', self.make_embeddings(0, 5)),
+            '-m', self.metadata_path, '-u', '1', '-c', self.connection,
+        ])
+        self.assertNotEqual(0, result.exit_code)
+        self.assertIsInstance(result.exception, KeyError)